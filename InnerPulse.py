@@ -1,16 +1,34 @@
-import sys, numpy as np, sounddevice as sd, queue, time, math, random, json, os, platform, signal
-from PySide6.QtCore import Qt, QTimer, QPointF, QRect, QEvent, QObject
+import sys, time
+STARTUP = {"t0": time.perf_counter()} # 起動プロファイラ: 各段階の perf_counter を記録 (startup_report)
+import numpy as np, queue, math, random, json, os, platform, signal, threading, heapq, collections
+from types import MappingProxyType
+from PySide6.QtCore import Qt, QTimer, QPointF, QRect, QRectF, QEvent, QObject, Signal
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-                             QGridLayout, QLabel, QComboBox, QPushButton, QSpinBox,
+                             QGridLayout, QLabel, QComboBox, QPushButton, QSpinBox, QDoubleSpinBox,
                              QSlider, QFrame, QCheckBox, QTextEdit, QDialog, QTableWidget,
                              QTableWidgetItem, QHeaderView, QAbstractItemView,
-                             QLineEdit, QAbstractSpinBox, QMenu)
-from PySide6.QtGui import QPainter, QPen, QColor, QFont, QCursor, QAction, QActionGroup, QRadialGradient
+                             QLineEdit, QMenu, QGraphicsView, QGraphicsScene,
+                             QGraphicsItem, QGraphicsPathItem, QGraphicsRectItem, QGraphicsLineItem,
+                             QGraphicsEllipseItem, QGraphicsSimpleTextItem)
+from PySide6.QtGui import (QPainter, QPen, QColor, QFont, QCursor, QAction, QActionGroup, QRadialGradient, QBrush, QPainterPath,
+                           QShortcut, QKeySequence)
+
+class _LazyModule:
+    # 初回の属性アクセスで import する。sounddevice は import 時に PortAudio を初期化するので、ウィンドウ表示後まで遅らせる
+    def __init__(self, name): self._name, self._mod = name, None
+    def __getattr__(self, attr):
+        if self._mod is None: self._mod = __import__(self._name)
+        return getattr(self._mod, attr)
+
+sd = _LazyModule("sounddevice")
+STARTUP["imports"] = time.perf_counter()
 
 # ==========================================
 #  Constants & Config
 # ==========================================
 APP_NAME = "InnerPulse"
+ACTIVE_POLL_MS = 10 # UI ポーリング (再生中/操作中)
+IDLE_POLL_MS = 500 # アイドル中
 APP_VERSION = "v1.8.0"
 JSON_FILENAME = "setlist.json"
 CONFIG_FILENAME = "config.json"
@@ -154,6 +172,624 @@ SETLIST_STYLE = """
     QPushButton { font-size: 12px; padding: 6px; }
 """
 
+# ==========================================
+#  Sample I/O
+# ==========================================
+KIT_VOICES = ["acc", "backbeat", "4th", "8th", "16th", "trip"]
+# サンプル未設定のボイスの内蔵音: _make_wave の (type, freq, duration)
+SYNTH_WAVES = {"acc": ("bell", 2000, 0.1), "backbeat": ("snare", 1000, 0.15), "4th": ("click", 800, 0.1),
+               "8th": ("hihat", 1000, 0.1), "16th": ("shaker", 1000, 0.1), "trip": ("wood", 1000, 0.1)}
+KIT_CACHE_MAX = 32 # デコード済みサンプルの保持数 (古い順に捨てる)
+BUS_NAMES = KIT_VOICES + ["cue", "track_l", "track_r"]
+BUS_INDEX = {name: i for i, name in enumerate(BUS_NAMES)}
+# ルーティング未設定のバスの既定 (それ以外は ch 1+2 のセンター)
+BUS_DEFAULT_ROUTING = {"track_l": {"ch": [0]}, "track_r": {"ch": [1]}}
+
+def parse_headroom(h):
+    # config の headroom_db: {bus: dB (<= 0)}。旧形式の数値 1 つは全バス共通として読む
+    if not isinstance(h, dict): h = {b: h for b in BUS_NAMES}
+    return {b: min(0.0, float(v)) for b, v in h.items() if b in BUS_INDEX and float(v) != 0.0}
+# 追加メトロノームレイヤーの既定値 (config の "layers" に無いキーはこれで埋める)
+LAYER_DEFAULTS = {"name": "Layer", "bpm": 120, "bpb": 4, "play": 1, "mute": 0, "v_acc": 0.8, "v_backbeat": 0.0, "v_4th": 0.5,
+                  "v_8th": 0.0, "v_16th": 0.0, "v_trip": 0.0, "v_mute_dim": 0.0, "rnd": False, "force_play": False,
+                  "voices": (), "sound": "", "enabled": True}
+
+def read_wav_mmap(path):
+    # RIFF/WAVE を memmap で開く (PCM 16/24/32bit, float32/64)。戻り値は (frames, ch) の float32 と SR
+    decode, frames, ch, sr = open_wav_mmap(path)
+    return decode(0, frames), sr
+
+def open_wav_mmap(path):
+    # ヘッダだけ読み、任意区間 [a, b) を (n, ch) float32 に直す decode と frames, ch, sr を返す (本体は memmap のまま)
+    with open(path, 'rb') as f:
+        head = f.read(12)
+        if head[:4] != b'RIFF' or head[8:12] != b'WAVE': raise ValueError("not a WAV file")
+        fmt = None; pos = 12
+        while True:
+            ck = f.read(8)
+            if len(ck) < 8: raise ValueError("no data chunk")
+            cid, size = ck[:4], int.from_bytes(ck[4:], 'little')
+            if cid == b'fmt ':
+                raw = f.read(size)
+                tag, ch, sr = int.from_bytes(raw[0:2], 'little'), int.from_bytes(raw[2:4], 'little'), int.from_bytes(raw[4:8], 'little')
+                bits = int.from_bytes(raw[14:16], 'little')
+                if tag == 0xFFFE and size >= 26: tag = int.from_bytes(raw[24:26], 'little')
+                fmt = (tag, ch, sr, bits)
+            elif cid == b'data':
+                if fmt is None: raise ValueError("data before fmt")
+                data_off, data_len = pos + 8, size
+                break
+            else: f.seek(size + (size & 1), 1)
+            pos += 8 + size + (size & 1)
+    tag, ch, sr, bits = fmt
+    width = bits // 8
+    frames = data_len // (width * ch)
+    if tag == 3 and bits in (32, 64):
+        data = np.memmap(path, dtype=f'<f{width}', mode='r', offset=data_off, shape=(frames, ch))
+        return (lambda a, b: data[a:b].astype(np.float32)), frames, ch, sr
+    if tag != 1: raise ValueError(f"unsupported WAV format {tag}")
+    if bits == 24:
+        raw = np.memmap(path, dtype=np.uint8, mode='r', offset=data_off, shape=(frames, ch, 3))
+        def decode(a, b):
+            r = raw[a:b]
+            i32 = (r[..., 0].astype(np.int32) | (r[..., 1].astype(np.int32) << 8) | (r[..., 2].astype(np.int32) << 16)) << 8
+            return (i32 / 2147483648.0).astype(np.float32)
+        return decode, frames, ch, sr
+    if bits == 8:
+        data = np.memmap(path, dtype=np.uint8, mode='r', offset=data_off, shape=(frames, ch))
+        return (lambda a, b: (data[a:b].astype(np.float32) - 128.0) / 128.0), frames, ch, sr
+    data = np.memmap(path, dtype=f'<i{width}', mode='r', offset=data_off, shape=(frames, ch))
+    return (lambda a, b: (data[a:b] / float(2 ** (bits - 1))).astype(np.float32)), frames, ch, sr
+
+def resample(x, sr_in, sr_out):
+    # 帯域制限 FFT リサンプラ。ワンショット素材向けに末尾をゼロパディングして循環の回り込みを防ぐ
+    x = np.asarray(x, dtype=np.float64)
+    if sr_in == sr_out or len(x) == 0: return x.astype(np.float32)
+    pad = max(64, len(x) // 8)
+    n_in = len(x) + pad
+    n_out = int(round(n_in * sr_out / sr_in))
+    X = np.fft.rfft(x, n_in)
+    n_bins = min(len(X), n_out // 2 + 1)
+    Y = np.zeros(n_out // 2 + 1, dtype=np.complex128)
+    Y[:n_bins] = X[:n_bins]
+    # 上端 5% をレイズドコサインで落としてギブス振動を抑える
+    taper = max(1, n_bins // 20)
+    Y[n_bins - taper:n_bins] *= 0.5 + 0.5 * np.cos(np.linspace(0, np.pi, taper))
+    y = np.fft.irfft(Y, n_out) * (n_out / n_in)
+    return y[:int(round(len(x) * sr_out / sr_in))].astype(np.float32)
+
+class TrackStream:
+    # バッキングトラックのディスクストリーミング。WAV は memmap、それ以外は soundfile (あれば) でチャンク単位にデコードし、
+    # 背景スレッドがプリフェッチリングを埋める。コールバックはリングから読むだけ (単一生産者/単一消費者、カウンタは単調増加)
+    def __init__(self, path, sr, gain=1.0, offset_s=0.0, ring_s=4.0, chunk=8192):
+        self.path, self.sr, self.gain, self.offset_s = path, sr, gain, offset_s
+        if path.lower().endswith(".wav"):
+            self._decode, self.n_src, ch, self.src_sr = open_wav_mmap(path)
+            self._sf = None
+        else:
+            import soundfile
+            self._sf = soundfile.SoundFile(path)
+            self.n_src, ch, self.src_sr = self._sf.frames, self._sf.channels, self._sf.samplerate
+            self._decode = self._sf_decode
+        self.src_ch = ch
+        self.step = self.src_sr / sr # 出力 1 サンプルあたりの元サンプル数 (≠1 なら線形補間)
+        self.chunk = chunk
+        self.ring = np.zeros((max(int(ring_s * sr), 4 * chunk), 2), dtype=np.float32)
+        self.r = self.w = 0
+        self.underruns = 0
+        self.seek_to = 0.0 # 出力サンプル単位。None 以外なら生産側が処理する
+        self.src_pos = 0.0; self.eof = False
+        self._wake = threading.Event(); self._stop = False
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _sf_decode(self, a, b):
+        self._sf.seek(a)
+        return self._sf.read(b - a, dtype='float32', always_2d=True)
+
+    def _src(self, a, b):
+        # [a, b) を (n, 2) float32 で。範囲外 (頭の無音やファイル末尾の先) はゼロ
+        out = np.zeros((b - a, 2), dtype=np.float32)
+        lo, hi = max(a, 0), min(b, self.n_src)
+        if hi > lo:
+            x = self._decode(lo, hi)
+            out[lo - a:hi - a] = x[:, :2] if self.src_ch >= 2 else x[:, :1]
+        return out
+
+    def _produce(self, n):
+        pos = self.src_pos
+        if self.step == 1.0 and pos == int(pos):
+            y = self._src(int(pos), int(pos) + n)
+        else:
+            idx = pos + np.arange(n) * self.step
+            i0 = int(math.floor(idx[0])); x = self._src(i0, int(math.floor(idx[-1])) + 2)
+            k = (idx - i0).astype(np.int64); f = (idx - i0 - k).astype(np.float32)[:, None]
+            y = x[k] * (1.0 - f) + x[k + 1] * f
+        self.src_pos = pos + n * self.step
+        self.eof = self.src_pos >= self.n_src
+        return y * self.gain
+
+    def _fill(self):
+        N = len(self.ring)
+        while not self._stop:
+            if self.seek_to is not None:
+                # 出力サンプル t の位置へ (offset_s > 0 ならトラックの頭を遅らせる)。seek 中は消費側が読まないので r は止まっている
+                t = self.seek_to
+                self.src_pos = (t - self.offset_s * self.sr) * self.step; self.eof = False
+                self.w = self.r
+                if self.seek_to == t: self.seek_to = None
+            space = N - (self.w - self.r)
+            if self.eof or space < self.chunk or self.seek_to is not None:
+                self._wake.wait(0.02); self._wake.clear(); continue
+            y = self._produce(self.chunk); w = self.w % N
+            n1 = min(len(y), N - w)
+            self.ring[w:w + n1] = y[:n1]; self.ring[:len(y) - n1] = y[n1:]
+            self.w += len(y)
+
+    def read(self, bus_l, bus_r, frames):
+        # コールバックから。足りなければ不足分は無音 (EOF でなければアンダーランとして数える)
+        if self.seek_to is not None: return
+        N = len(self.ring); r = self.r % N
+        n = min(frames, self.w - self.r)
+        n1 = min(n, N - r)
+        bus_l[:n1] += self.ring[r:r + n1, 0]; bus_r[:n1] += self.ring[r:r + n1, 1]
+        bus_l[n1:n] += self.ring[:n - n1, 0]; bus_r[n1:n] += self.ring[:n - n1, 1]
+        self.r += n
+        if n < frames and not self.eof: self.underruns += 1
+        if self.w - self.r < N // 2: self._wake.set()
+
+    def rewind(self, t=0.0):
+        self.seek_to = float(t); self._wake.set()
+
+    def ready(self):
+        # 頭出しが済んで、リングの半分 (最大 4 チャンク) が埋まったか
+        return self.seek_to is None and (self.w - self.r >= min(len(self.ring) // 2, self.chunk * 4) or self.eof)
+
+    def wait_ready(self, timeout=0.5):
+        t_end = time.perf_counter() + timeout
+        while not self.ready() and time.perf_counter() < t_end:
+            time.sleep(0.002)
+
+    def close(self):
+        self._stop = True; self._wake.set()
+        if self._sf is not None: self._sf.close()
+
+CUE_KEYS = ("count_in", "cue_bars", "cue_sections", "v_cue")
+
+def count_in_words(bpb, last):
+    # 最後のカウントイン小節が 4 拍なら "1, 2, ready, go"、それ以外は拍番号
+    return ["1", "2", "ready", "go"] if last and bpb == 4 else [str(i + 1) for i in range(bpb)]
+
+class CueLibrary:
+    # 音声キュー (数字 / ready / go / セクション名) の素材集。<root>/<lang>/<word>.wav を初めて要る時にデコードし、
+    # デバイス SR へ一度だけリサンプルして合計バイト数上限つきの LRU に置く。コールバックは peek (デコードしない) だけ
+    def __init__(self, root, sr, lang="", max_bytes=32 << 20):
+        self.root = os.path.join(root, lang) if lang else root
+        self.sr, self.max_bytes = sr, max_bytes
+        self.cache = collections.OrderedDict(); self.bytes = 0
+        self.missing = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def languages(root):
+        try: return sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+        except OSError: return []
+
+    def get(self, word):
+        word = str(word).lower()
+        with self.lock:
+            if word in self.cache:
+                self.cache.move_to_end(word); return self.cache[word]
+        if word in self.missing: return None
+        path = os.path.join(self.root, f"{word}.wav")
+        try:
+            data, sr = read_wav_mmap(path)
+            x = resample(data.mean(axis=1), sr, self.sr)
+        except (OSError, ValueError):
+            self.missing.add(word); return None
+        with self.lock:
+            self.cache[word] = x; self.bytes += x.nbytes
+            while self.bytes > self.max_bytes and len(self.cache) > 1:
+                _, old = self.cache.popitem(last=False); self.bytes -= old.nbytes
+        return x
+
+    def peek(self, word):
+        # コールバック用: キャッシュ済みのときだけ返す (LRU の順序は prefetch 側で更新)
+        return self.cache.get(str(word).lower())
+
+    def prefetch(self, words):
+        for w in words: self.get(w)
+
+# ==========================================
+#  Timing Analysis
+# ==========================================
+class OnsetDetector:
+    # ブロック単位のスペクトルフラックス。hop ごとのフレームをまとめて 1 回の rfft で処理する
+    def __init__(self, sr, n_fft=1024, hop=256, k=1.6, delta=0.02, refractory=0.06):
+        self.sr, self.n_fft, self.hop = sr, n_fft, hop
+        self.win = np.hanning(n_fft).astype(np.float32)
+        self.k, self.delta, self.refractory = k, delta, int(refractory * sr)
+        self.reset()
+
+    def reset(self):
+        self.tail = np.zeros(self.n_fft - self.hop, dtype=np.float32)
+        self.prev = np.zeros(self.n_fft // 2 + 1, dtype=np.float32)
+        self.hist = np.zeros(32, dtype=np.float32); self.hist_i = 0
+        self.above = False; self.last_onset = -10 ** 12; self.warmup = len(self.hist)
+
+    def process(self, x, start_s):
+        buf = np.concatenate((self.tail, x))
+        base = start_s - len(self.tail) # buf[0] の絶対サンプル位置
+        n = (len(buf) - self.n_fft) // self.hop + 1
+        if n <= 0: self.tail = buf; return []
+        frames = np.lib.stride_tricks.sliding_window_view(buf, self.n_fft)[::self.hop][:n]
+        mag = np.log1p(100.0 * np.abs(np.fft.rfft(frames * self.win, axis=1))).astype(np.float32)
+        flux = np.maximum(mag - np.vstack((self.prev[None], mag[:-1])), 0).mean(axis=1)
+        self.prev = mag[-1]; self.tail = buf[n * self.hop:]
+        onsets = []
+        for t in range(n):
+            thr = self.k * self.hist.mean() + self.delta
+            self.hist[self.hist_i] = flux[t]; self.hist_i = (self.hist_i + 1) % len(self.hist)
+            if self.warmup > 0: self.warmup -= 1; continue
+            if flux[t] > thr:
+                if not self.above:
+                    # フレーム内の包絡線で立ち上がりサンプルまで詰める
+                    seg = np.abs(frames[t][self.n_fft // 2 - self.hop:])
+                    pos = base + t * self.hop + self.n_fft // 2 - self.hop + int(np.argmax(seg >= 0.3 * seg.max()))
+                    if pos - self.last_onset >= self.refractory:
+                        onsets.append(pos); self.last_onset = pos
+                self.above = True
+            else: self.above = False
+        return onsets
+
+class TimingScorer:
+    # 予定クリック (出力側サンプル時計) と検出オンセットを突き合わせ、拍ごとの前後ズレとスコアを出す
+    def __init__(self, sr, tolerance_ms=50.0):
+        self.sr, self.tol = sr, tolerance_ms
+        self.expected = collections.deque(maxlen=64)
+        self.reset()
+
+    def reset(self):
+        self.expected.clear()
+        self.results = []
+        self.points = {"play": [0.0, 0], "mute": [0.0, 0]}
+
+    def expect(self, pos, bar, beat, mute, spb):
+        self.expected.append((pos, bar, beat, mute, spb))
+
+    def match(self, onsets, latency=0):
+        out = []
+        for o in onsets:
+            o -= latency
+            best = min(self.expected, key=lambda e: abs(o - e[0]), default=None)
+            if best is None or abs(o - best[0]) > best[4] / 2: continue
+            self.expected.remove(best)
+            off_ms = (o - best[0]) / self.sr * 1000.0
+            pts = max(0.0, 1.0 - abs(off_ms) / self.tol)
+            acc = self.points["mute" if best[3] else "play"]; acc[0] += pts; acc[1] += 1
+            r = {"s": best[0], "bar": best[1], "beat": best[2], "mute": best[3], "off_ms": off_ms, "score": self.score()}
+            self.results.append(r); out.append(r)
+        return out
+
+    def score(self, which=None):
+        keys = [which] if which else ["play", "mute"]
+        pts, n = sum(self.points[k][0] for k in keys), sum(self.points[k][1] for k in keys)
+        return 100.0 * pts / n if n else 0.0
+
+def score_wav(path, bpm, bpb=4, play=0, mute=0, first_beat_s=0.0, latency_ms=0.0, block=128):
+    # 録音済み WAV をブロック単位で流して、ライブと同じ経路で採点する (オフライン検証用)
+    data, sr = read_wav_mmap(path)
+    x = data.mean(axis=1) if data.shape[1] > 1 else data[:, 0]
+    det, sc = OnsetDetector(sr), TimingScorer(sr)
+    spb = sr * 60.0 / bpm
+    n_beats = int((len(x) / sr - first_beat_s) / (60.0 / bpm)) + 1
+    for i in range(max(0, n_beats)):
+        bar, beat = divmod(i, bpb)
+        sc.expect(first_beat_s * sr + i * spb, bar + 1, beat + 1, bool(play and mute and bar % (play + mute) >= play), spb)
+    sc.expected = collections.deque(sc.expected, maxlen=None)
+    t0 = time.perf_counter()
+    for b in range(0, len(x), block):
+        sc.match(det.process(np.ascontiguousarray(x[b:b + block]), b), int(latency_ms * sr / 1000.0))
+    cost = (time.perf_counter() - t0) / (len(x) / sr)
+    return {"results": sc.results, "score": sc.score(), "play": sc.score("play"), "mute": sc.score("mute"), "load": cost}
+
+class LatencyCalibrator:
+    # ループバック (出力 -> ケーブル/マイク -> 入力) の往復レイテンシ測定。間隔を不規則にしたチャープ列を出し、
+    # 録音との相互相関 (FFT) で全体の遅れを出してから、チャープごとに局所相関で詰めてばらつきも見る
+    def __init__(self, sr, n_clicks=8, max_rt_s=0.5, seed=3):
+        rng = random.Random(seed)
+        L = int(0.01 * sr); t = np.arange(L) / sr
+        self.chirp = (np.sin(2 * np.pi * (1000.0 * t + 350000.0 * t * t)) * np.hanning(L) * 0.5).astype(np.float32) # 1k -> 8kHz / 10ms
+        self.starts, pos = [], int(0.2 * sr)
+        for _ in range(n_clicks):
+            self.starts.append(pos); pos += int(rng.uniform(0.2, 0.35) * sr)
+        self.sr, self.max_lag = sr, int(max_rt_s * sr)
+        self.ref = np.zeros(pos + self.max_lag, dtype=np.float32)
+        for p in self.starts: self.ref[p:p + L] = self.chirp
+        self.rec = np.zeros_like(self.ref)
+        self.pos = 0
+        self.duration = len(self.ref) / sr
+        self.reported = [] # (往復, 出力) の秒。ホストが time_info を出さなければ stream.latency
+        self.stream_latency = (0.0, 0.0)
+        self.done = threading.Event()
+
+    def callback(self, indata, outdata, frames, time_info, status):
+        outdata.fill(0)
+        n = max(0, min(frames, len(self.ref) - self.pos))
+        if n:
+            outdata[:n] = self.ref[self.pos:self.pos + n, None]
+            self.rec[self.pos:self.pos + n] = indata[:n, 0]
+        try:
+            rt = time_info.outputBufferDacTime - time_info.inputBufferAdcTime
+            out = time_info.outputBufferDacTime - time_info.currentTime
+            if 0.0 < rt < 1.0 and 0.0 < out < 1.0: self.reported.append((rt, out))
+        except AttributeError: pass
+        self.pos += frames
+        if self.pos >= len(self.ref): self.done.set()
+
+    def analyze(self):
+        n = 1 << int(math.ceil(math.log2(2 * len(self.ref))))
+        xc = np.fft.irfft(np.fft.rfft(self.rec, n) * np.conj(np.fft.rfft(self.ref, n)), n)[:self.max_lag]
+        a = np.abs(xc); lag = int(np.argmax(a))
+        snr = float(a[lag] / (np.median(a) + 1e-12))
+        if snr < 8.0: raise RuntimeError(f"no loopback signal (SNR {snr:.1f})")
+        # チャープごとの局所相関 + 放物線補間でサブサンプルまで
+        L, W, lags = len(self.chirp), 64, []
+        for p in self.starts:
+            a0 = p + lag - W
+            seg = self.rec[max(0, a0):a0 + 2 * W + L]
+            if len(seg) < 2 * W + L: continue
+            c = np.correlate(seg, self.chirp, 'valid'); k = int(np.argmax(np.abs(c)))
+            if 0 < k < len(c) - 1:
+                y0, y1, y2 = np.abs(c[k - 1:k + 2]); d = y0 - 2 * y1 + y2
+                k += 0.5 * (y0 - y2) / d if d else 0.0
+            lags.append(a0 + k - p)
+        lags = np.array(lags) if lags else np.array([float(lag)])
+        rt = float(np.median(lags)) / self.sr
+        if self.reported: rep_rt, rep_out = (float(np.median(x)) for x in zip(*self.reported))
+        else: rep_rt, rep_out = float(sum(self.stream_latency)), float(self.stream_latency[1])
+        # 報告値を超えた分 (変換器やドライバの見えない遅れ) は入出力で半分ずつと見なす
+        fix = (rt - rep_rt) / 2.0
+        return {"rt_ms": rt * 1000.0, "jitter_ms": float(np.std(lags)) / self.sr * 1000.0, "snr": snr, "clicks": len(lags),
+                "reported_rt_ms": rep_rt * 1000.0, "out_ms": (rep_out + fix) * 1000.0, "fix_ms": fix * 1000.0}
+
+def calibrate_offline(sr=48000, delay_s=0.0234, block=256, gain=0.3, noise=0.002, reported_rt_s=0.0):
+    # ストリームなしの自己検証: 出力を delay_s (>= 1 ブロック, 実機の往復も必ずそれ以上) 遅らせ、減衰とノイズを足して入力に戻す
+    cal = LatencyCalibrator(sr)
+    cal.stream_latency = (reported_rt_s / 2.0, reported_rt_s / 2.0)
+    d = max(block, int(round(delay_s * sr)))
+    hist = np.zeros(len(cal.ref) + block, dtype=np.float32)
+    rng = np.random.default_rng(0)
+    out = np.zeros((block, 2), dtype=np.float32)
+    while not cal.done.is_set():
+        p = cal.pos; idx = np.arange(p - d, p - d + block)
+        x = np.where(idx >= 0, hist[np.clip(idx, 0, len(hist) - 1)], 0.0)
+        indata = (x * gain + rng.normal(0.0, noise, block)).astype(np.float32)[:, None]
+        cal.callback(indata, out, block, None, None)
+        hist[p:p + block] = out[:len(hist) - p, 0]
+    return dict(cal.analyze(), true_ms=d / sr * 1000.0)
+
+class TimingProbe:
+    # 測定モード: ブロックごとの (開始サンプル, 長さ, コールバック到着 perf_counter, DAC 時刻) と
+    # 拍ごとの (実サンプル, 理想位置, ブロック内オフセット) を固定長リングに取り、誤差の種類ごとに分けて集計する
+    def __init__(self, sr, n=16384):
+        self.sr = sr
+        self.blocks = np.zeros((n, 4)); self.nb = 0
+        self.beats = np.zeros((n, 3)); self.ne = 0
+
+    def block(self, s, frames, t_cb, dac0):
+        self.blocks[self.nb % len(self.blocks)] = (s, frames, t_cb, dac0); self.nb += 1
+
+    def beat(self, s, ideal, off):
+        self.beats[self.ne % len(self.beats)] = (s, ideal, off); self.ne += 1
+
+    def _jitter(self, x, y):
+        # 理想時計 (サンプル位置 / sr) に一次式で合わせた残差 = ドリフトを除いた揺れ
+        r = (y - np.polyval(np.polyfit(x, y, 1), x)) * 1000.0
+        return {"std_ms": float(r.std()), "p99_ms": float(np.percentile(np.abs(r), 99)), "pkpk_ms": float(r.max() - r.min())}
+
+    def report(self):
+        b = self.blocks[:min(self.nb, len(self.blocks))]; e = self.beats[:min(self.ne, len(self.beats))]
+        rep = {"blocks": len(b), "beats": len(e)}
+        if len(e):
+            # スケジューリング誤差: 鳴らしたサンプルと理想 (小数) 位置の差。サンプル時計上の真の誤差
+            err = (e[:, 0] - e[:, 1]) / self.sr * 1000.0
+            rep["sched"] = {"max_ms": float(np.abs(err).max()), "rms_ms": float(np.sqrt((err ** 2).mean()))}
+            # ブロック量子化: コールバック時刻で打刻した場合に混ざるズレ (拍のブロック内位置)
+            q = e[:, 2] / self.sr * 1000.0
+            rep["quant"] = {"mean_ms": float(q.mean()), "max_ms": float(q.max())}
+        if len(b) > 2:
+            x = b[:, 0] / self.sr
+            rep["block_ms"] = float(b[:, 1].mean() / self.sr * 1000.0)
+            rep["arrival"] = self._jitter(x, b[:, 2])
+            if np.all(b[:, 3] > 0): rep["dac"] = self._jitter(x, b[:, 3])
+        return rep
+
+    def summary(self):
+        r = self.report()
+        parts = [f"{r['blocks']} blocks / {r['beats']} beats"]
+        if "sched" in r: parts.append(f"Sched err max {r['sched']['max_ms']:.4f}ms rms {r['sched']['rms_ms']:.4f}ms")
+        if "arrival" in r:
+            a = r["arrival"]
+            parts.append(f"CB arrival σ {a['std_ms']:.3f}ms p99 {a['p99_ms']:.3f}ms pk-pk {a['pkpk_ms']:.3f}ms ({a['pkpk_ms'] / r['block_ms'] * 100:.0f}% of {r['block_ms']:.2f}ms block)")
+        if "dac" in r: parts.append(f"DAC σ {r['dac']['std_ms']:.3f}ms")
+        if "quant" in r: parts.append(f"Block quantization mean {r['quant']['mean_ms']:.2f}ms max {r['quant']['max_ms']:.2f}ms")
+        return " | ".join(parts)
+
+# ==========================================
+#  Session Recording
+# ==========================================
+# 1 レコード = 固定長。kind 0: 拍イベント, 1: マイク採点 (off_ms)
+# ideal はスケジューラ上の理想位置 (小数サンプル) と sr、t_out はその拍の出力時刻 (DAC 時刻、取れなければ到着時刻 + 出力レイテンシ)
+SESSION_DTYPE = np.dtype([("ts", "<f8"), ("sample", "<i8"), ("ideal", "<f8"), ("t_out", "<f8"), ("pos", "<f8"), ("bpm", "<f4"),
+                          ("vis_err", "<f4"), ("off_ms", "<f4"), ("sr", "<u4"), ("bar", "<i4"), ("beat", "<i2"), ("bpb", "u1"),
+                          ("mute", "u1"), ("kind", "u1")])
+SESSION_MAGIC = b"IPSESS01"
+SESSION_HEADER = 16 # magic + record count
+
+class SessionRecorder:
+    def __init__(self, path, chunk=4096):
+        self.path, self.chunk = path, chunk
+        self.n, self.cap, self.mm = 0, 0, None
+        with open(path, 'wb') as f: f.write(SESSION_MAGIC + (0).to_bytes(8, 'little'))
+        self._grow()
+
+    def _grow(self):
+        # 容量を chunk 単位で伸ばして memmap を張り直す (append 自体は配列への代入だけ)
+        if self.mm is not None: self.mm.flush(); self.mm = None
+        self.cap += self.chunk
+        with open(self.path, 'r+b') as f: f.truncate(SESSION_HEADER + self.cap * SESSION_DTYPE.itemsize)
+        self.mm = np.memmap(self.path, dtype=SESSION_DTYPE, mode='r+', offset=SESSION_HEADER, shape=(self.cap,))
+
+    def append(self, kind, ts, sample, pos, bpm, bar, beat, bpb, mute, vis_err=0.0, off_ms=float("nan"), ideal=float("nan"), t_out=0.0, sr=0):
+        if self.n == self.cap: self._grow()
+        self.mm[self.n] = (ts, sample, ideal, t_out, pos, bpm, vis_err, off_ms, sr, bar, beat, bpb, mute, kind)
+        self.n += 1
+
+    def close(self):
+        if self.mm is None: return
+        self.mm.flush(); self.mm = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(SESSION_HEADER + self.n * SESSION_DTYPE.itemsize)
+            f.seek(len(SESSION_MAGIC)); f.write(self.n.to_bytes(8, 'little'))
+
+def load_session(path):
+    with open(path, 'rb') as f: head = f.read(SESSION_HEADER)
+    if head[:8] != SESSION_MAGIC: raise ValueError("not an InnerPulse session")
+    n = int.from_bytes(head[8:16], 'little')
+    cap = (os.path.getsize(path) - SESSION_HEADER) // SESSION_DTYPE.itemsize
+    if cap == 0: return np.zeros(0, dtype=SESSION_DTYPE)
+    arr = np.memmap(path, dtype=SESSION_DTYPE, mode='r', offset=SESSION_HEADER, shape=(cap,))
+    if n == 0: # 録音中に落ちたファイル: 末尾のゼロ埋めを落とす
+        nz = np.flatnonzero(arr["ts"])
+        n = int(nz[-1]) + 1 if len(nz) else 0
+    return arr[:n]
+
+def analyze_session(arr, window_s=10.0):
+    beats, hits = arr[arr["kind"] == 0], arr[arr["kind"] == 1]
+    rep = {"beats": len(beats), "hits": len(hits), "duration": 0.0, "jitter_ms": 0.0, "jitter_over_time": [], "mute_acc": {}}
+    if len(beats) > 1:
+        t = beats["ts"] - beats["ts"][0]
+        # 拍間隔の出力時刻の揺れ: 実際の出力時刻の差 - 理想サンプル間隔 (UI 側の受信時刻はブロック単位に量子化されるので使わない)
+        err = (np.diff(beats["t_out"]) - np.diff(beats["ideal"]) / np.maximum(beats["sr"][1:], 1)) * 1000.0
+        # 連続した拍だけ (再スタート跨ぎは除外)
+        err = err[np.diff(beats["pos"]) == 1]
+        rep["duration"] = float(t[-1])
+        if len(err):
+            rep["jitter_ms"] = float(err.std())
+            idx = (t[1:][:len(err)] // window_s).astype(np.int64)
+            cnt = np.bincount(idx)
+            s1, s2 = np.bincount(idx, err), np.bincount(idx, err * err)
+            ok = cnt > 1
+            rep["jitter_over_time"] = [(float(i * window_s), float(np.sqrt(max(0.0, s2[i] / cnt[i] - (s1[i] / cnt[i]) ** 2)))) for i in np.flatnonzero(ok)]
+    for name, sel in (("play", hits["mute"] == 0), ("mute", hits["mute"] == 1)):
+        off = hits["off_ms"][sel]
+        if len(off): rep["mute_acc"][name] = {"n": len(off), "mean_ms": float(off.mean()), "abs_ms": float(np.abs(off).mean()), "within_25ms": float((np.abs(off) <= 25).mean())}
+    return rep
+
+# ==========================================
+#  Training Plans
+# ==========================================
+PLAN_BARS = 256 # 事前生成する小節数 (超えたら先頭から繰り返す)
+RND_KEYS = ("rnd_seed", "rnd_play_min", "rnd_play_max", "rnd_mute_min", "rnd_mute_max")
+TRAINER_KEYS = ("bpm", "trainer", "trainer_step", "trainer_every", "trainer_max")
+COMPILE_KEYS = ("bpb", "sound", "v_acc", "v_backbeat", "v_4th", "v_8th", "v_16th", "v_trip", "voices", "groove", "layers")
+
+def make_random_plan(seed, play_min=1, play_max=2, mute_min=1, mute_max=2, n_bars=PLAN_BARS):
+    # シードから PLAY/MUTE の連続小節数を交互に引き、小節ごとの mute フラグ列にする
+    rng = random.Random(seed)
+    plan = []
+    while len(plan) < n_bars:
+        plan += [False] * rng.randint(play_min, max(play_min, play_max))
+        plan += [True] * rng.randint(mute_min, max(mute_min, mute_max))
+    return tuple(plan[:n_bars])
+
+def plan_runs(plan):
+    # (False, False, True, ...) -> ["P2", "M1", ...]
+    runs = []
+    for m in plan:
+        tag = "M" if m else "P"
+        if runs and runs[-1][0] == tag: runs[-1][1] += 1
+        else: runs.append([tag, 1])
+    return [f"{t}{n}" for t, n in runs]
+
+def make_tempo_plan(bpm, step, every, max_bpm):
+    # スピードトレーナー: every 小節ごとに step BPM 上げ、max_bpm で頭打ち。小節 -> BPM の表
+    # step と逆向きの目標 (上げるのに max_bpm < bpm など) は目標へ飛ばさず、今の BPM のまま
+    if step == 0 or every <= 0 or (max_bpm - bpm) * step <= 0: return (bpm,)
+    plan, b = [], bpm
+    while len(plan) < 10000:
+        plan += [b] * every
+        nb = min(max_bpm, b + step) if step > 0 else max(max_bpm, b + step)
+        if nb == b: break
+        b = nb
+    return tuple(plan) + (b,)
+
+# グルーヴテンプレート: swing (%: 50 = ストレート, 66.7 = 3 連) を swing_grid ("8th"/"16th") の裏に掛け、
+# offsets / velocity はボイス (ident) ごとに 1 拍内のスロット順の表 (offsets は 1/480 拍単位)、
+# humanize は bars 小節ぶんの揺らぎをシード付きで事前に引く。どれも小節の外へははみ出さない (小節頭の MUTE 判定を保つ)
+GROOVE_PPQ = 480
+GROOVE_DEFAULTS = {"name": "Straight", "swing": 50.0, "swing_grid": "8th", "offsets": {}, "velocity": {},
+                   "humanize": {"ticks": 0, "velocity": 0.0, "bars": 4, "seed": 1}}
+GROOVES = {
+    "Straight": {},
+    "Swing 8th 58%": {"swing": 58.0},
+    "Swing 8th 62%": {"swing": 62.0},
+    "Swing 8th 66% (triplet)": {"swing": 66.67},
+    "Swing 16th 54%": {"swing": 54.0, "swing_grid": "16th"},
+    "Swing 16th 58%": {"swing": 58.0, "swing_grid": "16th", "velocity": {"16th": [1.0, 0.75, 1.0, 0.75]}},
+    "Laid-back Backbeat": {"offsets": {"backbeat": [12]}, "velocity": {"8th": [1.0, 0.8]}},
+    "Pushed 8ths": {"offsets": {"8th": [0, -10]}},
+    "Humanize (light)": {"humanize": {"ticks": 6, "velocity": 0.08, "bars": 4, "seed": 1}},
+}
+
+def make_groove(t):
+    # テンプレート (dict / None) を既定値で埋めて検証済みの dict にする。不正値は例外
+    if not t: return None
+    g = dict(GROOVE_DEFAULTS, **{k: v for k, v in t.items() if k in GROOVE_DEFAULTS})
+    g["swing"] = min(75.0, max(25.0, float(g["swing"])))
+    if g["swing_grid"] not in ("8th", "16th"): raise ValueError(f"swing_grid: {g['swing_grid']}")
+    g["offsets"] = {str(k): tuple(float(x) for x in v) for k, v in g["offsets"].items()}
+    g["velocity"] = {str(k): tuple(max(0.0, float(x)) for x in v) for k, v in g["velocity"].items()}
+    g["humanize"] = dict(GROOVE_DEFAULTS["humanize"], **g["humanize"])
+    if g["swing"] == 50.0 and not g["offsets"] and not g["velocity"] and not (g["humanize"]["ticks"] or g["humanize"]["velocity"]): return None
+    return g
+
+def apply_groove(g, ident, step, accents, vol, bpb):
+    # ボイス 1 行 (step 拍おきの accents) にグルーヴを焼き込んで (offs, gains, cycle) を返す。
+    # _compile (パラメータ変更時) で 1 回だけ呼ばれ、_trigger は表を引くだけ
+    cycle = len(accents) * step
+    per = round(1.0 / step) if step < 1.0 and abs(1.0 / step - round(1.0 / step)) < 1e-9 else len(accents) # 表のスロット数
+    grid = 0.5 if g["swing_grid"] == "8th" else 0.25
+    dev, vel, hum = g["offsets"].get(ident, ()), g["velocity"].get(ident, ()), g["humanize"]
+    # 表を 1 小節 (humanize は bars 小節) ぶんに展開して、小節の外へは動かさない (MUTE 判定は小節頭のクロックで決まる)
+    humanize = bool(hum["ticks"] or hum["velocity"])
+    n = (hum["bars"] if humanize else 1) * bpb / cycle
+    reps = int(round(n)) if n >= 1 and abs(n - round(n)) < 1e-9 else 1
+    humanize = humanize and abs(cycle * reps - hum["bars"] * bpb) < 1e-9
+    bar_aligned = abs(cycle * reps / bpb - round(cycle * reps / bpb)) < 1e-9
+    rng = random.Random(f"{hum['seed']}:{ident}")
+    out = []
+    for r in range(reps):
+        for k, a in enumerate(accents):
+            if a <= 0: continue
+            pos = (r * len(accents) + k) * step; beat = math.floor(pos + 1e-9); x = pos - beat; gain = a * vol
+            # swing: 2 グリッドを 1 組として組の中を折れ線で伸縮する (裏拍 grid → 組の swing% の位置)。
+            # 細かいボイス (8th swing の 16th など) も順序を保ったまま一緒に動く
+            pair = math.floor(x / (2 * grid) + 1e-9); u = (x - pair * 2 * grid) / (2 * grid); s = g["swing"] / 100.0
+            u = u * 2 * s if u < 0.5 else s + (u - 0.5) * (1 - s) * 2
+            x = (pair + u) * 2 * grid
+            if dev: x += dev[k % per % len(dev)] / GROOVE_PPQ
+            if vel: gain *= vel[k % per % len(vel)]
+            if humanize:
+                x += rng.randint(-hum["ticks"], hum["ticks"]) / GROOVE_PPQ
+                gain *= 1.0 + rng.uniform(-hum["velocity"], hum["velocity"])
+            lo = math.floor(pos / bpb + 1e-9) * bpb if bar_aligned else beat
+            hi = lo + bpb if bar_aligned else beat + 1
+            if gain > 0: out.append((min(max(beat + x, lo), hi - 1e-6), gain))
+    out.sort()
+    return tuple(o for o, _ in out), tuple(v for _, v in out), cycle * reps
+
 # ==========================================
 #  Audio Engine
 # ==========================================
@@ -166,36 +802,175 @@ class AudioEngine:
         self.device_index = None
         self.buffer_size = 128
         self.waves = {}
-        self.params = {
+        self.noise_seed = None # 波形のノイズ成分のシード (None = 毎回ランダム)。ゴールデン比較では固定する
+        self._rng = np.random.default_rng()
+        self.kit = {}
+        self._kit_cache = {}
+        self._layer_id = 0 # レイヤーの安定 ID (削除/無効化で並びがずれても状態を取り違えない)。メインは 0
+        params = {
             "bpm": 120, "bpb": 4, "play": 3, "mute": 1,
             "v_master": 0.8, "v_acc": 0.8, "v_backbeat": 0.0, "v_4th": 0.5, "v_8th": 0.0,
             "v_16th": 0.0, "v_trip": 0.0, "v_mute_dim": 0.0,
             "rnd": False, "force_play": False, "tone_mode": "electronic",
-            "rnd_play_min": 1, "rnd_play_max": 2, "rnd_mute_min": 1, "rnd_mute_max": 2
+            "rnd_play_min": 1, "rnd_play_max": 2, "rnd_mute_min": 1, "rnd_mute_max": 2, "rnd_seed": 1,
+            "trainer": False, "trainer_step": 4, "trainer_every": 4, "trainer_max": 200,
+            "voices": (), "layers": (),
+            "count_in": 0, "cue_bars": False, "cue_sections": True, "v_cue": 1.0, "sections": (),
+            "groove": None
         }
-        self.mute_options = {
+        self._derive(params, set(params))
+        mute_options = {
             "acc": False, "backbeat": False, "4th": False,
             "8th": False, "16th": False, "trip": False
         }
-        self.state = {"total_samples": 0, "next_tick": 0, "tick_count": 0, "is_mute": False, "active_voices": [], "zero_offset": 0, "rnd_phase": "play", "rnd_left": 3}
+        # UI スレッドとコールバックの受け渡しは不変スナップショット (version, params, mute_options, at_sample)
+        # を参照 1 回の代入で公開する。コールバックはブロック頭 (または at_sample) で 1 回だけ取り込む
+        self._pub_lock = threading.Lock()
+        self._pending = (0, MappingProxyType(params), MappingProxyType(mute_options), None)
+        self._live = self._pending
+        self.params, self.mute_options = self._pending[1], self._pending[2]
+        self.gain_ramp_s = 0.03 # v_master smoothing time (0 = off)
+        self.n_channels = 2
+        self.routing = {}
+        self.route_matrix = None
+        self._bus = np.zeros((len(BUS_NAMES), 0), dtype=np.float32)
+        self._gain = params["v_master"]
+        # Master stage: バス (ボイス) ごとのヘッドルーム (dB, ルーティング行列の行に畳み込む) とソフトリミッタ。
+        # 作業バッファはブロック長が伸びたときだけ確保し、コールバック内では out= で使い回す
+        self.headroom_db = {}
+        self.limiter = True
+        self.limit_threshold = 0.8 # これを超えた分だけ tanh で 1.0 に漸近させる
+        self._scratch = np.zeros(0, dtype=np.float32)
+        self._lim = np.zeros((0, 0), dtype=np.float32)
+        self._ramp = np.zeros(0, dtype=np.float32)
+        self.meter = {"peak": 0.0, "rms": 0.0, "gr": 0.0}
+        self.state = {"total_samples": 0, "layers": [], "heap": [], "table": [], "active_voices": [], "zero_offset": 0, "block_s": 0}
         self.queue = queue.Queue()
         self.current_device_name = "None"
         self.last_sent_pos = 0.0
+        self.out_latency = 0.0 # 直近ブロックの 先頭サンプル -> DAC の秒数 (time_info か stream.latency から)
+        self.probe = None # TimingProbe (測定モード中のみ)
+        self.track = None # TrackStream (曲のバッキングトラック)
+        self.track_spec = None # (path, gain, offset_s) — SR が変わったら開き直す
+        # アイドル: 停止中はストリームを止めて (デバイスは開いたまま) コールバックの起床をなくす。START で start() し直す
+        self.parked = False
+        self.cb_count = 0 # コールバック回数 (起床/秒の計測用)
+        self.start_req_t = 0.0
+        self.start_wait = 0.0 # 0 以外: トラックのプリフェッチ待ち (この perf_counter 時刻までで打ち切り)。poll_start が開始する
+        self.resume_ms = 0.0
+        self.cues = None # CueLibrary
+        self.cue_spec = None # (root, lang, max_bytes)
+        self.ci_beats, self.ci_s = 0, 0.0 # 今回のカウントイン (拍数 / 秒)
+        self.midi_clock = None # MidiClock (MIDI クロック出力)
+        # Listen mode: duplex stream + onset scoring (detector/scorer live in the callback thread)
+        self.listen = False
+        self.detector = None
+        self.scorer = None
+        self.listen_load = 0.0
+        self.listen_offset_ms = 0.0
+        self.lat_fix_s = 0.0 # ループバック校正で分かった報告値とのずれ (出力側, 秒)。表示/テレメトリ/採点の時刻に足す
+        self.set_routing({})
+
+    def update(self, key, val, at_sample=None): self.publish({key: val}, at_sample=at_sample)
+
+    def set_mute_options(self, opts): self.publish(mute_options=opts)
+
+    def publish(self, params=None, mute_options=None, at_sample=None):
+        with self._pub_lock:
+            p = dict(self.params); p.update(params or {})
+            self._derive(p, set(params or ()))
+            m = dict(self.mute_options); m.update(mute_options or {})
+            snap = (self._pending[0] + 1, MappingProxyType(p), MappingProxyType(m), at_sample)
+            self.params, self.mute_options = snap[1], snap[2]
+            self._pending = snap
+        return snap[0]
 
-    def update(self, key, val): self.params[key] = val
+    def _derive(self, p, changed):
+        # ランダム練習の小節表とトレーナーのテンポ表は公開時 (UI スレッド) に作っておき、コールバックでは引くだけにする
+        if changed & set(RND_KEYS) or "rnd_plan" not in p:
+            p["rnd_plan"] = make_random_plan(p["rnd_seed"], p["rnd_play_min"], p["rnd_play_max"], p["rnd_mute_min"], p["rnd_mute_max"])
+        if changed & set(TRAINER_KEYS) or "tempo_plan" not in p:
+            p["tempo_plan"] = make_tempo_plan(p["bpm"], p["trainer_step"], p["trainer_every"], p["trainer_max"]) if p["trainer"] else (p["bpm"],)
+        if "groove" in changed: p["groove"] = make_groove(p["groove"])
+        if "layers" in changed:
+            p["layers"] = tuple(dict(l, rnd_plan=make_random_plan(l.get("rnd_seed", 1), l.get("rnd_play_min", 1), l.get("rnd_play_max", 2),
+                                                                  l.get("rnd_mute_min", 1), l.get("rnd_mute_max", 2))) if l.get("rnd") else l
+                                for l in p["layers"])
+            p["layers"] = tuple(dict(l, groove=make_groove(l["groove"])) if l.get("groove") else l for l in p["layers"])
+            self._layer_id = max([self._layer_id] + [l.get("id", 0) for l in p["layers"]])
+            layers, seen = [], set()
+            for l in p["layers"]:
+                if not l.get("id") or l["id"] in seen:
+                    self._layer_id += 1; l = dict(l, id=self._layer_id)
+                seen.add(l["id"]); layers.append(l)
+            p["layers"] = tuple(layers)
+        if changed & set(COMPILE_KEYS) or "compiled" not in p:
+            # ボイス表 (グルーヴ込み) もここで組んでおき、コールバックの _reschedule は差し替えてヒープ位置を引き直すだけにする
+            sub = tuple(MappingProxyType({**LAYER_DEFAULTS, **l}) for l in p["layers"] if l.get("enabled", True))
+            table = self._compile(p)
+            for li, lp in enumerate(sub, 1): table += self._compile(lp, li)
+            p["compiled"] = (sub, tuple(table))
 
     def set_tone_mode(self, mode):
-        self.params["tone_mode"] = mode
-        # Regenerate waves with new tone mode
+        self.update("tone_mode", mode)
+        # Regenerate waves with new tone mode (起動前は boot/open_offline がまとめて作る)
+        if self.waves: self.waves = self._build_waves()
+
+    def _build_waves(self):
         tone_mode = self.params.get("tone_mode", "electronic")
-        self.waves = {
-            "acc": self._make_wave("bell", 2000, mode=tone_mode),
-            "backbeat": self._make_wave("snare", duration=0.15, mode=tone_mode),
-            "4th": self._make_wave("click", 800, mode=tone_mode),
-            "8th": self._make_wave("hihat", mode=tone_mode),
-            "16th": self._make_wave("shaker", mode=tone_mode),
-            "trip": self._make_wave("wood", mode=tone_mode)
-        }
+        self._rng = np.random.default_rng(self.noise_seed)
+        waves = {voice: self._make_wave(*spec, mode=tone_mode) for voice, spec in SYNTH_WAVES.items()}
+        for voice, path in self.kit.items():
+            if not path: continue
+            try: waves[voice] = self._load_sample(path)
+            except Exception as e: self.queue.put({"type": "log", "msg": f"[KIT] {voice}: {str(e)[:40]}"})
+        return waves
+
+    # --- Sample Kit ---
+    def _load_sample(self, path):
+        key = (os.path.abspath(path), os.path.getmtime(path), self.sr)
+        wav = self._kit_cache.pop(key, None)
+        if wav is None:
+            data, src_sr = read_wav_mmap(path)
+            mono = data.mean(axis=1) if data.shape[1] > 1 else data[:, 0]
+            wav = resample(mono, src_sr, self.sr)
+            # 同じファイルの古い版 (mtime/SR 違い) は二度と引かれないので捨てる
+            for k in [k for k in self._kit_cache if k[0] == key[0]]: del self._kit_cache[k]
+        self._kit_cache[key] = wav # 末尾 = 最近使った順
+        while len(self._kit_cache) > KIT_CACHE_MAX: del self._kit_cache[next(iter(self._kit_cache))]
+        return wav
+
+    def set_kit_sample(self, voice, path):
+        # Hot-swap: build the new table aside and publish it with one reference swap,
+        # so the callback never sees a half-updated kit and the stream keeps running.
+        waves = dict(self.waves)
+        if path:
+            waves[voice] = self._load_sample(path)
+            self.kit[voice] = path
+        else:
+            self.kit.pop(voice, None)
+            waves[voice] = self._make_wave(*SYNTH_WAVES[voice], mode=self.params.get("tone_mode", "electronic"))
+        self.waves = waves
+
+    # --- Output Routing ---
+    def set_routing(self, routing):
+        # bus -> {"ch": [0-based channels], "gain", "pan"} を (n_bus, n_ch) の行列にして参照 1 回で差し替える
+        self.routing = {k: dict(v) for k, v in routing.items() if k in BUS_INDEX}
+        n_ch = self.n_channels
+        R = np.zeros((len(BUS_NAMES), n_ch), dtype=np.float32)
+        for name, i in BUS_INDEX.items():
+            r = self.routing.get(name, BUS_DEFAULT_ROUTING.get(name, {}))
+            chs = [c for c in r.get("ch", [0, 1]) if 0 <= c < n_ch] or [0]
+            gain, pan = float(r.get("gain", 1.0)), max(-1.0, min(1.0, float(r.get("pan", 0.0))))
+            if len(chs) == 2:
+                # 定パワーパン。センターで 1.0/1.0 (従来のモノ→全ch と同じ音量)
+                a = (pan + 1.0) * math.pi / 4
+                R[i, chs[0]] += gain * math.cos(a) * math.sqrt(2)
+                R[i, chs[1]] += gain * math.sin(a) * math.sqrt(2)
+            else:
+                R[i, chs] += gain
+        for name, db in self.headroom_db.items(): R[BUS_INDEX[name]] *= 10.0 ** (db / 20.0)
+        self.route_matrix = R
 
     def get_filtered_devices(self):
         try:
@@ -223,24 +998,24 @@ class AudioEngine:
                 # Accent: louder pendulum click with slight metallic ring
                 wave = np.sin(2 * np.pi * 600 * t) * np.exp(-t * 100) * 0.6
                 wave += np.sin(2 * np.pi * 1200 * t) * np.exp(-t * 150) * 0.3
-                wave += np.random.uniform(-0.05, 0.05, length) * np.exp(-t * 200) * 0.1
+                wave += self._rng.uniform(-0.05, 0.05, length) * np.exp(-t * 200) * 0.1
             elif type == "click":
                 # Quarter notes: standard pendulum click
                 wave = np.sin(2 * np.pi * 500 * t) * np.exp(-t * 110) * 0.5
                 wave += np.sin(2 * np.pi * 1000 * t) * np.exp(-t * 160) * 0.2
             elif type == "hihat":
                 # 8th notes: use electronic sound
-                wave = np.random.uniform(-0.9, 0.9, length) * np.exp(-t * 80) * 0.9
+                wave = self._rng.uniform(-0.9, 0.9, length) * np.exp(-t * 80) * 0.9
             elif type == "shaker":
                 # 16th notes: use electronic sound
-                wave = np.random.uniform(-0.8, 0.8, length) * np.exp(-t * 50) * 0.8
+                wave = self._rng.uniform(-0.8, 0.8, length) * np.exp(-t * 50) * 0.8
             elif type == "wood":
                 # Triplets: subtle click
                 wave = np.sin(2 * np.pi * 580 * t) * np.exp(-t * 125) * 0.38
                 wave += np.sin(2 * np.pi * 1150 * t) * np.exp(-t * 175) * 0.14
             elif type == "snare":
                 # Backbeat: use electronic sound
-                noise = np.random.uniform(-1.0, 1.0, length) * np.exp(-t * 30)
+                noise = self._rng.uniform(-1.0, 1.0, length) * np.exp(-t * 30)
                 tone = np.sin(2 * np.pi * 180 * t) * np.exp(-t * 15) * 0.5
                 wave = (noise + tone) * 0.8
             else:
@@ -249,17 +1024,69 @@ class AudioEngine:
             # Original electronic sounds
             if type == "bell": wave = (np.sin(2 * np.pi * freq * t) + 0.5 * np.sin(2 * np.pi * freq * 2 * t)) * np.exp(-t * 8) * 0.3
             elif type == "click": wave = np.tanh(np.sin(2 * np.pi * freq * t) * 5) * np.exp(-t * 20) * 0.5
-            elif type == "hihat": wave = np.random.uniform(-0.9, 0.9, length) * np.exp(-t * 80) * 0.9
-            elif type == "shaker": wave = np.random.uniform(-0.8, 0.8, length) * np.exp(-t * 50) * 0.8
+            elif type == "hihat": wave = self._rng.uniform(-0.9, 0.9, length) * np.exp(-t * 80) * 0.9
+            elif type == "shaker": wave = self._rng.uniform(-0.8, 0.8, length) * np.exp(-t * 50) * 0.8
             elif type == "wood": wave = np.sin(np.cumsum(np.linspace(freq, freq/2, length)) / self.sr * 2 * np.pi) * np.exp(-t * 30) * 0.6
             elif type == "snare":
-                noise = np.random.uniform(-1.0, 1.0, length) * np.exp(-t * 30)
+                noise = self._rng.uniform(-1.0, 1.0, length) * np.exp(-t * 30)
                 tone = np.sin(2 * np.pi * 180 * t) * np.exp(-t * 15) * 0.5
                 wave = (noise + tone) * 0.8
             else: wave = np.zeros(length)
 
         return wave.astype(np.float32)
 
+    def open_offline(self, sr=48000, channels=2):
+        # ストリームを開かずにレンダリングする (ヘッドレスサーバ / オフライン検証用)。_cb を直接呼ぶ
+        self.sr, self.n_channels = sr, channels
+        self.waves = self._build_waves()
+        self.set_routing(self.routing)
+        self._open_track()
+        self._open_cues()
+        self.state["total_samples"] = 0
+
+    def set_midi_clock(self, port):
+        # port = "" で停止。開けなければ None のまま (ログに理由)
+        old, self.midi_clock = self.midi_clock, None
+        if old: old.close()
+        if not port: return None
+        try: self.midi_clock = MidiClock(port)
+        except Exception as e: self.queue.put({"type": "log", "msg": f"[MIDI] {port}: {str(e)[:60]}"})
+        return self.midi_clock
+
+    def set_cues(self, root, lang="", max_mb=32):
+        self.cue_spec = (root, lang, int(max_mb) << 20) if root else None
+        return self._open_cues()
+
+    def _open_cues(self):
+        if not self.cue_spec: self.cues = None; return None
+        root, lang, max_bytes = self.cue_spec
+        self.cues = CueLibrary(root, self.sr, lang, max_bytes)
+        return self.cues
+
+    def prefetch_cues(self, bar=0):
+        # UI スレッドから: これから鳴らしうる語を先にデコードしておく (bar は 0 始まりの現在小節)
+        if not self.cues: return
+        p, words = self.params, []
+        if p["count_in"] and bar == 0:
+            words += [w for k in range(p["count_in"]) for w in count_in_words(p["bpb"], k == p["count_in"] - 1)]
+        if p["cue_bars"]: words += [str(b) for b in range(bar + 1, bar + 5)]
+        if p["cue_sections"]: words += [name for b, name in p["sections"] if b > bar]
+        self.cues.prefetch(words)
+
+    def set_track(self, path, gain=1.0, offset_s=0.0):
+        self.track_spec = (path, gain, offset_s) if path else None
+        return self._open_track()
+
+    def _open_track(self):
+        old, self.track = self.track, None
+        if old: old.close()
+        if not self.track_spec: return None
+        path, gain, offset_s = self.track_spec
+        try: self.track = TrackStream(path, self.sr, gain, offset_s)
+        except Exception as e:
+            self.queue.put({"type": "log", "msg": f"[TRACK] {os.path.basename(path)}: {str(e)[:40]}"})
+        return self.track
+
     def boot(self):
         try:
             if self.stream:
@@ -268,107 +1095,791 @@ class AudioEngine:
             dev_info = sd.query_devices(self.device_index, 'output')
             self.sr = int(dev_info.get('default_samplerate', 48000))
             self.current_device_name = dev_info['name']
-            tone_mode = self.params.get("tone_mode", "electronic")
-            self.waves = {
-                "acc": self._make_wave("bell", 2000, mode=tone_mode),
-                "backbeat": self._make_wave("snare", duration=0.15, mode=tone_mode),
-                "4th": self._make_wave("click", 800, mode=tone_mode),
-                "8th": self._make_wave("hihat", mode=tone_mode),
-                "16th": self._make_wave("shaker", mode=tone_mode),
-                "trip": self._make_wave("wood", mode=tone_mode)
-            }
-            n_channels = min(2, int(dev_info['max_output_channels']))
-            self.stream = sd.OutputStream(
-                device=self.device_index, channels=n_channels, callback=self._cb, latency='low',
-                blocksize=self.buffer_size, samplerate=self.sr
-            )
-            self.stream.start()
+            self.waves = self._build_waves()
+            n_channels = self.n_channels = int(dev_info['max_output_channels'])
+            self.set_routing(self.routing)
+            if self.track_spec and (not self.track or self.track.sr != self.sr): self._open_track()
+            if self.cue_spec and (not self.cues or self.cues.sr != self.sr): self._open_cues()
+            if self.listen:
+                self.detector, self.scorer = OnsetDetector(self.sr), TimingScorer(self.sr)
+                self.stream = sd.Stream(
+                    device=(None, self.device_index), channels=(1, n_channels), callback=self._duplex_cb, latency='low',
+                    blocksize=self.buffer_size, samplerate=self.sr
+                )
+            else:
+                self.detector = self.scorer = None
+                self.stream = sd.OutputStream(
+                    device=self.device_index, channels=n_channels, callback=self._cb, latency='low',
+                    blocksize=self.buffer_size, samplerate=self.sr
+                )
+            self.stream.start(); self.parked = False
             self.state["total_samples"] = 0
-            return f"{dev_info['name']} ({self.sr}Hz / {n_channels}ch / Buf:{self.buffer_size})"
+            return f"{dev_info['name']} ({self.sr}Hz / {n_channels}ch / Buf:{self.buffer_size}{' / MIC' if self.listen else ''})"
         except Exception as e: return f"Error: {str(e)[:15]}"
 
-    def request_start(self):
+    def boot_async(self, device_name=""):
+        # 起動時のデバイス列挙とストリーム起動を別スレッドで回す (UI は描画/入力を続ける)。
+        # 結果は {"type": "boot"} で queue に返る。見つからなければ先頭のデバイス (なければ既定) で開く
+        def run():
+            devs = self.get_filtered_devices(); t_dev = time.perf_counter()
+            self.device_index = next((i for i, n in devs if n == device_name), devs[0][0] if devs else None)
+            self.queue.put({"type": "boot", "devices": devs, "t_devices": t_dev, "msg": self.boot()})
+        threading.Thread(target=run, daemon=True).start()
+
+    def start_calibration(self):
+        # 本ストリームを閉じ、同じデバイス/バッファの duplex ストリームで LatencyCalibrator を回す (別スレッド)。
+        # 結果は {"type": "cal"} で queue に返る。UI は受け取ったら boot し直す
+        if self.is_playing or self.pending_start or self.start_wait: return False
+        res = {"type": "cal", "device": self.current_device_name, "buffer": self.buffer_size}
+        def run():
+            try:
+                if self.stream: self.stream.stop(); self.stream.close(); self.stream = None
+                cal = LatencyCalibrator(self.sr)
+                with sd.Stream(device=(None, self.device_index), channels=(1, self.n_channels), callback=cal.callback, latency='low',
+                               blocksize=self.buffer_size, samplerate=self.sr) as stream:
+                    cal.stream_latency = tuple(stream.latency)
+                    if not cal.done.wait(cal.duration + 3.0): raise RuntimeError("stream timeout")
+                res.update(cal.analyze())
+            except Exception as e: res["error"] = str(e)[:60]
+            self.queue.put(res)
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+    def park(self):
+        if self.parked or not self.stream or self.is_playing: return False
+        try: self.stream.stop()
+        except Exception: return False
+        self.parked = True
+        if self.midi_clock: self.midi_clock.stop() # 止めたストリームの先で受け手が走り続けないように
+        return True
+
+    def unpark(self):
+        if not self.parked: return
+        t0 = time.perf_counter()
+        self.stream.start(); self.parked = False
+        self.resume_ms = (time.perf_counter() - t0) * 1000.0
+
+    def request_start(self, wait=True):
+        # wait=False (UI): トラックの頭出しを待たずに戻り、poll_start がリングが埋まってから開始する
+        self.start_req_t = time.perf_counter(); self.resume_ms = 0.0
         while not self.queue.empty():
             try: self.queue.get_nowait()
             except: break
+        p = self.params
+        self.ci_beats = p["count_in"] * p["bpb"]; self.ci_s = self.ci_beats * 60.0 / self._bar_bpm(p, 0)
+        self.prefetch_cues(0)
+        if self.track:
+            # 小節 1 の頭と同じサンプルから鳴らすため、頭出しとプリフェッチを済ませてから開始する (カウントイン分は頭に無音)
+            self.track.rewind(-self.ci_s * self.sr)
+            if not wait: self.start_wait = time.perf_counter() + 0.5; return
+            self.track.wait_ready()
+        self._begin()
+
+    def poll_start(self):
+        if not self.start_wait: return
+        if self.track and not self.track.ready() and time.perf_counter() < self.start_wait: return
+        self.start_wait = 0.0
+        self._begin()
+
+    def _begin(self):
+        if self.track: self.track.underruns = 0
         self.pending_start = True
+        self.unpark()
 
     def pause(self):
-        self.is_playing = False; self.pending_start = False
+        self.is_playing = False; self.pending_start = False; self.start_wait = 0.0
+        if self.midi_clock: self.midi_clock.stop()
         self.queue.put({"type": "vis", "pos": -1.0, "mute": False})
 
+    # --- Scheduler ---
+    # 共通の tick グリッドは持たず、ボイスごとの発音イベント列をサンプル時刻でマージする (heapq)。
+    # ボイス表: (ident, wave, offs, gains, cycle, layer) — offs/gains は 1 サイクル内で実際に鳴る位置だけ、cycle は拍数。
+    # レイヤー (独立した BPM/拍子/PLAY-MUTE) も同じヒープに載せるので、コストはレイヤー数ではなくイベント数に比例する
+    def _compile(self, p, li=0):
+        bpb = p["bpb"]; snd = p.get("sound") or None
+        specs = [
+            ("acc", snd or "acc", p["v_acc"], 1, bpb, [1.0]),
+            ("backbeat", "backbeat", p["v_backbeat"], 1, 1, [1.0 if b in (1, 3) else 0.0 for b in range(bpb)]),
+            ("4th", snd or "4th", p["v_4th"], 1, 1, [0.0] + [1.0] * (bpb - 1)),
+            ("8th", "8th", p["v_8th"], 2, 1, [0.0, 1.0]),
+            ("16th", "16th", p["v_16th"], 4, 1, [0.0, 1.0, 0.0, 1.0]),
+            ("trip", "trip", p["v_trip"], 3, 1, [0.0, 1.0, 1.0]),
+        ]
+        for n, v in enumerate(p.get("voices", ())):
+            specs.append((f"v{n}", v["wave"], v.get("vol", 0.5), v["hits"], v["beats"], v.get("accents") or [1.0] * v["hits"]))
+        table = [("clock", None, (0.0,), (1.0,), 1.0, li)]
+        groove = p.get("groove")
+        for ident, wave, vol, hits, beats, accents in specs:
+            if vol <= 0 or hits <= 0 or beats <= 0: continue
+            step = beats / hits
+            if groove:
+                offs, gains, cycle = apply_groove(groove, ident, step, accents, vol, bpb)
+                if offs: table.append((ident, wave, offs, gains, cycle, li))
+                continue
+            offs = tuple(k * step for k, g in enumerate(accents) if g > 0)
+            if not offs: continue
+            table.append((ident, wave, offs, tuple(g * vol for g in accents if g > 0), len(accents) * step, li))
+        return table
+
+    def _reschedule(self, p, at_s, ci_s=0.0):
+        # テンポ/ボイス変更時: at_s の拍位置でレイヤーごとに再アンカーし、次に鳴るイベントだけをヒープに積み直す
+        # 新しく作るレイヤーは ci_s 秒のカウントイン分だけ手前 (負の拍位置) から始める。
+        # 状態と待ちイベントはレイヤー ID で引き継ぐ (表の li は今回の並び順の添字)。表は _derive が組んだものを使う
+        st = self.state
+        sub, table = p["compiled"]
+        lps = (p,) + sub
+        keep = {}
+        for _, _, vid, j in st["heap"]:
+            v = st["table"][vid]
+            keep[(st["layers"][v[5]]["id"], v[0], v[2], v[4])] = j
+        old = {ls["id"]: ls for ls in st["layers"]}
+        layers, rebar = [], set()
+        for li, lp in enumerate(lps):
+            lid = lp.get("id", 0) if li else 0
+            ls = old.get(lid) or {"id": lid, "anchor": (at_s, -ci_s * self._bar_bpm(lp, 0) / 60.0, 1.0), "is_mute": False}
+            layers.append(ls)
+            a_s, a_b, spb = ls["anchor"]
+            b_now = a_b + (at_s - a_s) / spb
+            if "p" in ls and ls["p"]["bpb"] != lp["bpb"]:
+                # 拍子変更: 拍位置を新しい拍子の小節頭に合わせ直す (待ちイベントは引き継がず引き直す)
+                b_now = self._rebar(b_now, ls["p"]["bpb"], lp["bpb"]); rebar.add(li)
+            ls["anchor"] = (at_s, b_now, self.sr * 60.0 / self._bar_bpm(lp, int(b_now // lp["bpb"]))); ls["p"] = lp
+        heap = []
+        for vid, (ident, wave, offs, gains, cycle, li) in enumerate(table):
+            _, b_now, spb = layers[li]["anchor"]
+            j = None if li in rebar else keep.get((layers[li]["id"], ident, offs, cycle))
+            if j is None:
+                c = math.floor(b_now / cycle + 1e-9); m = len(offs)
+                j = c * m + next((k for k, o in enumerate(offs) if c * cycle + o >= b_now - 1e-9), m)
+            c, k = divmod(j, len(offs))
+            heap.append((at_s + (c * cycle + offs[k] - b_now) * spb, 0 if wave is None else 1, vid, j))
+        heapq.heapify(heap)
+        st["layers"], st["table"], st["heap"] = layers, table, heap
+
+    def _rebar(self, b, old_bpb, new_bpb):
+        # 拍子を old_bpb -> new_bpb に変えたときの新しい拍位置。小節頭ならその小節から新拍子、
+        # 小節の途中なら今の小節を弾き切ったところ (収まらなければ次の拍) を次の小節頭にする
+        bar = math.floor(b / old_bpb + 1e-9); x = b - bar * old_bpb
+        if x < 1e-9: return bar * new_bpb
+        rest = old_bpb - x
+        if rest > new_bpb: rest = math.ceil(b - 1e-9) - b
+        return (bar + 1) * new_bpb - rest
+
+    def _bar_bpm(self, p, bar):
+        plan = p.get("tempo_plan") or (p["bpm"],)
+        return plan[min(max(bar, 0), len(plan) - 1)]
+
+    def _retime(self, li, at_s, bpm):
+        # レイヤー li だけテンポを変える: at_s で再アンカーし、そのレイヤーの待ちイベント位置を引き直す
+        st = self.state; ls = st["layers"][li]
+        a_s, a_b, spb = ls["anchor"]
+        a_b += (at_s - a_s) / spb; spb = self.sr * 60.0 / bpm
+        ls["anchor"] = (at_s, a_b, spb)
+        heap, table = st["heap"], st["table"]
+        for n, (pos, prio, vid, j) in enumerate(heap):
+            v = table[vid]
+            if v[5] != li: continue
+            c, k = divmod(j, len(v[2]))
+            heap[n] = (at_s + (c * v[4] + v[2][k] - a_b) * spb, prio, vid, j)
+        heapq.heapify(heap)
+
     def _cb(self, outdata, frames, time_info, status):
         outdata.fill(0); st = self.state; start_s = st["total_samples"]; st["total_samples"] += frames
+        self.cb_count += 1
+        snap = self._pending
+        if snap is not self._live and (snap[3] is None or snap[3] <= start_s):
+            self._live = snap
+            if self.is_playing: self._reschedule(snap[1], start_s)
         if self.pending_start:
-            st["zero_offset"] = start_s; st["next_tick"] = start_s; st["tick_count"] = 0; st["active_voices"] = []; self.is_playing = True; self.pending_start = False
+            st["zero_offset"] = start_s; st["active_voices"] = []; st["heap"] = []
+            if self.scorer: self.scorer.reset(); self.detector.reset()
+            st["layers"] = []
+            self._reschedule(self._live[1], start_s, self.ci_s)
+            if self.midi_clock: self.midi_clock.start()
+            self.is_playing = True; self.pending_start = False
+            if self.start_req_t:
+                # START 押下から最初の拍を書くブロックまで (アイドルからの復帰時間を含む)
+                self.queue.put({"type": "log", "msg": f"[START] first block +{(time.perf_counter() - self.start_req_t) * 1000:.1f}ms"
+                                                      + (f" (resume {self.resume_ms:.1f}ms)" if self.resume_ms else ""), "first_block": time.perf_counter()})
+                self.start_req_t = 0.0
         if not self.is_playing: return
-        end_s = start_s + frames
-        while st["next_tick"] < end_s:
-            off = int(st["next_tick"] - start_s)
-            if 0 <= off < frames: self._trigger(off)
-            st["next_tick"] += (self.sr * 60.0 / self.params["bpm"]) / 12.0; st["tick_count"] += 1
+        end_s = start_s + frames; waves = self.waves; heap = st["heap"]; st["block_s"] = start_s
+        # このブロックの到着時刻と DAC 時刻。拍イベントはここから自分のサンプルの発音時刻を出す
+        st["cb_t"] = time.perf_counter(); st["lat"] = lat = self._out_latency(time_info)
+        try: st["dac0"] = time_info.outputBufferDacTime
+        except AttributeError: st["dac0"] = 0.0
+        if self.probe: self.probe.block(start_s, frames, st["cb_t"], st["dac0"])
+        # 位置は小数サンプル。3 連などの割り切れない位置が丸め誤差で 1 サンプル手前のブロックへ落ちないよう 1e-6 だけ寄せる
+        while heap and heap[0][0] < end_s - 1e-6:
+            if snap is not self._live and snap[3] <= heap[0][0]:
+                self._live = snap; self._reschedule(snap[1], max(start_s, snap[3])); heap = st["heap"]
+                continue
+            pos, prio, vid, j = heapq.heappop(heap); v = st["table"][vid]
+            off = int(pos - start_s + 1e-6)
+            if 0 <= off < frames: self._trigger(v, j, off, pos, self._live, waves)
+            j += 1; c, k = divmod(j, len(v[2])); a_s, a_b, spb = st["layers"][v[5]]["anchor"]
+            heapq.heappush(heap, (a_s + (c * v[4] + v[2][k] - a_b) * spb, prio, vid, j))
+        if self.midi_clock: self.midi_clock.block(self, start_s, end_s, st["cb_t"] + lat)
+        p = self._live[1]
+        # ボイスはバス (n_bus, frames) に積み、ルーティング行列との積 1 回で N ch に展開する
+        if self._bus.shape[1] < frames: self._bus = np.zeros((len(BUS_NAMES), frames), dtype=np.float32)
+        if self._scratch.shape[0] < frames: self._scratch = np.zeros(frames, dtype=np.float32)
+        bus = self._bus[:, :frames]; bus.fill(0); tmp = self._scratch
         new_voices = []
-        for cur, wav, vol, s_off in st["active_voices"]:
+        for cur, wav, vol, s_off, b in st["active_voices"]:
             wav_cur, b_start = int(cur), int(max(0, s_off)); L = min(frames - b_start, len(wav) - wav_cur)
             if L > 0:
-                outdata[b_start:b_start+L] += (wav[wav_cur:wav_cur+L] * vol)[:, None]
-                if wav_cur + L < len(wav): new_voices.append([wav_cur+L, wav, vol, s_off-frames])
-            elif s_off > frames: new_voices.append([cur, wav, vol, s_off-frames])
-        st["active_voices"] = new_voices; outdata *= self.params["v_master"]
-        self.last_sent_pos = ((end_s - st["zero_offset"]) / self.sr) * (self.params["bpm"] / 60.0) - 0.025 * (self.params["bpm"] / 60.0)
-        self.queue.put({"type": "vis", "pos": max(-1.0, self.last_sent_pos), "mute": st["is_mute"]})
-
-    def _trigger(self, off):
-        st, p = self.state, self.params; tpb = 12 * p["bpb"]
-        if st["tick_count"] % tpb == 0:
-            if p["rnd"]:
-                st["rnd_left"] -= 1
-                if st["rnd_left"] <= 0:
-                    st["rnd_phase"] = "mute" if st["rnd_phase"] == "play" else "play"
-                    if st["rnd_phase"] == "play":
-                        st["rnd_left"] = random.randint(p.get("rnd_play_min", 1), p.get("rnd_play_max", 2))
-                    else:
-                        st["rnd_left"] = random.randint(p.get("rnd_mute_min", 1), p.get("rnd_mute_max", 2))
-                st["is_mute"] = (st["rnd_phase"] == "mute")
-            else: st["is_mute"] = ((st["tick_count"] // tpb) % (p["play"] + p["mute"])) >= p["play"]
-
-        if p["force_play"]:
-            st["is_mute"] = False
-
-        beat, tick, is_m = ((st["tick_count"] % tpb) // 12) + 1, st["tick_count"] % 12, st["is_mute"]
+                np.multiply(wav[wav_cur:wav_cur+L], vol, out=tmp[:L])
+                bus[b, b_start:b_start+L] += tmp[:L]
+                if wav_cur + L < len(wav): new_voices.append([wav_cur+L, wav, vol, s_off-frames, b])
+            elif s_off > frames: new_voices.append([cur, wav, vol, s_off-frames, b])
+        st["active_voices"] = new_voices
+        if self.track: self.track.read(bus[BUS_INDEX["track_l"]], bus[BUS_INDEX["track_r"]], frames)
+        np.dot(bus.T, self.route_matrix, out=outdata)
+        self._master(outdata, frames, p["v_master"])
+        # 表示位置: ブロック末尾の拍位置と、それがスピーカーから出る時刻 (perf_counter 基準) を送り、UI 側で毎フレーム外挿する
+        L0 = st["layers"][0]; a_s, a_b, spb = L0["anchor"]
+        bps = self.sr / spb
+        t_end = st["cb_t"] + lat + frames / self.sr; b_end = a_b + (end_s - a_s) / spb
+        self.last_sent_pos = b_end - (lat + frames / self.sr) * bps # いまスピーカーから出ている拍位置
+        m = self.meter
+        self.queue.put({"type": "vis", "pos": max(-1.0, self.last_sent_pos), "mute": L0["is_mute"], "t": t_end, "b": b_end, "bps": bps, "ci": self.ci_beats,
+                        "peak": m["peak"], "rms": m["rms"], "gr": m["gr"]})
+
+    def _out_latency(self, time_info):
+        # outputBufferDacTime - currentTime が取れればそれ (ブロックごとの実測)、0 や異常値を返すホスト API では stream.latency
+        try: lat = time_info.outputBufferDacTime - time_info.currentTime
+        except AttributeError: lat = -1.0
+        if not 0.0 < lat < 1.0:
+            lat = getattr(self.stream, "latency", 0.0) if self.stream else 0.0
+            if isinstance(lat, (tuple, list)): lat = lat[1]
+        lat += self.lat_fix_s
+        self.out_latency = lat
+        return lat
+
+    def _master(self, outdata, frames, target):
+        # Master bus: v_master ランプ -> ソフトリミッタ -> メータ。すべて outdata と使い回しバッファ上で in-place
+        n_ch = outdata.shape[1]
+        if self._lim.shape != (frames, n_ch):
+            self._lim = np.zeros((frames, n_ch), dtype=np.float32)
+            self._ramp = np.arange(frames, dtype=np.float32) / np.float32(frames)
+        lim, tmp = self._lim, self._scratch[:frames]
+        # v_master はブロック内で直線補間してジッパーノイズを防ぐ
+        g0 = self._gain
+        if g0 == target: outdata *= target
+        else:
+            step = frames / (self.gain_ramp_s * self.sr) if self.gain_ramp_s > 0 else 1.0
+            g1 = g0 + max(-step, min(step, target - g0))
+            np.multiply(self._ramp, g1 - g0, out=tmp); tmp += g0
+            outdata *= tmp[:, None]
+            self._gain = g1
+        np.abs(outdata, out=lim); pre = float(lim.max())
+        T = self.limit_threshold
+        if self.limiter and pre > T:
+            # |x| > T の超過分 e を T + (1-T)·tanh(e/(1-T)) に圧縮 (T で傾き 1 のまま繋がり、1.0 を超えない)
+            lim -= T; np.maximum(lim, 0.0, out=lim)
+            lim *= 1.0 / (1.0 - T); np.tanh(lim, out=lim); lim *= 1.0 - T
+            np.copysign(lim, outdata, out=lim)
+            np.clip(outdata, -T, T, out=outdata); outdata += lim
+            np.abs(outdata, out=lim); post = float(lim.max())
+        else: post = pre
+        m = self.meter
+        m["peak"], m["rms"] = post, math.sqrt(float(np.vdot(outdata, outdata)) / outdata.size)
+        m["gr"] = 20.0 * math.log10(pre / post) if post > 0 and pre > post else 0.0
+
+    def _duplex_cb(self, indata, outdata, frames, time_info, status):
+        start_s = self.state["total_samples"]
+        self._cb(outdata, frames, time_info, status)
+        if not self.is_playing: return
+        t0 = time.perf_counter()
+        # 入力側のオンセットを出力側のサンプル時計に戻すための往復レイテンシ
+        rt = 0.0
+        try: rt = time_info.outputBufferDacTime - time_info.inputBufferAdcTime
+        except AttributeError: pass
+        if rt <= 0: rt = sum(self.stream.latency)
+        lat = int((rt + 2.0 * self.lat_fix_s + self.listen_offset_ms / 1000.0) * self.sr)
+        for r in self.scorer.match(self.detector.process(indata[:, 0], start_s), lat):
+            r["type"] = "hit"; self.queue.put(r)
+        self.listen_load = 0.95 * self.listen_load + 0.05 * (time.perf_counter() - t0) * self.sr / frames
+
+    def _bar_cues(self, bar, p, is_mute, off):
+        # MUTE 小節の頭で小節番号、セクションの 1 小節前にその名前 (キャッシュに無い語は鳴らさない)
+        words = [str(bar + 1)] if p["cue_bars"] and is_mute else []
+        if p["cue_sections"]: words += [name for b, name in p["sections"] if b - 2 == bar]
+        for w in words:
+            wav = self.cues.peek(w)
+            if wav is not None: self.state["active_voices"].append([0, wav, p["v_cue"], off, BUS_INDEX["cue"]])
+
+    def _trigger(self, v, j, off, pos, snap, waves):
+        st, mo = self.state, snap[2]; ls = st["layers"][v[5]]; p = ls["p"]
+        if v[1] is None:
+            # Clock: 小節頭で PLAY/MUTE を決め、拍ごとにテレメトリを送る (テレメトリはメインレイヤーのみ)
+            bar, beat = divmod(j, p["bpb"])
+            ls["ci"] = bar < 0
+            if bar < 0:
+                # カウントイン (負の小節): キット音は鳴らさず、メインレイヤーだけ cue バスで数える
+                if v[5]: return
+                word = count_in_words(p["bpb"], bar == -1)[beat]
+                wav = self.cues.peek(word) if self.cues else None
+                if wav is None: wav = waves["acc" if beat == 0 else "4th"]
+                st["active_voices"].append([0, wav, p["v_cue"], off, BUS_INDEX["cue"]])
+                self.queue.put({"type": "evt", "ts": time.perf_counter(), "mute": False, "beat": beat + 1, "bar": bar + 1, "vis_err": 0.0,
+                                "s": st["block_s"] + off, "ideal": pos, "t_spk": st["cb_t"] + st["lat"] + off / self.sr, "dac": 0.0,
+                                "pos": j, "bpm": self.sr * 60.0 / ls["anchor"][2], "bpb": p["bpb"], "word": word})
+                return
+            if beat == 0:
+                if p["rnd"]:
+                    plan = p.get("rnd_plan") or (False,)
+                    ls["is_mute"] = plan[bar % len(plan)]
+                else: ls["is_mute"] = (bar % (p["play"] + p["mute"])) >= p["play"]
+                bpm = self._bar_bpm(p, bar)
+                if self.sr * 60.0 / bpm != ls["anchor"][2]: self._retime(v[5], pos, bpm)
+            if p["force_play"]:
+                ls["is_mute"] = False
+            if v[5]: return
+            if beat == 0 and self.cues: self._bar_cues(bar, p, ls["is_mute"], off)
+            if self.scorer: self.scorer.expect(st["block_s"] + off, bar + 1, beat + 1, ls["is_mute"], ls["anchor"][2])
+            if self.probe: self.probe.beat(st["block_s"] + off, pos, off)
+            angle = 30.0 * math.cos(self.last_sent_pos * math.pi)
+            # ts はコールバック到着時刻 (ブロック量子化あり)。発音時刻は t_spk (perf_counter 基準) と dac (ストリーム時計)
+            self.queue.put({"type": "evt", "ts": time.perf_counter(), "mute": ls["is_mute"], "beat": beat + 1, "bar": bar + 1, "vis_err": 30.0 - abs(angle),
+                            "s": st["block_s"] + off, "ideal": pos, "t_spk": st["cb_t"] + st["lat"] + off / self.sr,
+                            "dac": st["dac0"] + off / self.sr if st["dac0"] else 0.0,
+                            "pos": j, "bpm": self.sr * 60.0 / ls["anchor"][2], "bpb": p["bpb"]})
+            return
+        if ls.get("ci"): return
+        is_m = ls["is_mute"]
+        if is_m and not mo.get(v[1], False): return
         vol_m = p["v_mute_dim"] if is_m else 1.0
+        if vol_m > 0: st["active_voices"].append([0, waves[v[1]], v[3][j % len(v[2])] * vol_m, off, BUS_INDEX[v[1]]])
+
+# ==========================================
+#  Headless Server
+# ==========================================
+class WavSink:
+    def __init__(self, path, sr, channels):
+        import wave
+        self.f = wave.open(path, 'wb'); self.f.setnchannels(channels); self.f.setsampwidth(2); self.f.setframerate(sr)
+    def write(self, buf): self.f.writeframes((np.clip(buf, -1.0, 1.0) * 32767).astype('<i2').tobytes())
+    def close(self): self.f.close()
+
+class StreamSink:
+    # Unix ドメインソケット (接続先が listen 済み) または FIFO に float32 インターリーブで流す
+    def __init__(self, kind, path):
+        if kind == "socket":
+            import socket
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM); self.sock.connect(path)
+            self.f = self.sock.makefile('wb')
+        else:
+            if not os.path.exists(path): os.mkfifo(path)
+            self.f = open(path, 'wb')
+    def write(self, buf): self.f.write(np.ascontiguousarray(buf, dtype='<f4').tobytes())
+    def close(self): self.f.close()
 
-        triggers = []
-        if tick == 0:
-            # Backbeat (2 & 4) Trigger
-            if (beat == 2 or beat == 4) and p["v_backbeat"] > 0:
-                if not is_m or self.mute_options.get("backbeat", False):
-                    if vol_m > 0: triggers.append((self.waves["backbeat"], p["v_backbeat"]))
-
-            if beat == 1:
-                if p["v_acc"] > 0:
-                    if not is_m or self.mute_options.get("acc", False):
-                        if vol_m > 0: triggers.append((self.waves["acc"], p["v_acc"]))
+class DeviceSink:
+    paced = True # blocking write がデバイスの実時間で待つ
+    def __init__(self, device, sr, channels, block):
+        self.stream = sd.OutputStream(device=device, channels=channels, samplerate=sr, blocksize=block, latency='low', dtype='float32')
+        self.stream.start()
+    def write(self, buf): self.stream.write(buf)
+    def close(self): self.stream.stop(); self.stream.close()
+
+def _open_session(cfg, block):
+    eng = AudioEngine()
+    eng.kit = dict(cfg.get("kit", {}))
+    eng.routing = dict(cfg.get("routing", {}))
+    eng.limiter, eng.headroom_db = bool(cfg.get("limiter", True)), parse_headroom(cfg.get("headroom_db", {}))
+    params = dict(cfg.get("params", {}))
+    setlist = cfg.get("setlist", [DEFAULT_SONG])
+    if isinstance(setlist, str):
+        with open(setlist, 'r', encoding='utf-8') as f: setlist = json.load(f)
+    if setlist:
+        song = setlist[int(cfg.get("song", 0)) % len(setlist)]
+        params.update(bpm=song["bpm"], bpb=song["bpb"])
+    eng.publish(params, cfg.get("mute_options"))
+    sink_cfg = cfg.get("sink", {"type": "null"})
+    sr, channels = int(sink_cfg.get("samplerate", 48000)), int(sink_cfg.get("channels", 2))
+    src = cfg if cfg.get("track") else (song if setlist else {})
+    if src.get("track"): eng.track_spec = (src["track"], float(src.get("track_gain", 1.0)), float(src.get("track_offset_ms", 0.0)) / 1000.0)
+    if cfg.get("cue_dir"): eng.cue_spec = (cfg["cue_dir"], cfg.get("cue_lang", ""), int(cfg.get("cue_cache_mb", 32)) << 20)
+    if setlist: eng.update("sections", tuple(sorted((int(b), str(n)) for b, n in song.get("sections", {}).items())))
+    eng.open_offline(sr, channels)
+    kind = sink_cfg["type"]
+    if kind == "wav": sink = WavSink(sink_cfg["path"], sr, channels)
+    elif kind in ("socket", "pipe"): sink = StreamSink(kind, sink_cfg["path"])
+    elif kind == "device": sink = DeviceSink(sink_cfg.get("device"), sr, channels, block)
+    else: sink = None
+    eng.request_start()
+    return eng, sink, np.zeros((block, channels), dtype=np.float32)
+
+def _serve_worker(sessions, seconds, block, realtime):
+    # 1 プロセスが複数セッションをブロック単位のラウンドロビンで描画する。戻り値は描画負荷の統計
+    open_ = [_open_session(cfg, block) for cfg in sessions]
+    sr = open_[0][0].sr if open_ else 48000
+    paced = any(getattr(sink, "paced", False) for _, sink, _ in open_)
+    n_blocks = int(seconds * sr / block) if seconds > 0 else -1
+    t0 = time.perf_counter(); busy = 0.0; late = 0; i = 0
+    try:
+        while i != n_blocks:
+            t_blk = time.perf_counter()
+            for eng, sink, buf in open_:
+                eng._cb(buf, block, None, None)
+                while not eng.queue.empty(): eng.queue.get_nowait()
+                if sink: sink.write(buf)
+            busy += time.perf_counter() - t_blk
+            i += 1
+            if realtime and not paced:
+                wait = t0 + i * block / sr - time.perf_counter()
+                if wait > 0: time.sleep(wait)
+                elif wait < -block / sr: late += 1
+    except KeyboardInterrupt: pass
+    finally:
+        for _, sink, _ in open_:
+            if sink: sink.close()
+    audio_s = i * block / sr
+    return {"sessions": len(open_), "audio_s": audio_s, "busy_s": busy, "late_blocks": late,
+            "load": busy / audio_s if audio_s else 0.0}
+
+def serve(path, workers=None, seconds=0.0, block=512, realtime=True):
+    import multiprocessing as mp
+    with open(path, 'r', encoding='utf-8') as f: sessions = json.load(f)["sessions"]
+    workers = max(1, min(workers or os.cpu_count() or 1, len(sessions)))
+    groups = [sessions[w::workers] for w in range(workers)]
+    with mp.get_context("spawn").Pool(workers) as pool:
+        return pool.starmap(_serve_worker, [(g, seconds, block, realtime) for g in groups])
+
+def bench_server(workers=None, seconds=5.0, block=512):
+    # セッション数を倍々に増やし、全セッションが実時間以上で描画できる最大数を二分探索する
+    import multiprocessing as mp
+    workers = workers or os.cpu_count() or 1
+    cfg = {"params": {"v_backbeat": 0.5, "v_8th": 0.4, "v_16th": 0.3, "v_trip": 0.2}, "sink": {"type": "null"}}
+    results = {}
+    with mp.get_context("spawn").Pool(workers) as pool:
+        def rt_factor(n):
+            if n not in results:
+                groups = [[cfg] * (n // workers + (1 if w < n % workers else 0)) for w in range(min(workers, n))]
+                stats = pool.starmap(_serve_worker, [(g, seconds, block, False) for g in groups])
+                # セッション生成 (波形生成) を除いた描画ループだけの時間で比べる
+                results[n] = seconds / max(st["busy_s"] for st in stats)
+            return results[n]
+        lo, hi = 0, 1
+        while rt_factor(hi) >= 1.0: lo, hi = hi, hi * 2
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if rt_factor(mid) >= 1.0: lo = mid
+            else: hi = mid
+    return {"workers": workers, "block": block, "max_sessions": lo, "results": results}
+
+# ==========================================
+#  Golden Render (regression)
+# ==========================================
+GOLDEN_FILENAME = os.path.join("tests", "golden.json")
+GOLDEN_BARS = 8
+GOLDEN_SR = 48000
+
+def golden_scenarios():
+    # 名前 -> (params, mute_options, block)。BPM x 拍子 x ミュート x ランダム x 音色 x バッファの代表点
+    full = {"v_backbeat": 0.5, "v_8th": 0.4, "v_16th": 0.3, "v_trip": 0.2, "v_mute_dim": 0.3}
+    mo_all = {k: True for k in ("acc", "backbeat", "4th", "8th", "16th", "trip")}
+    sc = {}
+    for bpm in (60, 120, 197.5):
+        for bpb in (3, 4, 7):
+            sc[f"bpm{bpm:g}-{bpb}"] = ({"bpm": bpm, "bpb": bpb}, {}, 128)
+    for block in (32, 128, 441, 1024):
+        sc[f"full-b{block}"] = (dict(full, play=2, mute=1), {"acc": True, "8th": True}, block)
+    sc["mute-all-voices"] = (dict(full, play=1, mute=1), mo_all, 256)
+    sc["mute-dim0"] = (dict(full, v_mute_dim=0.0, play=1, mute=2), {"4th": True}, 256)
+    sc["random"] = (dict(full, rnd=True, rnd_seed=7, rnd_play_min=1, rnd_play_max=3), {"acc": True}, 256)
+    sc["force-play"] = (dict(full, play=1, mute=1, force_play=True), {}, 256)
+    sc["woody"] = (dict(full, tone_mode="woody", play=2, mute=1), {"acc": True}, 256)
+    sc["woody-b64"] = (dict(full, tone_mode="woody", bpm=150), {}, 64)
+    sc["trainer"] = (dict(full, trainer=True, trainer_step=10, trainer_every=2, trainer_max=160, bpm=120), {}, 256)
+    sc["count-in"] = ({"count_in": 1, "bpm": 100}, {}, 256)
+    sc["tuplet-5:4"] = ({"voices": ({"wave": "trip", "hits": 5, "beats": 4, "accents": [2, 1, 1, 1, 1], "vol": 0.5},)}, {}, 256)
+    sc["layers-7/8"] = ({"layers": ({"name": "7/8", "bpm": 180, "bpb": 7, "sound": "trip"},)}, {}, 256)
+    sc["swing-8th-66"] = ({"v_8th": 0.4, "v_4th": 0.0, "groove": GROOVES["Swing 8th 66% (triplet)"]}, {}, 256)
+    sc["swing-8th-16ths"] = ({"v_16th": 0.4, "v_4th": 0.0, "groove": GROOVES["Swing 8th 62%"]}, {}, 256)
+    sc["swing-16th-58"] = (dict(full, play=2, mute=1, groove=GROOVES["Swing 16th 58%"]), {"16th": True}, 128)
+    sc["groove-humanize"] = (dict(full, bpb=3, groove=dict(GROOVES["Humanize (light)"], swing=60, offsets={"backbeat": [10]})), {}, 256)
+    return sc
+
+def golden_render(params, mute_options, block, bars=GOLDEN_BARS, sr=GOLDEN_SR):
+    # 固定シード・ストリームなし・固定ブロック長で bars 小節ぶん描画し、(モノ音声, 小節頭サンプル, 描画秒) を返す
+    eng = AudioEngine()
+    eng.noise_seed = 0
+    eng.publish(params, mute_options)
+    eng.open_offline(sr, 2)
+    eng.request_start()
+    out = np.zeros((block, 2), dtype=np.float32)
+    chunks, downbeats = [], []
+    t0 = time.perf_counter(); busy = 0.0
+    while len(downbeats) <= bars and len(chunks) * block < sr * 120:
+        t = time.perf_counter()
+        eng._cb(out, block, None, None)
+        busy += time.perf_counter() - t
+        chunks.append(out[:, 0].copy())
+        while True:
+            try: d = eng.queue.get_nowait()
+            except queue.Empty: break
+            if d["type"] == "evt" and d["beat"] == 1 and d["bar"] > 0: downbeats.append(d["s"])
+    return np.concatenate(chunks), downbeats[:bars + 1], busy
+
+def golden_fingerprint(audio, downbeats):
+    # 小節ごとのハッシュ (16bit に量子化してから: 末位の丸め差は吸収し、聞こえる差は拾う) と発音位置
+    import hashlib
+    q = np.round(np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+    bars = []
+    for a, b in zip(downbeats, downbeats[1:]):
+        seg = audio[a:b]
+        bars.append({"hash": hashlib.sha1(q[a:b].tobytes()).hexdigest()[:16],
+                     "rms": round(float(np.sqrt(np.mean(seg * seg))) if len(seg) else 0.0, 5)})
+    # 発音 = 16 サンプル以上の無音のあとに立ち上がった位置
+    nz = np.abs(q) > 0
+    idx = np.flatnonzero(nz)
+    onsets = idx[np.diff(idx, prepend=-16) >= 16].tolist() if len(idx) else []
+    return {"downbeats": [int(x) for x in downbeats], "bars": bars, "onsets": onsets}
+
+def golden_compare(ref, cur):
+    # 差分を人が読める文字列のリストで返す (空なら一致)
+    diffs = []
+    if ref["downbeats"] != cur["downbeats"]:
+        n = next((i for i, (a, b) in enumerate(zip(ref["downbeats"], cur["downbeats"])) if a != b), min(len(ref["downbeats"]), len(cur["downbeats"])))
+        diffs.append(f"downbeat {n}: {ref['downbeats'][n] if n < len(ref['downbeats']) else '-'} -> {cur['downbeats'][n] if n < len(cur['downbeats']) else '-'}")
+    for i, (a, b) in enumerate(zip(ref["bars"], cur["bars"])):
+        if a["hash"] != b["hash"]: diffs.append(f"bar {i + 1}: hash differs (rms {a['rms']:.5f} -> {b['rms']:.5f})")
+    ro, co = set(ref["onsets"]), set(cur["onsets"])
+    if ro != co:
+        diffs.append(f"onsets: {len(ro - co)} missing {sorted(ro - co)[:5]}, {len(co - ro)} new {sorted(co - ro)[:5]}")
+    return diffs
+
+def golden_run(path, update=False, only=""):
+    # python InnerPulse.py --golden [--golden-file tests/golden.json] [--update] [--only name]
+    # 全シナリオを描画して保存済みの指紋と比べ、描画時間 (実時間比) も同じ実行で記録する。
+    # "baseline" に載っているシナリオは 1.x のティック式エンジンの出力から取った指紋。--update で上書きしたら外す
+    ref = {}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f: ref = json.load(f)
+    scenarios = dict(ref.get("scenarios", {}))  # --update --only は描画したシナリオだけ書き換える
+    baseline = set(ref.get("baseline", []))
+    failed, results = [], {}
+    for name, (params, mo, block) in golden_scenarios().items():
+        if only and only not in name: continue
+        audio, downbeats, busy = golden_render(params, mo, block)
+        fp = golden_fingerprint(audio, downbeats)
+        fp["render_ms"] = round(busy * 1000.0, 2)
+        rt = len(audio) / GOLDEN_SR / max(busy, 1e-9)
+        old = ref.get("scenarios", {}).get(name)
+        if update or old is None:
+            results[name] = fp; status = "RECORDED"; diffs = []
+            if name in baseline: baseline.discard(name); status = "REBASED"
+        else:
+            diffs = golden_compare(old, fp); status = "FAIL" if diffs else "ok"
+            results[name] = old
+            if diffs: failed.append(name)
+        slow = f" ({busy * 1000.0 / max(old['render_ms'], 1e-3):.2f}x stored)" if old and not update else ""
+        print(f"[GOLDEN] {name:18s} {status:8s} {busy * 1000.0:8.1f}ms  {rt:7.1f}x real time{slow}")
+        for d in diffs: print(f"           {d}")
+    if update or any(n not in ref.get("scenarios", {}) for n in results):
+        scenarios.update(results)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"version": APP_VERSION, "sr": GOLDEN_SR, "bars": GOLDEN_BARS, "numpy": np.__version__, "baseline": sorted(baseline),
+                       "scenarios": scenarios}, f, indent=1)
+    return failed
+
+# ==========================================
+#  MIDI (SMF Export / Clock)
+# ==========================================
+MIDI_NOTES = {"acc": 76, "4th": 77, "backbeat": 38, "8th": 42, "16th": 70, "trip": 75} # GM ドラム (ch 10)
+MIDI_TUPLET_NOTE = 37 # 連符ボイス (Side Stick)
+MIDI_CLOCK, MIDI_START, MIDI_STOP = 0xF8, 0xFA, 0xFC
+SMF_PPQ = 480
+
+def _vlq(n):
+    out = [n & 0x7F]; n >>= 7
+    while n: out.append(0x80 | (n & 0x7F)); n >>= 7
+    return bytes(reversed(out))
+
+def _smf_meta(kind, data): return b"\xff" + bytes([kind]) + _vlq(len(data)) + data
+
+def _smf_encode(ticks, data, prev):
+    # チャンネルイベント列 (デルタ VLQ + 3 バイト) を numpy でまとめて符号化する
+    d = np.diff(ticks, prepend=prev).astype(np.int64)
+    nb = 1 + (d >= 1 << 7) + (d >= 1 << 14) + (d >= 1 << 21)
+    size = nb + 3
+    start = np.cumsum(size) - size
+    buf = np.zeros(int(size.sum()), dtype=np.uint8)
+    for k in range(4):
+        m = nb > k
+        buf[start[m] + nb[m] - 1 - k] = ((d[m] >> (7 * k)) & 0x7F) | (0x80 if k else 0)
+    for c in range(3): buf[start + nb + c] = data[:, c]
+    return buf.tobytes()
+
+def _smf_track(ticks, data, metas, end=0):
+    # ticks は昇順。メタイベント (テンポ/拍子/マーカー, 少数) の位置で区切り、同じ tick ではメタを先に置く
+    out, prev, lo = [], 0, 0
+    for t, payload in sorted(metas, key=lambda m: m[0]):
+        hi = int(np.searchsorted(ticks, t, 'left'))
+        if hi > lo: out.append(_smf_encode(ticks[lo:hi], data[lo:hi], prev)); prev = int(ticks[hi - 1])
+        out.append(_vlq(t - prev) + payload); prev, lo = t, hi
+    if lo < len(ticks): out.append(_smf_encode(ticks[lo:], data[lo:], prev)); prev = int(ticks[-1])
+    out.append(_vlq(max(0, end - prev)) + b"\xff\x2f\x00")
+    body = b"".join(out)
+    return b"MTrk" + len(body).to_bytes(4, "big") + body
+
+def _bar_mutes(p, n):
+    # _trigger と同じ PLAY/MUTE 判定を小節ごとに
+    bars = np.arange(n)
+    if p["force_play"]: return np.zeros(n, dtype=bool)
+    if p["rnd"]:
+        plan = np.array(p.get("rnd_plan") or (False,), dtype=bool)
+        return plan[bars % len(plan)]
+    return (bars % (p["play"] + p["mute"])) >= p["play"]
+
+def smf_song_events(eng, p, mo, bars):
+    # 1 曲 bars 小節ぶんの (メイン拍位置, ノート, ゲイン) をボイス表から numpy で展開する。
+    # サブレイヤーは自分の BPM で秒に直し、メインのテンポ表でメインの拍位置へ写す
+    bpb = p["bpb"]
+    bpm = np.array([eng._bar_bpm(p, b) for b in range(bars)], dtype=float)
+    bar_t = np.concatenate(([0.0], np.cumsum(bpb * 60.0 / bpm)))
+    lps = [p] + [{**LAYER_DEFAULTS, **l} for l in p.get("layers", ()) if l.get("enabled", True)]
+    beats, notes, gains = [], [], []
+    for li, lp in enumerate(lps):
+        lbpb = lp["bpb"]
+        n = bars if li == 0 else int(math.ceil(bar_t[-1] * lp["bpm"] / 60.0 / lbpb))
+        mutes = _bar_mutes(lp, n)
+        for ident, wave, offs, g, cycle, _ in eng._compile(lp, li):
+            if wave is None: continue
+            total = n * lbpb
+            c = np.arange(int(math.ceil(total / cycle)))
+            pos = (c[:, None] * cycle + np.array(offs)[None, :]).ravel()
+            gain = np.tile(np.array(g, dtype=float), len(c))
+            keep = pos < total - 1e-9
+            pos, gain = pos[keep], gain[keep]
+            bar = np.minimum((pos / lbpb + 1e-9).astype(np.int64), n - 1)
+            gain = np.where(mutes[bar], gain * lp["v_mute_dim"] if mo.get(wave, False) else 0.0, gain)
+            if li == 0: b = pos
             else:
-                if p["v_4th"] > 0:
-                    if not is_m or self.mute_options.get("4th", False):
-                        if vol_m > 0: triggers.append((self.waves["4th"], p["v_4th"]))
-
-        if tick == 6 and p["v_8th"] > 0:
-            if not is_m or self.mute_options.get("8th", False):
-                if vol_m > 0: triggers.append((self.waves["8th"], p["v_8th"]))
-        if (tick == 3 or tick == 9) and p["v_16th"] > 0:
-            if not is_m or self.mute_options.get("16th", False):
-                if vol_m > 0: triggers.append((self.waves["16th"], p["v_16th"]))
-        if (tick == 4 or tick == 8) and p["v_trip"] > 0:
-            if not is_m or self.mute_options.get("trip", False):
-                if vol_m > 0: triggers.append((self.waves["trip"], p["v_trip"]))
-
-        for w, v in triggers: st["active_voices"].append([0, w, v * vol_m, off])
-
-        if tick == 0:
-            angle = 30.0 * math.cos(self.last_sent_pos * math.pi)
-            self.queue.put({"type": "evt", "ts": time.perf_counter(), "mute": is_m, "beat": beat, "bar": (st["tick_count"] // tpb) + 1, "vis_err": 30.0 - abs(angle)})
+                sec = pos * 60.0 / lp["bpm"]
+                keep = sec < bar_t[-1] - 1e-9
+                sec, gain = sec[keep], gain[keep]
+                mb = np.clip(np.searchsorted(bar_t, sec, 'right') - 1, 0, bars - 1)
+                b = mb * bpb + (sec - bar_t[mb]) * bpm[mb] / 60.0
+            beats.append(b); gains.append(gain)
+            notes.append(np.full(len(b), MIDI_TUPLET_NOTE if ident.startswith("v") else MIDI_NOTES.get(wave, MIDI_TUPLET_NOTE)))
+    if not beats: return np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0), bpm
+    return np.concatenate(beats), np.concatenate(notes), np.concatenate(gains), bpm
+
+def export_smf(eng, path, songs, bars=64, ppq=SMF_PPQ):
+    # 曲 (name/bpm/bpb/sections, 任意で bars) を続けて SMF (format 0, ch 10) に書く。params/mute_options は eng の現在値。
+    # 曲名・セクションはマーカー、テンポ表 (トレーナー) はテンポイベント、カウントインは acc/4th のノートで入れる
+    mo = eng.mute_options
+    ticks, data, metas = [], [], [(0, _smf_meta(0x03, APP_NAME.encode()))]
+    t0 = n_notes = n_bars = 0
+    for song in songs:
+        p = dict(eng.params, bpm=song["bpm"], bpb=song["bpb"])
+        eng._derive(p, {"bpm", "bpb"})
+        n, bpb = int(song.get("bars", bars)), p["bpb"]
+        beats, notes, gains, bpm = smf_song_events(eng, p, mo, n)
+        ci = p["count_in"] * bpb
+        if ci:
+            cb = np.arange(ci, dtype=float)
+            beats = np.concatenate((cb - ci, beats)); gains = np.concatenate((np.full(ci, p["v_cue"]), gains))
+            notes = np.concatenate((np.where(cb % bpb == 0, MIDI_NOTES["acc"], MIDI_NOTES["4th"]), notes))
+        metas.append((t0, _smf_meta(0x06, str(song.get("name", "")).encode("utf-8"))))
+        metas.append((t0, _smf_meta(0x58, bytes([bpb, 2, 24, 8]))))
+        for b in np.flatnonzero(np.diff(bpm, prepend=-1.0)):
+            at = t0 + (ci + int(b) * bpb) * ppq if b else t0
+            metas.append((at, _smf_meta(0x51, int(round(60e6 / bpm[b])).to_bytes(3, "big"))))
+        for b, name in song.get("sections", {}).items():
+            if 1 <= int(b) <= n: metas.append((t0 + (ci + (int(b) - 1) * bpb) * ppq, _smf_meta(0x06, str(name).encode("utf-8"))))
+        keep = gains > 0
+        tk = t0 + np.round((beats[keep] + ci) * ppq).astype(np.int64)
+        vel = np.clip(np.round(gains[keep] * 127), 1, 127).astype(np.int64)
+        nt = notes[keep].astype(np.int64)
+        ticks += [tk, tk + ppq // 8]
+        data += [np.stack((np.full(len(tk), 0x99), nt, vel), axis=1), np.stack((np.full(len(tk), 0x89), nt, np.zeros_like(nt)), axis=1)]
+        t0 += (ci + n * bpb) * ppq; n_notes += len(tk); n_bars += n
+    ticks = np.concatenate(ticks) if ticks else np.zeros(0, dtype=np.int64)
+    data = np.concatenate(data).astype(np.uint8) if data else np.zeros((0, 3), dtype=np.uint8)
+    # 同じ tick ではノートオフを先に
+    order = np.lexsort((data[:, 0] == 0x99, ticks))
+    track = _smf_track(ticks[order], data[order], metas, t0)
+    with open(path, 'wb') as f:
+        f.write(b"MThd" + (6).to_bytes(4, "big") + (0).to_bytes(2, "big") + (1).to_bytes(2, "big") + ppq.to_bytes(2, "big") + track)
+    return {"songs": len(songs), "bars": n_bars, "notes": n_notes}
+
+class MidiClock:
+    # MIDI クロック (24 PPQN) / START / STOP。位置はエンジンのサンプル時計から _cb が出し、(サンプル, 発音時刻, バイト) を積むだけ。
+    # 送信スレッドが発音時刻 (perf_counter 基準, 出力レイテンシ込み) に合わせて送るのでオーディオと揃う。
+    # port: mido の出力ポート名 / "virtual" (ALSA/CoreMIDI の仮想ポート) / "file:<path>" (テキストで記録, 待たずに書く)
+    def __init__(self, port):
+        self.port = port
+        self.q = collections.deque()
+        self.k = None # 次のクロック番号 (拍 k/24)。None = 次のブロックで拾い直す
+        self.running = False
+        # q / k / running はオーディオ・UI・送信の 3 スレッドから触るので、読み書きは _lock の中だけ (中では待たない)
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.file = port.startswith("file:")
+        if self.file: self.out = open(port[5:], 'w', encoding='utf-8')
+        else:
+            import mido
+            self.out = mido.open_output(APP_NAME + " Clock", virtual=True) if port == "virtual" else mido.open_output(port)
+            self._msg = mido.Message.from_bytes
+        self._stop, self._wake = threading.Event(), threading.Event()
+        self.th = threading.Thread(target=self._run, daemon=True)
+        self.th.start()
+
+    def start(self):
+        # 再生開始のブロックから拾い直す (START は拍 0 の直前に block が積む)
+        with self._lock: self.k = None; self.running = True
+
+    def block(self, eng, start_s, end_s, t0):
+        # [start_s, end_s) に入るクロックを積む (t0 = start_s の発音時刻)。拍 0 の直前に START
+        a_s, a_b, spb = eng.state["layers"][0]["anchor"]
+        with self._lock:
+            if not self.running: return # stop() 後に走り込んだブロックは積まない
+            if self.k is None: self.k = math.ceil((a_b + (start_s - a_s) / spb) * 24 - 1e-9)
+            b1 = (a_b + (end_s - a_s) / spb) * 24 - 1e-9
+            while self.k < b1:
+                s = a_s + (self.k / 24.0 - a_b) * spb
+                t = t0 + (s - start_s) / eng.sr
+                if self.k == 0: self.q.append((s, t, MIDI_START))
+                self.q.append((s, t, MIDI_CLOCK)); self.k += 1
+        self._wake.set()
+
+    def stop(self):
+        # 停止は UI スレッドから即時: 未送信のクロックは捨てて STOP だけ残す (停止中に呼ばれても STOP は送る)
+        with self._lock:
+            self.q.clear(); self.k = None; self.running = False
+            self.q.append((-1, time.perf_counter(), MIDI_STOP))
+        self._wake.set()
+
+    def _send(self, s, t, b):
+        if self.file: self.out.write(f"{s:.1f}\t{t:.6f}\t{b:02X}\n")
+        else: self.out.send(self._msg([b]))
+        self.sent += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(0.05); self._wake.clear()
+            while not self._stop.is_set():
+                # 先頭の確認と取り出しは同じロックの中で (間に stop() の clear が入らない)
+                with self._lock:
+                    if not self.q: break
+                    s, t, b = self.q[0]
+                    dt = t - time.perf_counter()
+                    if dt <= 0 or self.file: self.q.popleft()
+                if dt > 0 and not self.file: time.sleep(min(dt, 0.05)); continue
+                self._send(s, t, b)
+
+    def close(self):
+        # 送信スレッドを止めてから、受け手が走ったままにならないよう STOP を直接送って閉じる
+        self._stop.set(); self._wake.set(); self.th.join(timeout=1.0)
+        with self._lock: self.q.clear(); self.running = False
+        try: self._send(-1, time.perf_counter(), MIDI_STOP)
+        except Exception: pass
+        self.out.close()
 
 # ==========================================
 #  UI Components
@@ -382,16 +1893,20 @@ class SetlistEditor(QDialog):
         self.setlist = setlist
         self.jump_to_index = -1
         layout = QVBoxLayout(self)
-        self.table = QTableWidget(len(setlist), 3)
-        self.table.setHorizontalHeaderLabels(["Song Name", "BPM", "Beats"])
+        self.table = QTableWidget(len(setlist), 4)
+        self.table.setHorizontalHeaderLabels(["Song Name", "BPM", "Beats", "Track"])
         self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
         self.table.setSelectionBehavior(QTableWidget.SelectRows)
         for i, s in enumerate(setlist):
             name_item = QTableWidgetItem(s["name"])
+            name_item.setData(Qt.UserRole, s) # track_gain など表に出ないキーを保つ
             bpm_item = QTableWidgetItem(str(s["bpm"]))
             bpb_item = QTableWidgetItem(str(s["bpb"]))
+            track_item = QTableWidgetItem(os.path.basename(s.get("track", "")))
+            track_item.setData(Qt.UserRole, s.get("track", ""))
+            track_item.setToolTip(s.get("track", ""))
             if i == 0:
-                for item in (name_item, bpm_item, bpb_item):
+                for item in (name_item, bpm_item, bpb_item, track_item):
                     item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
                     item.setBackground(QColor("#1a1a1a"))
                     item.setForeground(QColor("#666"))
@@ -400,12 +1915,17 @@ class SetlistEditor(QDialog):
             self.table.setItem(i, 0, name_item)
             self.table.setItem(i, 1, bpm_item)
             self.table.setItem(i, 2, bpb_item)
+            self.table.setItem(i, 3, track_item)
         layout.addWidget(self.table)
         btn_layout = QGridLayout()
         btn_add = QPushButton("+ Add Song")
         btn_add.clicked.connect(self.add_row)
         btn_del = QPushButton("- Remove Selected")
         btn_del.clicked.connect(self.del_row)
+        btn_track = QPushButton("♪ Set Track...")
+        btn_track.clicked.connect(self.set_track)
+        btn_untrack = QPushButton("♪ Clear Track")
+        btn_untrack.clicked.connect(lambda: self._put_track(""))
         btn_load = QPushButton("LOAD && CLOSE")
         btn_load.setStyleSheet("background: #007acc; color: white; font-weight: bold;")
         btn_load.clicked.connect(self.load_and_close)
@@ -414,8 +1934,10 @@ class SetlistEditor(QDialog):
         btn_close.clicked.connect(self.accept)
         btn_layout.addWidget(btn_add, 0, 0)
         btn_layout.addWidget(btn_del, 0, 1)
-        btn_layout.addWidget(btn_load, 1, 0)
-        btn_layout.addWidget(btn_close, 1, 1)
+        btn_layout.addWidget(btn_track, 1, 0)
+        btn_layout.addWidget(btn_untrack, 1, 1)
+        btn_layout.addWidget(btn_load, 2, 0)
+        btn_layout.addWidget(btn_close, 2, 1)
         layout.addLayout(btn_layout)
 
     def add_row(self):
@@ -424,6 +1946,20 @@ class SetlistEditor(QDialog):
         self.table.setItem(row, 0, QTableWidgetItem(f"New Song {row}"))
         self.table.setItem(row, 1, QTableWidgetItem("120"))
         self.table.setItem(row, 2, QTableWidgetItem("4"))
+        self.table.setItem(row, 3, QTableWidgetItem(""))
+
+    def set_track(self):
+        if self.table.currentRow() <= 0: return
+        from PySide6.QtWidgets import QFileDialog
+        path, _ = QFileDialog.getOpenFileName(self, "Select Backing Track", "", "Audio Files (*.wav *.flac *.ogg *.mp3);;WAV Files (*.wav)")
+        if path: self._put_track(path)
+
+    def _put_track(self, path):
+        row = self.table.currentRow()
+        if row <= 0: return
+        item = QTableWidgetItem(os.path.basename(path))
+        item.setData(Qt.UserRole, path); item.setToolTip(path)
+        self.table.setItem(row, 3, item)
 
     def del_row(self):
         idx = self.table.currentRow()
@@ -443,7 +1979,12 @@ class SetlistEditor(QDialog):
             try:
                 name = self.table.item(i, 0).text()
                 if name.startswith("> "): name = name[2:]
-                new_list.append({"name": name, "bpm": int(self.table.item(i, 1).text()), "bpb": int(self.table.item(i, 2).text())})
+                song = dict(self.table.item(i, 0).data(Qt.UserRole) or {})
+                song.update(name=name, bpm=int(self.table.item(i, 1).text()), bpb=int(self.table.item(i, 2).text()))
+                track = self.table.item(i, 3).data(Qt.UserRole) if self.table.item(i, 3) else ""
+                if track: song["track"] = track
+                else: song.pop("track", None)
+                new_list.append(song)
             except: continue
         self.setlist[:] = new_list
 
@@ -507,7 +2048,7 @@ class RandomTrainingOptionsDialog(QDialog):
     def __init__(self, parent=None, params=None):
         super().__init__(parent)
         self.setWindowTitle("Random Training Settings")
-        self.resize(300, 250)
+        self.resize(320, 360)
         self.setStyleSheet("""
             QDialog { background: #222; color: #eee; }
             QLabel { color: #ccc; font-weight: bold; font-size: 11px; }
@@ -544,56 +2085,629 @@ class RandomTrainingOptionsDialog(QDialog):
         self.sp_m_max.setRange(1, 16)
         self.sp_m_max.setValue(self.params.get("rnd_mute_max", 2))
         grid.addWidget(self.sp_m_max, 5, 1)
-        
+
+        grid.addWidget(QLabel("SEED (same seed = same plan):"), 6, 0, 1, 2)
+        self.sp_seed = QSpinBox()
+        self.sp_seed.setRange(0, 999999)
+        self.sp_seed.setValue(self.params.get("rnd_seed", 1))
+        grid.addWidget(self.sp_seed, 7, 0)
+        btn_seed = QPushButton("New Seed")
+        btn_seed.clicked.connect(lambda: self.sp_seed.setValue(random.randint(0, 999999)))
+        grid.addWidget(btn_seed, 7, 1)
+
         layout.addLayout(grid)
+        self.lbl_plan = QLabel()
+        self.lbl_plan.setWordWrap(True)
+        self.lbl_plan.setStyleSheet("color: #0cf; font-family: 'Courier New', monospace; font-size: 11px;")
+        layout.addWidget(self.lbl_plan)
+        for sp in (self.sp_p_min, self.sp_p_max, self.sp_m_min, self.sp_m_max, self.sp_seed):
+            sp.valueChanged.connect(self.update_preview)
+        self.update_preview()
         layout.addStretch()
         
         btn_layout = QHBoxLayout()
         btn_ok = QPushButton("OK")
-        btn_ok.clicked.connect(self.validate_and_accept)
+        btn_ok.clicked.connect(self.validate_and_accept)
+        btn_cancel = QPushButton("Cancel")
+        btn_cancel.setStyleSheet("background: #555;")
+        btn_cancel.clicked.connect(self.reject)
+        btn_layout.addWidget(btn_ok)
+        btn_layout.addWidget(btn_cancel)
+        layout.addLayout(btn_layout)
+
+    def validate_and_accept(self):
+        if self.sp_p_min.value() > self.sp_p_max.value():
+            self.sp_p_max.setValue(self.sp_p_min.value())
+        if self.sp_m_min.value() > self.sp_m_max.value():
+            self.sp_m_max.setValue(self.sp_m_min.value())
+        self.accept()
+
+    def update_preview(self):
+        r = self.get_ranges()
+        plan = make_random_plan(r["rnd_seed"], r["rnd_play_min"], r["rnd_play_max"], r["rnd_mute_min"], r["rnd_mute_max"], 32)
+        self.lbl_plan.setText("First 32 bars: " + " ".join(plan_runs(plan)))
+
+    def get_ranges(self):
+        return {
+            "rnd_seed": self.sp_seed.value(),
+            "rnd_play_min": self.sp_p_min.value(),
+            "rnd_play_max": self.sp_p_max.value(),
+            "rnd_mute_min": self.sp_m_min.value(),
+            "rnd_mute_max": self.sp_m_max.value()
+        }
+
+class SpeedTrainerDialog(QDialog):
+    def __init__(self, parent=None, params=None):
+        super().__init__(parent)
+        self.setWindowTitle("Speed Trainer")
+        self.resize(300, 230)
+        self.setStyleSheet("""
+            QDialog { background: #222; color: #eee; }
+            QLabel { color: #ccc; font-weight: bold; font-size: 11px; }
+            QCheckBox { color: #ffcc00; font-weight: bold; font-size: 12px; }
+            QSpinBox { background: #333; color: #eee; padding: 4px; border-radius: 4px; font-size: 13px; }
+            QPushButton { background: #007acc; color: white; font-weight: bold; padding: 8px; border-radius: 4px; }
+        """)
+        params = params if params else {}
+        layout = QVBoxLayout(self)
+        self.chk_on = QCheckBox("Raise BPM while playing")
+        self.chk_on.setChecked(params.get("trainer", False))
+        layout.addWidget(self.chk_on)
+        grid = QGridLayout()
+        self.spins = {}
+        for row, (key, label, lo, hi, default) in enumerate([("trainer_step", "BPM STEP (+/-):", -40, 40, 4),
+                                                             ("trainer_every", "EVERY N BARS:", 1, 64, 4),
+                                                             ("trainer_max", "TARGET BPM:", 40, 300, 200)]):
+            grid.addWidget(QLabel(label), row, 0)
+            sp = QSpinBox()
+            sp.setRange(lo, hi)
+            sp.setValue(params.get(key, default))
+            grid.addWidget(sp, row, 1)
+            self.spins[key] = sp
+            sp.valueChanged.connect(self.validate)
+        layout.addLayout(grid)
+        self.bpm = params.get("bpm", 120)
+        self.lbl_warn = QLabel("")
+        self.lbl_warn.setStyleSheet("color: #ff5555;")
+        self.lbl_warn.setWordWrap(True)
+        layout.addWidget(self.lbl_warn)
+        layout.addStretch()
+        btn_layout = QHBoxLayout()
+        self.btn_ok = btn_ok = QPushButton("OK")
+        btn_ok.clicked.connect(self.accept)
+        btn_cancel = QPushButton("Cancel")
+        btn_cancel.setStyleSheet("background: #555;")
+        btn_cancel.clicked.connect(self.reject)
+        btn_layout.addWidget(btn_ok)
+        btn_layout.addWidget(btn_cancel)
+        layout.addLayout(btn_layout)
+        self.chk_on.toggled.connect(self.validate)
+        self.validate()
+
+    def validate(self):
+        # 目標 BPM が STEP の向きと逆 (今の BPM より下なのに + など) なら OK を押させない
+        step, target = self.spins["trainer_step"].value(), self.spins["trainer_max"].value()
+        msg = ""
+        if self.chk_on.isChecked():
+            if step == 0: msg = "BPM STEP is 0."
+            elif (target - self.bpm) * step <= 0:
+                msg = f"TARGET {target} is not {'above' if step > 0 else 'below'} the current {self.bpm} BPM."
+        self.lbl_warn.setText(msg)
+        self.btn_ok.setEnabled(not msg)
+
+    def get_settings(self):
+        return dict({k: sp.value() for k, sp in self.spins.items()}, trainer=self.chk_on.isChecked())
+
+class GrooveDialog(QDialog):
+    # プリセット/ファイルのテンプレートを土台に swing と humanize を上書きする。offsets/velocity 表はテンプレートのまま
+    def __init__(self, parent=None, groove=None):
+        super().__init__(parent)
+        self.setWindowTitle("Groove")
+        self.resize(340, 300)
+        self.setStyleSheet("""
+            QDialog { background: #222; color: #eee; }
+            QLabel { color: #ccc; font-weight: bold; font-size: 11px; }
+            QSpinBox, QDoubleSpinBox, QComboBox { background: #333; color: #eee; padding: 4px; border-radius: 4px; font-size: 13px; }
+            QPushButton { background: #007acc; color: white; font-weight: bold; padding: 8px; border-radius: 4px; }
+        """)
+        self.templates = dict(GROOVES)
+        if groove and groove.get("name") not in self.templates: self.templates[groove["name"]] = groove
+        layout = QVBoxLayout(self)
+        grid = QGridLayout()
+        grid.addWidget(QLabel("TEMPLATE:"), 0, 0)
+        self.combo = QComboBox()
+        self.combo.addItems(list(self.templates))
+        grid.addWidget(self.combo, 0, 1)
+        btn_import = QPushButton("Import...")
+        btn_import.clicked.connect(self.import_file)
+        grid.addWidget(btn_import, 0, 2)
+        grid.addWidget(QLabel("SWING %:"), 1, 0)
+        self.sp_swing = QDoubleSpinBox()
+        self.sp_swing.setRange(25.0, 75.0)
+        self.sp_swing.setDecimals(1)
+        grid.addWidget(self.sp_swing, 1, 1, 1, 2)
+        grid.addWidget(QLabel("SWING GRID:"), 2, 0)
+        self.combo_grid = QComboBox()
+        self.combo_grid.addItems(["8th", "16th"])
+        grid.addWidget(self.combo_grid, 2, 1, 1, 2)
+        grid.addWidget(QLabel("HUMANIZE TICKS (±/480):"), 3, 0)
+        self.sp_ticks = QSpinBox()
+        self.sp_ticks.setRange(0, 40)
+        grid.addWidget(self.sp_ticks, 3, 1, 1, 2)
+        grid.addWidget(QLabel("HUMANIZE VELOCITY %:"), 4, 0)
+        self.sp_vel = QSpinBox()
+        self.sp_vel.setRange(0, 50)
+        grid.addWidget(self.sp_vel, 4, 1, 1, 2)
+        layout.addLayout(grid)
+        self.lbl_tables = QLabel("")
+        self.lbl_tables.setStyleSheet("color: #777; font-size: 9px; font-weight: normal;")
+        self.lbl_tables.setWordWrap(True)
+        layout.addWidget(self.lbl_tables)
+        layout.addStretch()
+        btn_layout = QHBoxLayout()
+        btn_ok = QPushButton("OK")
+        btn_ok.clicked.connect(self.accept)
+        btn_cancel = QPushButton("Cancel")
+        btn_cancel.setStyleSheet("background: #555;")
+        btn_cancel.clicked.connect(self.reject)
+        btn_layout.addWidget(btn_ok)
+        btn_layout.addWidget(btn_cancel)
+        layout.addLayout(btn_layout)
+        self.combo.currentTextChanged.connect(self.load_template)
+        self.combo.setCurrentText(groove["name"] if groove else "Straight")
+        self.load_template(self.combo.currentText())
+        if groove: self._show(groove)
+
+    def load_template(self, name):
+        self._show(make_groove(dict(self.templates.get(name, {}), name=name)) or dict(GROOVE_DEFAULTS, name=name))
+
+    def _show(self, g):
+        self.sp_swing.setValue(g["swing"])
+        self.combo_grid.setCurrentText(g["swing_grid"])
+        self.sp_ticks.setValue(int(g["humanize"]["ticks"]))
+        self.sp_vel.setValue(int(round(g["humanize"]["velocity"] * 100)))
+        tables = [f"{k}: {' '.join(f'{x:+g}' for x in v)} ticks" for k, v in g["offsets"].items()]
+        tables += [f"{k}: {' '.join(f'{x:g}' for x in v)} vel" for k, v in g["velocity"].items()]
+        self.lbl_tables.setText("Tables: " + (" | ".join(tables) if tables else "none"))
+
+    def import_file(self):
+        from PySide6.QtWidgets import QFileDialog
+        path, _ = QFileDialog.getOpenFileName(self, "Import Groove", "", "Groove Template (*.json)")
+        if not path: return
+        try:
+            with open(path, 'r', encoding='utf-8') as f: t = json.load(f)
+            t.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+            make_groove(t)
+        except Exception as e:
+            self.lbl_tables.setText(f"Import failed: {str(e)[:60]}"); return
+        self.templates[t["name"]] = t
+        if self.combo.findText(t["name"]) < 0: self.combo.addItem(t["name"])
+        self.combo.setCurrentText(t["name"]); self.load_template(t["name"])
+
+    def get_groove(self):
+        name = self.combo.currentText()
+        t = dict(self.templates.get(name, {}), name=name, swing=self.sp_swing.value(), swing_grid=self.combo_grid.currentText())
+        t["humanize"] = dict(GROOVE_DEFAULTS["humanize"], **t.get("humanize", {}), ticks=self.sp_ticks.value(), velocity=self.sp_vel.value() / 100.0)
+        return make_groove(t)
+
+class VisualOffsetDialog(QDialog):
+    # 振り子表示のデバイス別オフセット (ms)。+ で表示を遅らせる。値を動かすとその場で反映 (Cancel で元に戻す)
+    def __init__(self, parent=None, device="", offset_ms=0, latency_ms=0.0, on_change=None):
+        super().__init__(parent)
+        self.setWindowTitle("Visual Offset")
+        self.resize(300, 170)
+        self.setStyleSheet("""
+            QDialog { background: #222; color: #eee; }
+            QLabel { color: #ccc; font-weight: bold; font-size: 11px; }
+            QSpinBox { background: #333; color: #eee; padding: 4px; border-radius: 4px; font-size: 13px; }
+            QPushButton { background: #007acc; color: white; font-weight: bold; padding: 8px; border-radius: 4px; }
+        """)
+        layout = QVBoxLayout(self)
+        layout.addWidget(QLabel(f"DEVICE: {device}"))
+        layout.addWidget(QLabel(f"MEASURED OUTPUT LATENCY: {latency_ms:.1f} ms"))
+        grid = QGridLayout()
+        grid.addWidget(QLabel("OFFSET (ms, + = later):"), 0, 0)
+        self.sp = QSpinBox()
+        self.sp.setRange(-300, 300)
+        self.sp.setValue(int(offset_ms))
+        if on_change: self.sp.valueChanged.connect(on_change)
+        grid.addWidget(self.sp, 0, 1)
+        layout.addLayout(grid)
+        layout.addStretch()
+        btn_layout = QHBoxLayout()
+        btn_ok = QPushButton("OK")
+        btn_ok.clicked.connect(self.accept)
+        btn_cancel = QPushButton("Cancel")
+        btn_cancel.setStyleSheet("background: #555;")
+        btn_cancel.clicked.connect(self.reject)
+        btn_layout.addWidget(btn_ok)
+        btn_layout.addWidget(btn_cancel)
+        layout.addLayout(btn_layout)
+
+    def get_offset(self): return self.sp.value()
+
+class VoiceCueDialog(QDialog):
+    def __init__(self, parent=None, params=None, cue_dir="", lang="", cache_mb=32):
+        super().__init__(parent)
+        self.setWindowTitle("Voice Cues")
+        self.resize(340, 300)
+        self.setStyleSheet("""
+            QDialog { background: #222; color: #eee; }
+            QLabel { color: #ccc; font-weight: bold; font-size: 11px; }
+            QCheckBox { color: #ffcc00; font-weight: bold; font-size: 12px; }
+            QSpinBox, QComboBox, QLineEdit { background: #333; color: #eee; padding: 4px; border-radius: 4px; font-size: 13px; }
+            QPushButton { background: #007acc; color: white; font-weight: bold; padding: 8px; border-radius: 4px; }
+        """)
+        params = params if params else {}
+        layout = QVBoxLayout(self)
+        grid = QGridLayout()
+        grid.addWidget(QLabel("COUNT-IN BARS:"), 0, 0)
+        self.sp_count = QSpinBox()
+        self.sp_count.setRange(0, 4)
+        self.sp_count.setValue(params.get("count_in", 0))
+        grid.addWidget(self.sp_count, 0, 1)
+        grid.addWidget(QLabel("CUE VOLUME %:"), 1, 0)
+        self.sp_vol = QSpinBox()
+        self.sp_vol.setRange(0, 200)
+        self.sp_vol.setValue(int(round(params.get("v_cue", 1.0) * 100)))
+        grid.addWidget(self.sp_vol, 1, 1)
+        layout.addLayout(grid)
+        self.chk_bars = QCheckBox("Speak bar numbers in MUTE bars")
+        self.chk_bars.setChecked(params.get("cue_bars", False))
+        layout.addWidget(self.chk_bars)
+        self.chk_sections = QCheckBox("Announce song sections (1 bar ahead)")
+        self.chk_sections.setChecked(params.get("cue_sections", True))
+        layout.addWidget(self.chk_sections)
+        lib = QGridLayout()
+        lib.addWidget(QLabel("LIBRARY:"), 0, 0)
+        self.ed_dir = QLineEdit(cue_dir)
+        lib.addWidget(self.ed_dir, 0, 1)
+        btn_browse = QPushButton("...")
+        btn_browse.setFixedWidth(36)
+        btn_browse.clicked.connect(self.browse)
+        lib.addWidget(btn_browse, 0, 2)
+        lib.addWidget(QLabel("LANGUAGE:"), 1, 0)
+        self.combo_lang = QComboBox()
+        lib.addWidget(self.combo_lang, 1, 1, 1, 2)
+        lib.addWidget(QLabel("CACHE MB:"), 2, 0)
+        self.sp_cache = QSpinBox()
+        self.sp_cache.setRange(1, 1024)
+        self.sp_cache.setValue(int(cache_mb))
+        lib.addWidget(self.sp_cache, 2, 1, 1, 2)
+        layout.addLayout(lib)
+        self._fill_langs(lang)
+        self.ed_dir.editingFinished.connect(lambda: self._fill_langs(self.combo_lang.currentData() or ""))
+        info = QLabel("Files: <library>/<language>/<word>.wav — 1..16, ready, go, section names.\nMissing words fall back to clicks (count-in) or stay silent.")
+        info.setStyleSheet("color: #777; font-size: 9px; font-weight: normal;")
+        info.setWordWrap(True)
+        layout.addWidget(info)
+        layout.addStretch()
+        btn_layout = QHBoxLayout()
+        btn_ok = QPushButton("OK")
+        btn_ok.clicked.connect(self.accept)
+        btn_cancel = QPushButton("Cancel")
+        btn_cancel.setStyleSheet("background: #555;")
+        btn_cancel.clicked.connect(self.reject)
+        btn_layout.addWidget(btn_ok)
+        btn_layout.addWidget(btn_cancel)
+        layout.addLayout(btn_layout)
+
+    def _fill_langs(self, current):
+        self.combo_lang.clear()
+        self.combo_lang.addItem("(none)", "")
+        for lang in CueLibrary.languages(self.ed_dir.text()):
+            self.combo_lang.addItem(lang, lang)
+            if lang == current: self.combo_lang.setCurrentIndex(self.combo_lang.count() - 1)
+
+    def browse(self):
+        from PySide6.QtWidgets import QFileDialog
+        path = QFileDialog.getExistingDirectory(self, "Select Cue Library", self.ed_dir.text())
+        if path: self.ed_dir.setText(path); self._fill_langs("")
+
+    def get_settings(self):
+        return {"count_in": self.sp_count.value(), "v_cue": self.sp_vol.value() / 100.0,
+                "cue_bars": self.chk_bars.isChecked(), "cue_sections": self.chk_sections.isChecked()}
+
+    def get_library(self):
+        return self.ed_dir.text().strip(), self.combo_lang.currentData() or "", self.sp_cache.value()
+
+class KitDialog(QDialog):
+    def __init__(self, parent=None, kit=None):
+        super().__init__(parent)
+        self.setWindowTitle("Sample Kit - WAV file per voice")
+        self.resize(460, 320)
+        self.setStyleSheet("""
+            QDialog { background: #222; color: #eee; }
+            QLabel { color: #ccc; font-size: 12px; }
+            QLineEdit { background: #333; color: #eee; padding: 4px; border-radius: 4px; font-size: 11px; }
+            QPushButton { background: #007acc; color: white; font-weight: bold; padding: 6px; border-radius: 4px; }
+        """)
+        self.kit = dict(kit) if kit else {}
+        layout = QVBoxLayout(self)
+        info_lbl = QLabel("Empty = built-in sound. Changes apply without restarting audio.")
+        info_lbl.setStyleSheet("color: #0cf; font-weight: bold; font-size: 11px; margin-bottom: 10px;")
+        layout.addWidget(info_lbl)
+
+        grid = QGridLayout()
+        self.edits = {}
+        for row, (key, label) in enumerate(zip(KIT_VOICES, ["Accent", "Backbeat", "4th", "8th", "16th", "Triplet"])):
+            edit = QLineEdit(self.kit.get(key, ""))
+            btn_browse = QPushButton("...")
+            btn_browse.setFixedWidth(36)
+            btn_browse.clicked.connect(lambda _=False, k=key: self.browse(k))
+            btn_clear = QPushButton("x")
+            btn_clear.setFixedWidth(28)
+            btn_clear.setStyleSheet("background: #555;")
+            btn_clear.clicked.connect(lambda _=False, k=key: self.edits[k].clear())
+            grid.addWidget(QLabel(label), row, 0)
+            grid.addWidget(edit, row, 1)
+            grid.addWidget(btn_browse, row, 2)
+            grid.addWidget(btn_clear, row, 3)
+            self.edits[key] = edit
+        layout.addLayout(grid)
+        layout.addStretch()
+
+        btn_layout = QHBoxLayout()
+        btn_ok = QPushButton("OK")
+        btn_ok.clicked.connect(self.accept)
+        btn_cancel = QPushButton("Cancel")
+        btn_cancel.setStyleSheet("background: #555;")
+        btn_cancel.clicked.connect(self.reject)
+        btn_layout.addWidget(btn_ok)
+        btn_layout.addWidget(btn_cancel)
+        layout.addLayout(btn_layout)
+
+    def browse(self, key):
+        from PySide6.QtWidgets import QFileDialog
+        path, _ = QFileDialog.getOpenFileName(self, "Select WAV Sample", "", "WAV Files (*.wav)")
+        if path: self.edits[key].setText(path)
+
+    def get_kit(self):
+        return {key: edit.text().strip() for key, edit in self.edits.items() if edit.text().strip()}
+
+class VoiceLayerDialog(QDialog):
+    PRESETS = [("Quintuplet", "trip", 5, 1, "0 1 1 1 1"), ("Septuplet", "trip", 7, 1, "0 1 1 1 1 1 1"),
+               ("3:2 Poly", "16th", 3, 2, "1 1 1"), ("4:3 Poly", "8th", 4, 3, "1 1 1 1")]
+
+    def __init__(self, parent=None, voices=()):
+        super().__init__(parent)
+        self.setWindowTitle("Tuplets / Polyrhythms")
+        self.resize(480, 320)
+        self.setStyleSheet(SETLIST_STYLE)
+        layout = QVBoxLayout(self)
+        info_lbl = QLabel("HITS evenly spaced over BEATS. ACCENTS: gain per hit (0 = rest).")
+        info_lbl.setStyleSheet("color: #0cf; font-weight: bold; font-size: 11px;")
+        layout.addWidget(info_lbl)
+        self.table = QTableWidget(0, 5)
+        self.table.setHorizontalHeaderLabels(["Sound", "Hits", "Beats", "Accents", "Vol %"])
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.table.setSelectionBehavior(QTableWidget.SelectRows)
+        for v in voices:
+            self.add_row(v["wave"], v["hits"], v["beats"], " ".join(f"{g:g}" for g in v.get("accents", [])), int(v.get("vol", 0.5) * 100))
+        layout.addWidget(self.table)
+
+        btn_layout = QGridLayout()
+        self.combo_preset = QComboBox()
+        self.combo_preset.addItems([pr[0] for pr in self.PRESETS])
+        btn_add = QPushButton("+ Add Preset")
+        btn_add.clicked.connect(lambda: self.add_row(*self.PRESETS[self.combo_preset.currentIndex()][1:], 50))
+        btn_del = QPushButton("- Remove Selected")
+        btn_del.clicked.connect(lambda: self.table.removeRow(self.table.currentRow()))
+        btn_ok = QPushButton("OK")
+        btn_ok.setStyleSheet("background: #007acc; color: white; font-weight: bold;")
+        btn_ok.clicked.connect(self.accept)
+        btn_cancel = QPushButton("Cancel")
+        btn_cancel.setStyleSheet("background: #555; color: #ddd; font-weight: bold;")
+        btn_cancel.clicked.connect(self.reject)
+        btn_layout.addWidget(self.combo_preset, 0, 0)
+        btn_layout.addWidget(btn_add, 0, 1)
+        btn_layout.addWidget(btn_del, 0, 2)
+        btn_layout.addWidget(btn_ok, 1, 1)
+        btn_layout.addWidget(btn_cancel, 1, 2)
+        layout.addLayout(btn_layout)
+
+    def add_row(self, wave, hits, beats, accents, vol):
+        row = self.table.rowCount()
+        self.table.insertRow(row)
+        combo = QComboBox()
+        combo.addItems(KIT_VOICES)
+        combo.setCurrentText(wave)
+        self.table.setCellWidget(row, 0, combo)
+        for col, val in enumerate([hits, beats, accents, vol], 1):
+            self.table.setItem(row, col, QTableWidgetItem(str(val)))
+
+    def get_voices(self):
+        voices = []
+        for i in range(self.table.rowCount()):
+            try:
+                hits, beats = int(self.table.item(i, 1).text()), int(self.table.item(i, 2).text())
+                accents = [float(x) for x in self.table.item(i, 3).text().split()] or [1.0] * hits
+                vol = max(0, min(100, int(self.table.item(i, 4).text()))) / 100.0
+                if hits < 1 or beats < 1: continue
+                voices.append({"wave": self.table.cellWidget(i, 0).currentText(), "hits": hits, "beats": beats, "accents": accents, "vol": vol})
+            except: continue
+        return voices
+
+class RoutingDialog(QDialog):
+    def __init__(self, parent=None, routing=None, n_channels=2, headroom=None):
+        super().__init__(parent)
+        self.setWindowTitle("Output Routing")
+        self.resize(500, 360)
+        self.setStyleSheet(SETLIST_STYLE)
+        routing, headroom = routing or {}, headroom or {}
+        layout = QVBoxLayout(self)
+        info_lbl = QLabel(f"Device outputs: {n_channels}ch. Channels: e.g. '1,2' (pair = stereo pan) or '5'.")
+        info_lbl.setStyleSheet("color: #0cf; font-weight: bold; font-size: 11px;")
+        layout.addWidget(info_lbl)
+        labels = {"acc": "Accent", "backbeat": "Backbeat", "4th": "4th", "8th": "8th", "16th": "16th", "trip": "Triplet", "cue": "Cue",
+                  "track_l": "Track L", "track_r": "Track R"}
+        self.table = QTableWidget(len(BUS_NAMES), 4)
+        self.table.setHorizontalHeaderLabels(["Channels", "Gain %", "Pan (-100..100)", "Headroom dB"])
+        self.table.setVerticalHeaderLabels([labels.get(b, b) for b in BUS_NAMES])
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        for i, name in enumerate(BUS_NAMES):
+            r = routing.get(name, BUS_DEFAULT_ROUTING.get(name, {}))
+            self.table.setItem(i, 0, QTableWidgetItem(",".join(str(c + 1) for c in r.get("ch", [0, 1]))))
+            self.table.setItem(i, 1, QTableWidgetItem(str(int(round(r.get("gain", 1.0) * 100)))))
+            self.table.setItem(i, 2, QTableWidgetItem(str(int(round(r.get("pan", 0.0) * 100)))))
+            self.table.setItem(i, 3, QTableWidgetItem(f"{headroom.get(name, 0.0):g}"))
+        layout.addWidget(self.table)
+        btn_layout = QHBoxLayout()
+        btn_ok = QPushButton("OK")
+        btn_ok.setStyleSheet("background: #007acc; color: white; font-weight: bold;")
+        btn_ok.clicked.connect(self.accept)
         btn_cancel = QPushButton("Cancel")
-        btn_cancel.setStyleSheet("background: #555;")
+        btn_cancel.setStyleSheet("background: #555; color: #ddd; font-weight: bold;")
         btn_cancel.clicked.connect(self.reject)
         btn_layout.addWidget(btn_ok)
         btn_layout.addWidget(btn_cancel)
         layout.addLayout(btn_layout)
 
-    def validate_and_accept(self):
-        if self.sp_p_min.value() > self.sp_p_max.value():
-            self.sp_p_max.setValue(self.sp_p_min.value())
-        if self.sp_m_min.value() > self.sp_m_max.value():
-            self.sp_m_max.setValue(self.sp_m_min.value())
-        self.accept()
+    def get_routing(self):
+        routing = {}
+        for i, name in enumerate(BUS_NAMES):
+            try:
+                chs = [int(c) - 1 for c in self.table.item(i, 0).text().replace(" ", "").split(",") if c]
+                routing[name] = {"ch": [c for c in chs if c >= 0] or [0], "gain": max(0, int(self.table.item(i, 1).text())) / 100.0,
+                                 "pan": max(-100, min(100, int(self.table.item(i, 2).text()))) / 100.0}
+            except: continue
+        return routing
 
-    def get_ranges(self):
-        return {
-            "rnd_play_min": self.sp_p_min.value(),
-            "rnd_play_max": self.sp_p_max.value(),
-            "rnd_mute_min": self.sp_m_min.value(),
-            "rnd_mute_max": self.sp_m_max.value()
-        }
+    def get_headroom(self):
+        headroom = {}
+        for i, name in enumerate(BUS_NAMES):
+            try: headroom[name] = float(self.table.item(i, 3).text())
+            except: continue
+        return parse_headroom(headroom)
+
+class LayersDialog(QDialog):
+    COLUMNS = [("Name", "name"), ("BPM", "bpm"), ("Beats", "bpb"), ("Play", "play"), ("Mute", "mute"), ("Acc %", "v_acc"), ("4th %", "v_4th")]
+
+    def __init__(self, parent=None, layers=()):
+        super().__init__(parent)
+        self.setWindowTitle("Metronome Layers")
+        self.resize(620, 320)
+        self.setStyleSheet(SETLIST_STYLE)
+        layout = QVBoxLayout(self)
+        info_lbl = QLabel("Extra layers run against the main click on the same clock. SOUND replaces Accent/4th.")
+        info_lbl.setStyleSheet("color: #0cf; font-weight: bold; font-size: 11px;")
+        layout.addWidget(info_lbl)
+        self.table = QTableWidget(0, len(self.COLUMNS) + 2)
+        self.table.setHorizontalHeaderLabels([c[0] for c in self.COLUMNS] + ["Sound", "On"])
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.table.setSelectionBehavior(QTableWidget.SelectRows)
+        for l in layers: self.add_row({**LAYER_DEFAULTS, **l})
+        layout.addWidget(self.table)
+        btn_layout = QGridLayout()
+        btn_add = QPushButton("+ Add Layer")
+        btn_add.clicked.connect(lambda: self.add_row(dict(LAYER_DEFAULTS, name=f"Layer {self.table.rowCount() + 2}")))
+        btn_del = QPushButton("- Remove Selected")
+        btn_del.clicked.connect(lambda: self.table.removeRow(self.table.currentRow()))
+        btn_ok = QPushButton("OK")
+        btn_ok.setStyleSheet("background: #007acc; color: white; font-weight: bold;")
+        btn_ok.clicked.connect(self.accept)
+        btn_cancel = QPushButton("Cancel")
+        btn_cancel.setStyleSheet("background: #555; color: #ddd; font-weight: bold;")
+        btn_cancel.clicked.connect(self.reject)
+        btn_layout.addWidget(btn_add, 0, 0)
+        btn_layout.addWidget(btn_del, 0, 1)
+        btn_layout.addWidget(btn_ok, 1, 0)
+        btn_layout.addWidget(btn_cancel, 1, 1)
+        layout.addLayout(btn_layout)
+
+    def add_row(self, l):
+        row = self.table.rowCount()
+        self.table.insertRow(row)
+        for col, (_, key) in enumerate(self.COLUMNS):
+            val = int(round(l[key] * 100)) if key.startswith("v_") else l[key]
+            self.table.setItem(row, col, QTableWidgetItem(str(val)))
+        self.table.item(row, 0).setData(Qt.UserRole, dict(l)) # 表に出さないキー (voices, v_8th 等) を保持
+        combo = QComboBox()
+        combo.addItems(["(default)"] + KIT_VOICES)
+        combo.setCurrentText(l.get("sound") or "(default)")
+        self.table.setCellWidget(row, len(self.COLUMNS), combo)
+        on_item = QTableWidgetItem()
+        on_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsUserCheckable)
+        on_item.setCheckState(Qt.Checked if l.get("enabled", True) else Qt.Unchecked)
+        self.table.setItem(row, len(self.COLUMNS) + 1, on_item)
+
+    def get_layers(self):
+        layers = []
+        for i in range(self.table.rowCount()):
+            try:
+                l = {k: v for k, v in (self.table.item(i, 0).data(Qt.UserRole) or {}).items() if LAYER_DEFAULTS.get(k) != v and k != "rnd_plan"}
+                l["name"] = self.table.item(i, 0).text()
+                for col, (_, key) in enumerate(self.COLUMNS[1:], 1):
+                    val = int(self.table.item(i, col).text())
+                    l[key] = max(0, min(100, val)) / 100.0 if key.startswith("v_") else val
+                if not (20 <= l["bpm"] <= 400 and 1 <= l["bpb"] <= 16 and l["play"] >= 1 and l["mute"] >= 0): continue
+                snd = self.table.cellWidget(i, len(self.COLUMNS)).currentText()
+                l["sound"] = "" if snd == "(default)" else snd
+                l["enabled"] = self.table.item(i, len(self.COLUMNS) + 1).checkState() == Qt.Checked
+                layers.append(l)
+            except: continue
+        return layers
 
 class LogWindow(QWidget):
     def __init__(self, parent=None):
         super().__init__()
         self.setWindowTitle("InnerPulse Log")
         self.resize(450, 350)
+        self.parent_app = parent
+        self.text = None
+        self.pending = collections.deque(maxlen=5000) # 初めて開くまで QTextEdit は作らず行だけ溜める
+
+    def _build(self):
         self.setStyleSheet("background: #111; color: #0f0; font-family: 'Courier New', monospace;")
         layout = QVBoxLayout(self)
         self.text = QTextEdit()
         self.text.setReadOnly(True)
         layout.addWidget(self.text)
-        self.parent_app = parent
+        self.text.setPlainText("\n".join(self.pending)); self.pending.clear()
 
-    def log(self, msg): self.text.append(msg); self.text.ensureCursorVisible()
+    def log(self, msg):
+        if self.text is None: self.pending.append(msg); return
+        self.text.append(msg); self.text.ensureCursorVisible()
 
     def toggle(self):
         if self.isVisible():
             self.hide()
         else:
+            if self.text is None: self._build()
             self.show()
             self.raise_()
 
+class LevelMeter(QWidget):
+    # マスターのピーク/RMS (dBFS) と リミッタ動作表示。poll_queue から 10ms ごとに set_levels
+    def __init__(self, floor_db=-48.0):
+        super().__init__()
+        self.setFixedSize(10, 120)
+        self.floor_db = floor_db
+        self.peak = self.rms = self.hold = 0.0
+        self.hold_n = self.clip_n = 0
+
+    def set_levels(self, peak, rms, gr):
+        self.peak = max(peak, self.peak * 0.85)
+        self.rms = max(rms, self.rms * 0.85)
+        if peak >= self.hold or self.hold_n <= 0: self.hold, self.hold_n = peak, 100
+        else: self.hold_n -= 1
+        self.clip_n = 50 if gr > 0 else max(0, self.clip_n - 1)
+        self.update()
+
+    def _y(self, v):
+        db = 20.0 * math.log10(v) if v > 0 else self.floor_db
+        return int((self.height() - 4) * min(1.0, max(0.0, db / self.floor_db))) + 4
+
+    def paintEvent(self, event):
+        p = QPainter(self)
+        w, h = self.width(), self.height()
+        p.fillRect(0, 4, w, h - 4, QColor("#2d2d30"))
+        p.fillRect(0, 0, w, 3, QColor("#d32f2f") if self.clip_n else QColor("#333"))
+        p.fillRect(1, self._y(self.rms), w - 2, h, QColor("#005c99"))
+        y = self._y(self.peak)
+        p.fillRect(w // 2, y, w - w // 2 - 1, h - y, QColor("#0cf"))
+        p.fillRect(0, self._y(self.hold), w, 1, QColor("#fc0") if self.hold < 1.0 else QColor("#d32f2f"))
+
 class VisualizerWidget(QWidget):
     def __init__(self):
         super().__init__()
@@ -603,16 +2717,27 @@ class VisualizerWidget(QWidget):
         self.bpb = 4
         self.mode = "BAR"
         self.dark_mode = True
+        self.frame_times = collections.deque(maxlen=240)
+        self.paint_hook = None # 描画要求から paintEvent までの遅れ (秒) を受け取る
+        self._dirty_t = None
 
     def update_pos(self, pos, mute, bpb):
         self.pos = pos
         self.mute = mute
         self.bpb = bpb
+        if self._dirty_t is None: self._dirty_t = time.perf_counter()
         self.update()
 
     def reset_pos(self): self.pos = -1.0; self.update()
     def set_mode(self, mode): self.mode = mode; self.update()
     def paintEvent(self, event):
+        t0 = time.perf_counter()
+        if self._dirty_t is not None and self.paint_hook: self.paint_hook(t0 - self._dirty_t)
+        self._dirty_t = None
+        self._paint()
+        self.frame_times.append(time.perf_counter() - t0)
+
+    def _paint(self):
         p = QPainter(self)
         p.setRenderHint(QPainter.Antialiasing)
         
@@ -709,6 +2834,386 @@ class VisualizerWidget(QWidget):
         p.setPen(col if is_active else text_col)
         p.drawText(text_rect, Qt.AlignCenter, txt)
 
+def frame_stats(times):
+    if not times: return {"n": 0, "mean_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+    t = np.sort(np.fromiter(times, dtype=np.float64)) * 1000.0
+    return {"n": len(t), "mean_ms": float(t.mean()), "p95_ms": float(t[int(0.95 * (len(t) - 1))]), "max_ms": float(t[-1])}
+
+class SceneVisualizerWidget(QGraphicsView):
+    # VisualizerWidget と同じ見た目を保持型シーンで描く。アイテムは一度だけ作り、
+    # フレームごとは振り子の回転と色/表示の切り替えだけ。グロー (グラデーション) はデバイス座標でキャッシュ
+    def __init__(self, use_gl=True):
+        super().__init__()
+        self.setMinimumHeight(200)
+        self.pos = -1.0
+        self.mute = False
+        self.bpb = 4
+        self.mode = "BAR"
+        self.dark_mode = True
+        self.frame_times = collections.deque(maxlen=240)
+        self.paint_hook = None
+        self._dirty_t = None
+        self.use_gl = False
+        if use_gl:
+            try:
+                # GL コンテキストが作れない環境 (offscreen/リモート等) ではラスタのまま
+                from PySide6.QtGui import QOpenGLContext
+                from PySide6.QtOpenGLWidgets import QOpenGLWidget
+                if QOpenGLContext().create():
+                    self.setViewport(QOpenGLWidget())
+                    self.use_gl = True
+            except Exception: pass
+        self.setViewportUpdateMode(QGraphicsView.FullViewportUpdate if self.use_gl else QGraphicsView.SmartViewportUpdate)
+        self.setRenderHint(QPainter.Antialiasing)
+        self.setFrameShape(QFrame.NoFrame)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setBackgroundBrush(QColor("#181818"))
+        self.scene_ = QGraphicsScene(self)
+        self.setScene(self.scene_)
+        self._state = None
+        self._build()
+
+    def _build(self):
+        sc = self.scene_
+        if self.dark_mode:
+            self.bg_inactive, arc_col, self.text_col, glow_alpha = QColor("#2d2d30"), QColor("#333"), QColor("#888"), 100
+            self.cols = {False: QColor("#007acc"), True: QColor("#d32f2f")}
+        else:
+            self.bg_inactive, arc_col, self.text_col, glow_alpha = QColor("#e0e0e0"), QColor("#ddd"), QColor("#666"), 80
+            self.cols = {False: QColor("#007acc"), True: QColor("#f44336")}
+
+        def glow_brush(col, radius):
+            g = QRadialGradient(0, 0, radius)
+            g.setColorAt(0, QColor(col.red(), col.green(), col.blue(), glow_alpha))
+            g.setColorAt(1, Qt.transparent)
+            return QBrush(g)
+        self.glow = {m: glow_brush(c, 30) for m, c in self.cols.items()}
+        self.led_glow = {m: glow_brush(c, 36) for m, c in self.cols.items()}
+
+        # BAR: 円弧 + 支点 + 振り子 (支点を原点にした子アイテムを回転させる)
+        self.bar_root = sc.addRect(QRectF(), Qt.NoPen)
+        path = QPainterPath()
+        rect = QRectF(-120, -120, 240, 240)
+        path.arcMoveTo(rect, 60); path.arcTo(rect, 60, 60)
+        arc = QGraphicsPathItem(path, self.bar_root)
+        arc.setPen(QPen(arc_col, 5, Qt.SolidLine, Qt.RoundCap))
+        self.pendulum = QGraphicsRectItem(QRectF(), self.bar_root)
+        self.pendulum.setPen(Qt.NoPen)
+        self.rod = QGraphicsLineItem(0, 0, 0, -120, self.pendulum)
+        self.ball_glow = QGraphicsEllipseItem(-30, -30, 60, 60, self.pendulum)
+        self.ball_glow.setPos(0, -120)
+        self.ball_glow.setPen(Qt.NoPen)
+        self.ball_glow.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+        self.ball = QGraphicsEllipseItem(-12, -132, 24, 24, self.pendulum)
+        self.ball.setPen(Qt.NoPen)
+        pivot = QGraphicsEllipseItem(-4, -4, 8, 8, self.bar_root)
+        pivot.setPen(Qt.NoPen); pivot.setBrush(QColor("#555"))
+
+        # LED: 4 ドット。各ドットは 待機/グロー/コア の 3 アイテムを表示切り替えするだけ
+        self.led_root = sc.addRect(QRectF(), Qt.NoPen)
+        self.leds = []
+        for i in range(4):
+            x = (i - 1.5) * 60
+            idle = QGraphicsEllipseItem(x - 12, -12, 24, 24, self.led_root)
+            glow = QGraphicsEllipseItem(-54, -54, 108, 108, self.led_root)
+            glow.setPos(x, 0)
+            glow.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+            core = QGraphicsEllipseItem(x - 18, -18, 36, 36, self.led_root)
+            for it in (idle, glow, core): it.setPen(Qt.NoPen)
+            idle.setBrush(self.bg_inactive)
+            self.leds.append((idle, glow, core))
+
+        self.text = QGraphicsSimpleTextItem()
+        self.text.setFont(QFont("Segoe UI", 32, QFont.Bold))
+        sc.addItem(self.text)
+        self._layout_items()
+
+    def _layout_items(self):
+        w, h = max(1, self.viewport().width()), max(200, self.viewport().height())
+        self.scene_.setSceneRect(0, 0, w, h)
+        cx, cy = w / 2, 160
+        self.bar_root.setPos(cx, cy)
+        self.led_root.setPos(cx, 100)
+        self._text_box = QRectF(0, cy + 40, w, 60)
+        self._state = None
+        self._sync()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._layout_items()
+
+    def paintEvent(self, event):
+        t0 = time.perf_counter()
+        if self._dirty_t is not None and self.paint_hook: self.paint_hook(t0 - self._dirty_t)
+        self._dirty_t = None
+        super().paintEvent(event)
+        self.frame_times.append(time.perf_counter() - t0)
+
+    def update_pos(self, pos, mute, bpb):
+        self.pos = pos
+        self.mute = mute
+        self.bpb = bpb
+        if self._dirty_t is None: self._dirty_t = time.perf_counter()
+        self._sync()
+
+    def reset_pos(self): self.pos = -1.0; self._sync()
+    def set_mode(self, mode): self.mode = mode; self._sync()
+
+    def _sync(self):
+        is_active = self.pos >= 0
+        beat = int(self.pos) % self.bpb if is_active else -1
+        txt = ("MUTE" if self.mute else str(beat + 1)) if is_active else "STOP"
+        state = (self.mode, is_active, self.mute, beat, txt)
+        if state != self._state:
+            # 色・表示・文字の切り替えは状態が変わったときだけ
+            self._state = state
+            col = self.cols[self.mute]
+            bar = self.mode == "BAR"
+            self.bar_root.setVisible(bar); self.led_root.setVisible(not bar)
+            self.rod.setVisible(is_active); self.ball_glow.setVisible(is_active)
+            self.rod.setPen(QPen(col, 3, Qt.SolidLine, Qt.RoundCap))
+            self.ball_glow.setBrush(self.glow[self.mute])
+            self.ball.setBrush(col if is_active else self.bg_inactive)
+            for i, (idle, glow, core) in enumerate(self.leds):
+                on = i == beat
+                idle.setVisible(not on); glow.setVisible(on); core.setVisible(on)
+                if on: glow.setBrush(self.led_glow[self.mute]); core.setBrush(col)
+            self.text.setText(txt)
+            self.text.setBrush(col if is_active else self.text_col)
+            br = self.text.boundingRect()
+            self.text.setPos(self._text_box.center().x() - br.width() / 2, self._text_box.center().y() - br.height() / 2)
+        # フレームごとの仕事は振り子の回転だけ
+        self.pendulum.setRotation(30 * math.cos(self.pos * math.pi) if is_active and self.mode == "BAR" else 0)
+
+def make_visualizer(renderer):
+    if renderer == "painter": return VisualizerWidget()
+    return SceneVisualizerWidget(use_gl=(renderer == "gl"))
+
+# ==========================================
+#  UI Stall Watchdog
+# ==========================================
+class StallWatchdog:
+    # UI スレッドの詰まり検出。poll_queue の QTimer (beat) と描画 (paint) の遅れを測り、閾値超えを履歴に残す。
+    # 詰まっている最中のメインスレッドのスタックは横のスレッドから sys._current_frames() で採る
+    def __init__(self, threshold_ms=80.0, interval_ms=10.0, history=200):
+        self.threshold = threshold_ms / 1000.0
+        self.interval = interval_ms / 1000.0
+        self.history = collections.deque(maxlen=history)
+        self.main_id = threading.main_thread().ident
+        self.last_beat = time.perf_counter()
+        self.samples = [] # 詰まり中のスタック (横スレッドが積み、次の beat で回収)
+        self.lock = threading.Lock()
+        self.on_stall = None
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._watch, daemon=True)
+        self.thread.start()
+
+    def _watch(self):
+        import traceback
+        while not self._stop.wait(self.interval):
+            if time.perf_counter() - self.last_beat - self.interval <= self.threshold: continue
+            frame = sys._current_frames().get(self.main_id)
+            if frame is None: continue
+            stack = [f"{os.path.basename(f.filename)}:{f.lineno} {f.name}" for f in traceback.extract_stack(frame)]
+            with self.lock:
+                if len(self.samples) < 50: self.samples.append(stack)
+
+    def beat(self):
+        now = time.perf_counter()
+        late, self.last_beat = now - self.last_beat - self.interval, now
+        with self.lock: samples, self.samples = self.samples, []
+        if late > self.threshold: self._record("timer", late, samples)
+
+    def paint(self, lag):
+        if lag <= self.threshold: return
+        with self.lock: samples = list(self.samples)
+        self._record("paint", lag, samples)
+
+    def _record(self, kind, late, samples):
+        # 一番多く採れた最内フレームを「どこで詰まったか」とする
+        where = collections.Counter(st[-1] for st in samples).most_common(1)[0][0] if samples else "?"
+        rec = {"t": time.time(), "kind": kind, "late_ms": late * 1000.0, "where": where, "samples": len(samples),
+               "stack": samples[-1][-12:] if samples else []}
+        self.history.append(rec)
+        if self.on_stall: self.on_stall(rec)
+
+    def set_interval(self, interval_ms):
+        # ポーリング間隔を変えたとき (アイドル) に、遅れの基準も合わせる
+        self.interval = interval_ms / 1000.0; self.last_beat = time.perf_counter()
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f: json.dump(list(self.history), f, indent=2)
+
+    def stop(self): self._stop.set()
+
+# ==========================================
+#  Input Bindings
+# ==========================================
+# コマンド名 -> キー (QKeySequence の文字列, "" = 割り当てなし)。config の "keymap" で上書き
+KEYMAP_DEFAULTS = {"toggle": "Space", "mute_off": "M", "log": "L", "rnd": "R", "prev_song": "Left", "next_song": "Right",
+                   "bpm_up": "", "bpm_down": ""}
+# 外部コントローラ: "midi" は "note:36" / "cc:64" -> コマンド (cc は 64 以上への立ち上がりで発火、値コマンドなら 0..127 を 0..1 に)、
+# "hid" は evdev のキー名 ("KEY_A", "BTN_0" など) -> コマンド
+CONTROLLER_DEFAULTS = {"midi_port": "", "hid_device": "", "midi": {}, "hid": {}}
+
+class ControllerInput(QObject):
+    # MIDI 入力 (mido) と evdev のフットペダルをそれぞれのスレッドで読み、command シグナルで UI スレッドへ渡す
+    # (キューイング接続なので UI 側のハンドラはメインスレッドで走る。UI イベントの横取りはしない)
+    command = Signal(str, float, bool) # (コマンド, 値 0..1, 押下の立ち上がりか)
+
+    def __init__(self, cfg, log):
+        super().__init__()
+        self.cfg, self.log = cfg, log
+        self.midi_in, self.hid = None, None
+        self._cc = {}
+        self._stop = threading.Event()
+        if cfg.get("midi_port"):
+            try:
+                import mido
+                self.midi_in = mido.open_input(cfg["midi_port"], callback=self._on_midi)
+            except Exception as e: log(f"[INPUT] MIDI {cfg['midi_port']}: {str(e)[:60]}")
+        if cfg.get("hid_device"):
+            try:
+                import evdev
+                self.hid = evdev.InputDevice(cfg["hid_device"])
+                threading.Thread(target=self._hid_loop, daemon=True).start()
+            except Exception as e: log(f"[INPUT] HID {cfg['hid_device']}: {str(e)[:60]}")
+
+    def _on_midi(self, msg):
+        m = self.cfg.get("midi", {})
+        if msg.type == "note_on" and msg.velocity > 0:
+            cmd = m.get(f"note:{msg.note}")
+            if cmd: self.command.emit(cmd, msg.velocity / 127.0, True)
+        elif msg.type == "control_change":
+            cmd = m.get(f"cc:{msg.control}")
+            if not cmd: return
+            was = self._cc.get(msg.control, 0); self._cc[msg.control] = msg.value
+            # 値コマンド (フェーダー) は毎回の値で、トリガーは 64 をまたいだ立ち上がりだけで動く
+            self.command.emit(cmd, msg.value / 127.0, was < 64 <= msg.value)
+
+    def _hid_loop(self):
+        import evdev
+        m = self.cfg.get("hid", {})
+        try:
+            for ev in self.hid.read_loop():
+                if self._stop.is_set(): break
+                if ev.type != evdev.ecodes.EV_KEY or ev.value != 1: continue
+                names = evdev.ecodes.KEY.get(ev.code) or evdev.ecodes.BTN.get(ev.code) or ()
+                for name in (names if isinstance(names, list) else [names]):
+                    if name in m: self.command.emit(m[name], 1.0, True); break
+        except OSError as e:
+            if not self._stop.is_set(): self.log(f"[INPUT] HID: {str(e)[:60]}")
+
+    def close(self):
+        self._stop.set()
+        if self.midi_in: self.midi_in.close()
+        if self.hid: self.hid.close()
+
+class _SpinHotkeys(QObject):
+    # BPM/BEATS/PLAY/MUTE のスピンボックスでも割り当て済みキーはショートカットとして通す
+    # (QLineEdit が ShortcutOverride で文字キーを取ってしまうのを、割り当て済みのキーだけ譲らせる)
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.keys = set()
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.ShortcutOverride and QKeySequence(event.keyCombination()).toString() in self.keys:
+            event.ignore(); return True
+        return False
+
+class BindingsDialog(QDialog):
+    def __init__(self, parent=None, commands=None, keymap=None, controllers=None, reserved=None):
+        super().__init__(parent)
+        self.setWindowTitle("Key && Controller Bindings")
+        self.resize(460, 440)
+        self.setStyleSheet("""
+            QDialog { background: #222; color: #eee; }
+            QLabel { color: #ccc; font-weight: bold; font-size: 11px; }
+            QTableWidget { background: #2a2a2a; color: #eee; gridline-color: #444; font-size: 11px; }
+            QHeaderView::section { background: #333; color: #ccc; border: none; padding: 4px; }
+            QLineEdit, QComboBox { background: #333; color: #eee; padding: 4px; border-radius: 4px; font-size: 12px; }
+            QPushButton { background: #007acc; color: white; font-weight: bold; padding: 8px; border-radius: 4px; }
+        """)
+        from PySide6.QtWidgets import QKeySequenceEdit
+        commands, keymap, controllers = commands or {}, keymap or {}, controllers or CONTROLLER_DEFAULTS
+        self.labels, self.reserved = {n: c[0] for n, c in commands.items()}, reserved or {}
+        layout = QVBoxLayout(self)
+        self.table = QTableWidget(len(commands), 3)
+        self.table.setHorizontalHeaderLabels(["Command", "Key", "Controller (note:N, cc:N, KEY_X)"])
+        self.table.horizontalHeader().setSectionResizeMode(2, QHeaderView.Stretch)
+        self.table.verticalHeader().setVisible(False)
+        ctl = {}
+        for src in ("midi", "hid"):
+            for k, cmd in controllers.get(src, {}).items(): ctl.setdefault(cmd, []).append(k)
+        self.keys = {}
+        for row, (name, (label, _, _)) in enumerate(commands.items()):
+            item = QTableWidgetItem(label); item.setData(Qt.UserRole, name); item.setFlags(Qt.ItemIsEnabled)
+            self.table.setItem(row, 0, item)
+            ed = QKeySequenceEdit(QKeySequence(keymap.get(name, "")))
+            self.table.setCellWidget(row, 1, ed); self.keys[name] = ed
+            self.table.setItem(row, 2, QTableWidgetItem(", ".join(ctl.get(name, []))))
+        layout.addWidget(self.table)
+        grid = QGridLayout()
+        grid.addWidget(QLabel("MIDI INPUT:"), 0, 0)
+        self.combo_midi = QComboBox()
+        self.combo_midi.addItem("(none)", "")
+        try:
+            import mido
+            for p in mido.get_input_names(): self.combo_midi.addItem(p, p)
+        except Exception: pass
+        if controllers.get("midi_port") and self.combo_midi.findData(controllers["midi_port"]) < 0: self.combo_midi.addItem(controllers["midi_port"], controllers["midi_port"])
+        self.combo_midi.setCurrentIndex(max(0, self.combo_midi.findData(controllers.get("midi_port", ""))))
+        grid.addWidget(self.combo_midi, 0, 1)
+        grid.addWidget(QLabel("HID DEVICE (evdev):"), 1, 0)
+        self.ed_hid = QLineEdit(controllers.get("hid_device", ""))
+        self.ed_hid.setPlaceholderText("/dev/input/by-id/...-event-kbd")
+        grid.addWidget(self.ed_hid, 1, 1)
+        layout.addLayout(grid)
+        self.lbl_warn = QLabel("")
+        self.lbl_warn.setStyleSheet("color: #ff5555;")
+        self.lbl_warn.setWordWrap(True)
+        layout.addWidget(self.lbl_warn)
+        btn_layout = QHBoxLayout()
+        btn_reset = QPushButton("Defaults")
+        btn_reset.setStyleSheet("background: #555;")
+        btn_reset.clicked.connect(lambda: [ed.setKeySequence(QKeySequence(KEYMAP_DEFAULTS.get(n, ""))) for n, ed in self.keys.items()])
+        btn_ok = QPushButton("OK")
+        btn_ok.clicked.connect(self.accept)
+        btn_cancel = QPushButton("Cancel")
+        btn_cancel.setStyleSheet("background: #555;")
+        btn_cancel.clicked.connect(self.reject)
+        btn_layout.addWidget(btn_reset)
+        btn_layout.addWidget(btn_ok)
+        btn_layout.addWidget(btn_cancel)
+        layout.addLayout(btn_layout)
+
+    def conflicts(self):
+        # 同じキーが 2 か所にあると Qt はどちらも発火しない (activatedAmbiguously) ので、重複とメニューのキーは受け付けない
+        seen, msgs = dict(self.reserved), []
+        for name, seq in self.get_keymap().items():
+            if not seq: continue
+            if seq in seen: msgs.append(f"{seq}: {self.labels.get(name, name)} / {seen[seq]}")
+            else: seen[seq] = self.labels.get(name, name)
+        return msgs
+
+    def accept(self):
+        msgs = self.conflicts()
+        if msgs: self.lbl_warn.setText("Key used twice: " + "; ".join(msgs)); return
+        super().accept()
+
+    def get_keymap(self):
+        return {name: ed.keySequence().toString() for name, ed in self.keys.items()}
+
+    def get_controllers(self):
+        out = {"midi_port": self.combo_midi.currentData() or "", "hid_device": self.ed_hid.text().strip(), "midi": {}, "hid": {}}
+        for row in range(self.table.rowCount()):
+            name = self.table.item(row, 0).data(Qt.UserRole)
+            for k in (self.table.item(row, 2).text() if self.table.item(row, 2) else "").split(","):
+                k = k.strip()
+                if k: out["midi" if k.startswith(("note:", "cc:")) else "hid"][k] = name
+        return out
+
 # ==========================================
 #  Main Application
 # ==========================================
@@ -726,6 +3231,10 @@ class InnerPulseQt(QMainWindow):
         self.log_win = LogWindow(self)
         self.last_bt = 0
         self.diffs = []
+        self.recorder = None
+        self.replay = None
+        self.vis_anchor = None # (speaker 時刻, 拍位置, 拍/秒, mute) — 最新の vis メッセージから
+        self.vis_offset_ms = 0.0
 
         # Load Config & Setlist
         if getattr(sys, 'frozen', False):
@@ -755,10 +3264,19 @@ class InnerPulseQt(QMainWindow):
         self.setup_menu_bar()
         self.setup_tool_bar()
 
-        QApplication.instance().installEventFilter(self)
+        self.setup_bindings()
         self.tmr = QTimer()
         self.tmr.timeout.connect(self.poll_queue)
-        self.tmr.start(10)
+        self.tmr.start(ACTIVE_POLL_MS)
+        self.watchdog = StallWatchdog(float(self.app_config.get("stall_ms", 80.0)), self.tmr.interval())
+        # 停止後 idle_s 秒でアイドルへ (0 = しない): ストリームを止め、ポーリングを IDLE_POLL_MS に落とす
+        self.idle_tmr = QTimer(); self.idle_tmr.setSingleShot(True)
+        self.idle_tmr.timeout.connect(self.enter_idle)
+        self.is_idle = False
+        self._wake_mark = (time.perf_counter(), 0, 0)
+        self.poll_count = 0
+        self.watchdog.on_stall = lambda r: self.log_win.log(f"[STALL] {r['kind']} +{r['late_ms']:.0f}ms @ {r['where']}")
+        self.canvas.paint_hook = self.watchdog.paint
 
         if "buffer_size" in self.app_config:
             self.eng.buffer_size = int(self.app_config["buffer_size"])
@@ -769,30 +3287,81 @@ class InnerPulseQt(QMainWindow):
         if hasattr(self, 'btn_tone'):
             self.btn_tone.setText("♪ Wood" if saved_tone == "woody" else "♪ Elec")
 
-        self.change_dev() # Initial boot
+        # デバイス列挙とストリーム起動はウィンドウが描画された後 (_late_init) に別スレッドで回す
+        self.is_locked = True
+        self.btn_start.setText("WAIT...")
+        self.btn_start.setEnabled(False) # 起動完了 (unlock_controls) まで
+        STARTUP["window_built"] = time.perf_counter()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if "window_shown" not in STARTUP:
+            STARTUP["window_shown"] = time.perf_counter()
+            self.watchdog.last_beat = STARTUP["window_shown"] # exec() 前の構築時間は詰まりに数えない
+            # 0ms タイマーは最初の描画を処理した後に回ってくる
+            QTimer.singleShot(0, self._late_init)
+
+    def _late_init(self):
+        STARTUP["first_paint"] = time.perf_counter()
+        self.eng.boot_async(self.app_config.get("audio_device", "")) # 終わったら poll_queue -> on_boot
+
+    def on_boot(self, d):
+        self.combo_dev.blockSignals(True)
+        for i, (idx, name) in enumerate(d["devices"]):
+            self.combo_dev.addItem(name, idx)
+            if idx == self.eng.device_index: self.combo_dev.setCurrentIndex(i)
+        self.combo_dev.blockSignals(False)
+        STARTUP["devices"] = d["t_devices"]
+        self.booted(d["msg"])
+        if self.app_config.get("midi_clock"): self.eng.set_midi_clock(self.app_config["midi_clock"])
+        STARTUP["audio_ready"] = time.perf_counter()
+        self.log_win.log("[STARTUP] " + " | ".join(f"{k} {v:.0f}ms" for k, v in startup_report().items()))
+        if "--profile-startup" in sys.argv and "--quit-after-ready" in sys.argv:
+            # 自動計測: そのまま START して最初の拍のブロックで first_click を取り、閉じる (音が出なければ 3 秒で諦める)
+            QTimer.singleShot(0, self.toggle)
+            QTimer.singleShot(3000, self.close)
 
     # --- Config Management ---
     def load_config(self):
-        self.app_config = {"audio_device": "", "buffer_size": "128", "tone": "electronic"}
+        self.app_config = {"audio_device": "", "buffer_size": "128", "tone": "electronic", "kit": {}}
         if os.path.exists(self.config_path):
             try:
                 with open(self.config_path, 'r', encoding='utf-8') as f:
                     self.app_config.update(json.load(f))
                     # Apply random training ranges from config to engine if they exist
-                    for key in ["rnd_play_min", "rnd_play_max", "rnd_mute_min", "rnd_mute_max"]:
+                    for key in list(RND_KEYS) + ["trainer_step", "trainer_every", "trainer_max"]:
                         if key in self.app_config:
                             self.eng.update(key, int(self.app_config[key]))
+                    self.eng.update("voices", tuple(v for v in self.app_config.get("voices", []) if v.get("wave") in KIT_VOICES))
+                    self.eng.update("trainer", bool(self.app_config.get("trainer", False)))
+                    self.eng.update("layers", tuple(l for l in self.app_config.get("layers", []) if isinstance(l, dict)))
+                    self.eng.listen = bool(self.app_config.get("listen", False))
+                    self.eng.listen_offset_ms = float(self.app_config.get("listen_offset_ms", 0.0))
+                    self.eng.routing = {k: v for k, v in self.app_config.get("routing", {}).items() if k in BUS_INDEX}
+                    self.eng.limiter = bool(self.app_config.get("limiter", True))
+                    self.eng.limit_threshold = min(0.99, max(0.1, float(self.app_config.get("limit_threshold", 0.8))))
+                    self.eng.headroom_db = parse_headroom(self.app_config.get("headroom_db", {}))
+                    self.eng.kit = {k: v for k, v in self.app_config.get("kit", {}).items() if k in KIT_VOICES and v}
+                    self.eng.publish({k: type(self.eng.params[k])(self.app_config[k]) for k in CUE_KEYS if k in self.app_config})
+                    self.eng.cue_spec = self._cue_spec()
+                    try: self.eng.update("groove", self.app_config.get("groove"))
+                    except Exception as e: self.log_win.log(f"[GROOVE] config: {str(e)[:40]}")
             except: pass
 
     def save_config(self):
         try:
             # Sync random training ranges from engine to config
-            for key in ["rnd_play_min", "rnd_play_max", "rnd_mute_min", "rnd_mute_max"]:
+            for key in list(RND_KEYS) + ["trainer", "trainer_step", "trainer_every", "trainer_max"] + list(CUE_KEYS):
                 self.app_config[key] = self.eng.params.get(key)
             with open(self.config_path, 'w', encoding='utf-8') as f:
                 json.dump(self.app_config, f, indent=2)
         except: pass
 
+    def _cue_spec(self):
+        # 既定はスクリプト横の cues/ フォルダ
+        root = self.app_config.get("cue_dir") or os.path.join(os.path.dirname(self.config_path), "cues")
+        return (root, self.app_config.get("cue_lang", ""), int(self.app_config.get("cue_cache_mb", 32)) << 20)
+
     # --- UI Helpers ---
     def setup_audio_ui(self):
         cfg_box = QFrame()
@@ -803,13 +3372,7 @@ class InnerPulseQt(QMainWindow):
         tk_dev_lbl = QLabel("AUDIO DEVICE / BUFFER")
         tk_dev_lbl.setStyleSheet("font-size: 9px; color: #777; font-weight: bold;")
 
-        self.combo_dev = QComboBox()
-        saved_dev = self.app_config.get("audio_device", "")
-        set_idx = 0
-        for i, (idx, name) in enumerate(self.eng.get_filtered_devices()):
-            self.combo_dev.addItem(name, idx)
-            if name == saved_dev: set_idx = i
-        self.combo_dev.setCurrentIndex(set_idx)
+        self.combo_dev = QComboBox() # 中身は _late_init で列挙
         self.combo_dev.currentIndexChanged.connect(self.change_dev)
 
         self.combo_buf = QComboBox()
@@ -887,7 +3450,7 @@ class InnerPulseQt(QMainWindow):
         mode_layout.addWidget(self.btn_tone)
         self.layout.addLayout(mode_layout)
 
-        self.canvas = VisualizerWidget()
+        self.canvas = make_visualizer(self.app_config.get("renderer", "painter"))
         self.layout.addWidget(self.canvas)
         self.lbl_bar = QLabel("Bar: 0")
         self.lbl_bar.setAlignment(Qt.AlignCenter)
@@ -928,6 +3491,7 @@ class InnerPulseQt(QMainWindow):
         self.layout.addSpacing(15)
         mix_layout = QHBoxLayout()
         mix_layout.setSpacing(2)
+        self.sliders = {}
         controls = [
             ("MST", "v_master", 0.8, "#fff"),
             ("ACC", "v_acc", 0.8, "#fc0"),
@@ -948,9 +3512,16 @@ class InnerPulseQt(QMainWindow):
             sld.setFixedHeight(120)
             sld.setFocusPolicy(Qt.NoFocus)
             sld.valueChanged.connect(lambda val, key=k: self.eng.update(key, val/100.0))
+            self.sliders[k] = sld
             lbl = QLabel(label)
             lbl.setStyleSheet(f"color: {c}; font-weight: bold; font-size: 8px;")
-            v_box.addWidget(sld)
+            if k == "v_master":
+                # マスターの横にレベルメータ
+                self.meter = LevelMeter()
+                row = QHBoxLayout(); row.setSpacing(2)
+                row.addWidget(sld); row.addWidget(self.meter)
+                v_box.addLayout(row)
+            else: v_box.addWidget(sld)
             v_box.addWidget(lbl)
             mix_layout.addLayout(v_box)
         self.layout.addLayout(mix_layout)
@@ -982,46 +3553,83 @@ class InnerPulseQt(QMainWindow):
         except Exception as e: print(f"Save Error: {e}")
 
     # --- Logic ---
-    def eventFilter(self, obj, event):
-        if event.type() == QEvent.KeyPress and not self.is_locked:
-            focus_w = QApplication.focusWidget()
-
-            # セットリストエディタの入力フィールドではホットキーを無効化
-            if isinstance(focus_w, (QLineEdit, QTextEdit)):
-                return super().eventFilter(obj, event)
-
-            # BPM/BEATS/PLAYBARS/MUTEBARSのSpinBoxでは、ホットキーを有効にする
-            # それ以外のSpinBoxでは無効化
-            if isinstance(focus_w, QAbstractSpinBox):
-                allowed_spinboxes = [
-                    self.sp_bpm_obj[1],    # BPM
-                    self.sp_bpb_obj[1],    # BEATS
-                    self.sp_play_obj[1],   # PLAYBARS
-                    self.sp_mute_obj[1]    # MUTEBARS
-                ]
-                if focus_w not in allowed_spinboxes:
-                    return super().eventFilter(obj, event)
-
-            key = event.key()
-            if key == Qt.Key_Space:
-                self.toggle()
-                return True
-            elif key == Qt.Key_M:
-                self.chk_mute_off.setChecked(not self.chk_mute_off.isChecked())
-                return True
-            elif key == Qt.Key_L:
-                self.log_win.toggle()
-                return True
-            elif key == Qt.Key_R:
-                self.chk_rnd.setChecked(not self.chk_rnd.isChecked())
-                return True
-            elif key == Qt.Key_Left:
-                self.prev_song()
-                return True
-            elif key == Qt.Key_Right:
-                self.next_song()
-                return True
-        return super().eventFilter(obj, event)
+    # --- Input Bindings ---
+    def setup_bindings(self):
+        # キー/コントローラ -> コマンド。trigger は押すたび、value は 0..1 の値 (フェーダーや CC 向け)
+        bpm = self.sp_bpm_obj[1]
+        toggle_chk = lambda chk: (lambda: chk.setChecked(not chk.isChecked()))
+        self.commands = {
+            "toggle": ("Start / Stop", self.toggle, "trigger"),
+            "mute_off": ("Mute Off", toggle_chk(self.chk_mute_off), "trigger"),
+            "rnd": ("Random Training", toggle_chk(self.chk_rnd), "trigger"),
+            "prev_song": ("Previous Song", self.prev_song, "trigger"),
+            "next_song": ("Next Song", self.next_song, "trigger"),
+            "bpm_up": ("BPM +1", lambda: bpm.stepBy(1), "trigger"),
+            "bpm_down": ("BPM -1", lambda: bpm.stepBy(-1), "trigger"),
+            "log": ("Show Log", self.log_win.toggle, "trigger"),
+            "bpm": ("BPM (fader)", lambda x: bpm.setValue(round(bpm.minimum() + x * (bpm.maximum() - bpm.minimum()))), "value"),
+        }
+        for k, sld in self.sliders.items():
+            self.commands[k] = (f"{k[2:].upper()} Volume (fader)", lambda x, s=sld: s.setValue(round(x * 100)), "value")
+        self.spin_keys = _SpinHotkeys(self)
+        for obj in (self.sp_bpm_obj, self.sp_bpb_obj, self.sp_play_obj, self.sp_mute_obj): obj[1].installEventFilter(self.spin_keys)
+        self.shortcuts = []
+        self.controllers = None
+        self.apply_bindings()
+
+    def apply_bindings(self):
+        keymap = dict(KEYMAP_DEFAULTS, **self.app_config.get("keymap", {}))
+        for sc in self.shortcuts: sc.setEnabled(False); sc.deleteLater()
+        self.shortcuts = []
+        for name, act in self.command_actions.items():
+            act.setShortcut(QKeySequence(keymap.get(name, ""))); act.setShortcutContext(Qt.ApplicationShortcut)
+        for name, seq in keymap.items():
+            if not seq or name not in self.commands or name in self.command_actions: continue
+            # ApplicationShortcut: ログウィンドウ等にフォーカスがあっても効く (入力欄は ShortcutOverride で文字を優先する)
+            sc = QShortcut(QKeySequence(seq), self, context=Qt.ApplicationShortcut)
+            sc.activated.connect(lambda n=name: self.run_command(n))
+            self.shortcuts.append(sc)
+        self.spin_keys.keys = {QKeySequence(seq).toString() for seq in keymap.values() if seq}
+        if self.controllers: self.controllers.close()
+        cfg = dict(CONTROLLER_DEFAULTS, **self.app_config.get("controllers", {}))
+        self.controllers = ControllerInput(cfg, self.log_win.log) if cfg["midi_port"] or cfg["hid_device"] else None
+        if self.controllers: self.controllers.command.connect(self.run_command)
+
+    def _reserved_keys(self):
+        # コマンド以外が使っているキー: メニュー項目のショートカットとメニューバーの Alt+ニーモニック
+        used = {}
+        for act in self.findChildren(QAction):
+            if act in self.command_actions.values(): continue
+            if not act.shortcut().isEmpty(): used[act.shortcut().toString()] = act.text().replace("&", "")
+        for act in self.menuBar().actions():
+            t = act.text(); i = t.find("&")
+            if 0 <= i < len(t) - 1: used[f"Alt+{t[i + 1].upper()}"] = t.replace("&", "") + " menu"
+        return used
+
+    def run_command(self, name, value=1.0, edge=True):
+        if self.is_locked or name not in self.commands: return
+        _, fn, kind = self.commands[name]
+        if kind == "value": fn(max(0.0, min(1.0, value)))
+        elif edge: fn()
+
+    def open_bindings(self):
+        dlg = BindingsDialog(self, self.commands, dict(KEYMAP_DEFAULTS, **self.app_config.get("keymap", {})),
+                             dict(CONTROLLER_DEFAULTS, **self.app_config.get("controllers", {})), self._reserved_keys())
+        if dlg.exec():
+            self.app_config["keymap"] = dlg.get_keymap()
+            self.app_config["controllers"] = dlg.get_controllers()
+            self.save_config()
+            self.apply_bindings()
+            c = self.app_config["controllers"]
+            self.log_win.log(f"[INPUT] {len(self.shortcuts)} keys | MIDI {c['midi_port'] or '-'} ({len(c['midi'])}) | HID {c['hid_device'] or '-'} ({len(c['hid'])})")
+
+    def on_first_click(self, t):
+        # time-to-first-click = 起動後に最初の拍を描画したブロック (START の操作ではなく、鳴った時点で数える)
+        if "first_click" in STARTUP: return
+        STARTUP["first_click"] = t
+        self.log_win.log(f"[STARTUP] first click {startup_report()['first_click']:.0f}ms")
+        write_startup_profile()
+        if "--profile-startup" in sys.argv and "--quit-after-ready" in sys.argv: QTimer.singleShot(0, self.close)
 
     def setup_tool_bar(self):
         toolbar = self.addToolBar("Main")
@@ -1042,20 +3650,112 @@ class InnerPulseQt(QMainWindow):
         import_act = QAction("&Import Setlist (JSON)...", self)
         import_act.triggered.connect(self.import_setlist)
         file_menu.addAction(import_act)
+        file_menu.addSeparator()
+        self.rec_act = QAction("&Record Session", self)
+        self.rec_act.setCheckable(True)
+        self.rec_act.toggled.connect(self.toggle_recording)
+        file_menu.addAction(self.rec_act)
+        replay_act = QAction("Re&play Session...", self)
+        replay_act.triggered.connect(self.replay_session)
+        file_menu.addAction(replay_act)
+        analyze_act = QAction("&Analyze Session...", self)
+        analyze_act.triggered.connect(self.analyze_session)
+        file_menu.addAction(analyze_act)
+        file_menu.addSeparator()
+        smf_song_act = QAction("Export MIDI Click (&Song)...", self)
+        smf_song_act.triggered.connect(lambda: self.export_midi(False))
+        file_menu.addAction(smf_song_act)
+        smf_set_act = QAction("Export MIDI Click (Se&tlist)...", self)
+        smf_set_act.triggered.connect(lambda: self.export_midi(True))
+        file_menu.addAction(smf_set_act)
         
         # View Menu
         view_menu = menubar.addMenu("&View")
         
         log_act = QAction("Show &Log", self)
-        log_act.setShortcut("L")
         log_act.triggered.connect(self.log_win.toggle)
         view_menu.addAction(log_act)
+        self.command_actions = {"log": log_act} # キーは keymap から apply_bindings が付ける (QShortcut と二重にしない)
+
+        render_menu = view_menu.addMenu("&Renderer")
+        render_group = QActionGroup(self)
+        for key, label in [("painter", "QPainter (classic)"), ("scene", "Retained Scene (software)"), ("gl", "Retained Scene (OpenGL)")]:
+            act = QAction(label, self)
+            act.setCheckable(True)
+            act.setChecked(self.app_config.get("renderer", "painter") == key)
+            act.triggered.connect(lambda _=False, k=key: self.set_renderer(k))
+            render_group.addAction(act)
+            render_menu.addAction(act)
+        frame_act = QAction("Log &Frame Times", self)
+        frame_act.triggered.connect(self.log_frame_times)
+        view_menu.addAction(frame_act)
+
+        self.probe_act = QAction("&Timing Measurement", self)
+        self.probe_act.setCheckable(True)
+        self.probe_act.toggled.connect(self.toggle_probe)
+        view_menu.addAction(self.probe_act)
+
+        wake_act = QAction("Log &Wakeups/sec", self)
+        wake_act.triggered.connect(self.log_wakeups)
+        view_menu.addAction(wake_act)
+
+        stall_act = QAction("Log UI &Stalls", self)
+        stall_act.triggered.connect(self.log_stalls)
+        view_menu.addAction(stall_act)
+
+        dump_act = QAction("&Dump UI Stalls", self)
+        dump_act.triggered.connect(self.dump_stalls)
+        view_menu.addAction(dump_act)
 
         # Options Menu
         options_menu = menubar.addMenu("&Options")
         rnd_opt_act = QAction("&Random Training Settings...", self)
         rnd_opt_act.triggered.connect(self.open_random_options)
         options_menu.addAction(rnd_opt_act)
+        trainer_act = QAction("&Speed Trainer...", self)
+        trainer_act.triggered.connect(self.open_speed_trainer)
+        options_menu.addAction(trainer_act)
+        bind_act = QAction("&Key && Controller Bindings...", self)
+        bind_act.triggered.connect(self.open_bindings)
+        options_menu.addAction(bind_act)
+        groove_act = QAction("&Groove / Swing...", self)
+        groove_act.triggered.connect(self.open_groove)
+        options_menu.addAction(groove_act)
+        cues_act = QAction("&Voice Cues...", self)
+        cues_act.triggered.connect(self.open_voice_cues)
+        options_menu.addAction(cues_act)
+        self.midi_menu = options_menu.addMenu("&MIDI Clock Output")
+        self.midi_menu.aboutToShow.connect(self.fill_midi_menu) # ポート一覧は開くたびに取り直す
+        layers_act = QAction("Metronome &Layers...", self)
+        layers_act.triggered.connect(self.open_layers)
+        options_menu.addAction(layers_act)
+        voices_act = QAction("&Tuplets / Polyrhythms...", self)
+        voices_act.triggered.connect(self.open_voice_layers)
+        options_menu.addAction(voices_act)
+        self.listen_act = QAction("&Listen && Score (Mic)", self)
+        self.listen_act.setCheckable(True)
+        self.listen_act.setChecked(self.eng.listen)
+        self.listen_act.toggled.connect(self.toggle_listen)
+        options_menu.addAction(self.listen_act)
+
+        cal_act = QAction("&Calibrate Latency (Loopback)...", self)
+        cal_act.triggered.connect(self.calibrate_latency)
+        options_menu.addAction(cal_act)
+        vis_off_act = QAction("&Visual Offset...", self)
+        vis_off_act.triggered.connect(self.open_visual_offset)
+        options_menu.addAction(vis_off_act)
+
+        limiter_act = QAction("Master &Limiter", self)
+        limiter_act.setCheckable(True)
+        limiter_act.setChecked(self.eng.limiter)
+        limiter_act.toggled.connect(self.toggle_limiter)
+        options_menu.addAction(limiter_act)
+        routing_act = QAction("Output R&outing...", self)
+        routing_act.triggered.connect(self.open_routing)
+        options_menu.addAction(routing_act)
+        kit_act = QAction("Sample &Kit...", self)
+        kit_act.triggered.connect(self.open_kit)
+        options_menu.addAction(kit_act)
 
     def import_setlist(self):
         from PySide6.QtWidgets import QFileDialog
@@ -1077,6 +3777,152 @@ class InnerPulseQt(QMainWindow):
             except Exception as e:
                 self.log_win.log(f"[ERROR] Failed to import: {str(e)}")
 
+    # --- Session Recording ---
+    def toggle_recording(self, on):
+        if on:
+            sess_dir = os.path.join(os.path.dirname(self.config_path), "sessions")
+            os.makedirs(sess_dir, exist_ok=True)
+            path = os.path.join(sess_dir, time.strftime("session-%Y%m%d-%H%M%S.ipsess"))
+            self.recorder = SessionRecorder(path)
+            self.log_win.log(f"[REC] Recording to {os.path.basename(path)}")
+        elif self.recorder:
+            self.recorder.close()
+            self.log_win.log(f"[REC] Saved {self.recorder.n} records")
+            self.recorder = None
+
+    def closeEvent(self, event):
+        if self.recorder: self.recorder.close()
+        self.watchdog.stop()
+        if self.eng.midi_clock: self.eng.midi_clock.close()
+        if self.controllers: self.controllers.close()
+        if "first_click" not in STARTUP: write_startup_profile()
+        super().closeEvent(event)
+
+    def export_midi(self, whole):
+        from PySide6.QtWidgets import QFileDialog, QInputDialog
+        songs = self.setlist if whole else [self.setlist[self.setlist_idx]]
+        name = "setlist" if whole else songs[0]["name"]
+        path, _ = QFileDialog.getSaveFileName(self, "Export MIDI Click", os.path.join(os.path.dirname(self.config_path), f"{name}.mid"), "Standard MIDI File (*.mid)")
+        if not path: return
+        bars, ok = QInputDialog.getInt(self, "Export MIDI Click", "Bars per song (songs with \"bars\" keep their own):", int(self.app_config.get("midi_bars", 64)), 1, 100000)
+        if not ok: return
+        self.app_config["midi_bars"] = bars; self.save_config()
+        t = time.perf_counter()
+        try: rep = export_smf(self.eng, path, songs, bars)
+        except Exception as e: self.log_win.log(f"[ERROR] MIDI export: {str(e)}"); return
+        self.log_win.log(f"[MIDI] {os.path.basename(path)}: {rep['songs']} song(s), {rep['bars']} bars, {rep['notes']} notes ({(time.perf_counter() - t) * 1000:.0f}ms)")
+
+    def fill_midi_menu(self):
+        menu = self.midi_menu; menu.clear()
+        cur = self.eng.midi_clock.port if self.eng.midi_clock else ""
+        try:
+            import mido
+            ports = mido.get_output_names()
+        except Exception as e:
+            ports = []
+            note = QAction(f"(no MIDI ports: {str(e)[:40]})", self); note.setEnabled(False); menu.addAction(note)
+        group = QActionGroup(menu)
+        for port, label in [("", "Off"), ("virtual", f"Virtual Port \"{APP_NAME} Clock\"")] + [(p, p) for p in ports]:
+            act = QAction(label, menu)
+            act.setCheckable(True)
+            act.setChecked(port == cur)
+            act.triggered.connect(lambda _=False, p=port: self.set_midi_clock(p))
+            group.addAction(act)
+            menu.addAction(act)
+        menu.addSeparator()
+        file_act = QAction("Log to &File...", menu)
+        file_act.setCheckable(True)
+        file_act.setChecked(cur.startswith("file:"))
+        file_act.triggered.connect(self.set_midi_clock_file)
+        menu.addAction(file_act)
+
+    def set_midi_clock_file(self):
+        from PySide6.QtWidgets import QFileDialog
+        path, _ = QFileDialog.getSaveFileName(self, "MIDI Clock Log", os.path.join(os.path.dirname(self.config_path), "midi_clock.txt"), "Text (*.txt)")
+        if path: self.set_midi_clock("file:" + path)
+
+    def set_midi_clock(self, port):
+        clock = self.eng.set_midi_clock(port)
+        self.app_config["midi_clock"] = port if clock else ""
+        self.save_config()
+        self.log_win.log(f"[MIDI] Clock output: {port if clock else 'OFF'}")
+
+    def _pick_session(self, title):
+        from PySide6.QtWidgets import QFileDialog
+        path, _ = QFileDialog.getOpenFileName(self, title, os.path.join(os.path.dirname(self.config_path), "sessions"), "InnerPulse Sessions (*.ipsess)")
+        return path
+
+    def analyze_session(self):
+        path = self._pick_session("Analyze Session")
+        if not path: return
+        try: rep = analyze_session(load_session(path))
+        except Exception as e: self.log_win.log(f"[ERROR] Analyze: {str(e)}"); return
+        self.log_win.log(f"[ANALYZE] {os.path.basename(path)}: {rep['beats']} beats / {rep['duration']:.0f}s | Jitter:{rep['jitter_ms']:.2f}ms")
+        for t0, j in rep["jitter_over_time"]: self.log_win.log(f"  {t0:6.0f}s  jitter {j:.2f}ms")
+        for name, m in rep["mute_acc"].items():
+            self.log_win.log(f"  {name.upper()}: n={m['n']} mean {m['mean_ms']:+.1f}ms |abs| {m['abs_ms']:.1f}ms within 25ms {m['within_25ms']*100:.0f}%")
+
+    def replay_session(self):
+        path = self._pick_session("Replay Session")
+        if not path: return
+        try: beats = load_session(path)
+        except Exception as e: self.log_win.log(f"[ERROR] Replay: {str(e)}"); return
+        beats = beats[beats["kind"] == 0]
+        if not len(beats): return
+        if self.eng.is_playing: self.toggle()
+        self.leave_idle()
+        self.replay = {"rec": np.array(beats), "t0": time.perf_counter()}
+        self.log_win.log(f"[REPLAY] {os.path.basename(path)} ({len(beats)} beats)")
+
+    def _replay_step(self):
+        rec = self.replay["rec"]; ts = rec["ts"] - rec["ts"][0]
+        t = time.perf_counter() - self.replay["t0"]
+        i = int(np.searchsorted(ts, t, side='right')) - 1
+        if i >= len(rec) - 1 and t > ts[-1] + 60.0 / rec["bpm"][-1]:
+            self.replay = None; self.canvas.reset_pos(); self.log_win.log("[REPLAY] Done"); self.arm_idle(); return
+        r = rec[max(0, i)]
+        self.canvas.update_pos(r["pos"] + (t - ts[max(0, i)]) * r["bpm"] / 60.0, bool(r["mute"]), int(r["bpb"]))
+        self.lbl_bar.setText(f"Bar: {r['bar']} (replay)")
+
+    def set_renderer(self, renderer):
+        new = make_visualizer(renderer)
+        new.set_mode(self.vis_mode)
+        new.update_pos(self.canvas.pos, self.canvas.mute, self.canvas.bpb)
+        self.layout.replaceWidget(self.canvas, new)
+        self.canvas.deleteLater()
+        self.canvas = new
+        new.paint_hook = self.watchdog.paint
+        self.app_config["renderer"] = renderer
+        self.save_config()
+        gl = getattr(new, "use_gl", None)
+        self.log_win.log(f"[RENDER] {renderer}" + (" (OpenGL unavailable, software viewport)" if renderer == "gl" and not gl else ""))
+
+    def log_frame_times(self):
+        st = frame_stats(self.canvas.frame_times)
+        self.log_win.log(f"[FRAME] {type(self.canvas).__name__}: n={st['n']} mean {st['mean_ms']:.3f}ms p95 {st['p95_ms']:.3f}ms max {st['max_ms']:.3f}ms")
+
+    def toggle_probe(self, on):
+        if on:
+            self.eng.probe = TimingProbe(self.eng.sr)
+            self.log_win.log(f"[TIMING] Measuring (Buf:{self.eng.buffer_size} / {self.eng.current_device_name})")
+        elif self.eng.probe:
+            probe, self.eng.probe = self.eng.probe, None
+            self.log_win.log(f"[TIMING] Buf:{self.eng.buffer_size} | {probe.summary()}")
+
+    def log_stalls(self):
+        hist = list(self.watchdog.history)
+        self.log_win.log(f"[STALL] {len(hist)} stalls over {self.watchdog.threshold*1000:.0f}ms")
+        for site, n in collections.Counter(r["where"] for r in hist).most_common(10):
+            worst = max(r["late_ms"] for r in hist if r["where"] == site)
+            self.log_win.log(f"  {n:>3}x worst {worst:.0f}ms @ {site}")
+
+    def dump_stalls(self):
+        stall_dir = os.path.join(os.path.dirname(self.config_path), "stalls")
+        os.makedirs(stall_dir, exist_ok=True)
+        path = os.path.join(stall_dir, time.strftime("stalls-%Y%m%d-%H%M%S.json"))
+        self.watchdog.dump(path)
+        self.log_win.log(f"[STALL] Dumped {len(self.watchdog.history)} stalls to {os.path.basename(path)}")
+
     def toggle_mode(self):
         self.vis_mode = "LED" if self.vis_mode == "BAR" else "BAR"
         self.btn_mode.setText(f"Mode: {self.vis_mode}")
@@ -1095,17 +3941,142 @@ class InnerPulseQt(QMainWindow):
     def open_mute_options(self):
         dlg = MuteOptionsDialog(self, self.eng.mute_options)
         if dlg.exec():
-            self.eng.mute_options = dlg.get_options()
-            self.log_win.log(f"[MUTE OPTIONS] Updated: {self.eng.mute_options}")
+            self.eng.set_mute_options(dlg.get_options())
+            self.log_win.log(f"[MUTE OPTIONS] Updated: {dict(self.eng.mute_options)}")
 
     def open_random_options(self):
         dlg = RandomTrainingOptionsDialog(self, self.eng.params)
         if dlg.exec():
             ranges = dlg.get_ranges()
-            for k, v in ranges.items():
-                self.eng.update(k, v)
+            self.eng.publish(ranges)
+            self.save_config()
+            self.log_win.log(f"[RND SETTINGS] Play:{ranges['rnd_play_min']}-{ranges['rnd_play_max']} | Mute:{ranges['rnd_mute_min']}-{ranges['rnd_mute_max']} | Seed:{ranges['rnd_seed']}")
+            self.log_win.log("[RND PLAN] " + " ".join(plan_runs(self.eng.params["rnd_plan"][:32])))
+
+    def open_visual_offset(self):
+        dev, old = self.eng.current_device_name, self.vis_offset_ms
+        dlg = VisualOffsetDialog(self, dev, old, self.eng.out_latency * 1000.0, on_change=lambda v: setattr(self, "vis_offset_ms", float(v)))
+        if dlg.exec():
+            self.vis_offset_ms = float(dlg.get_offset())
+            self.app_config.setdefault("vis_offsets", {})[dev] = self.vis_offset_ms
+            self.save_config()
+            self.log_win.log(f"[VIS] Offset {self.vis_offset_ms:+.0f}ms for {dev}")
+        else: self.vis_offset_ms = old
+
+    def calibrate_latency(self):
+        from PySide6.QtWidgets import QMessageBox
+        if self.eng.is_playing: self.toggle()
+        dev, buf = self.eng.current_device_name, self.eng.buffer_size
+        if QMessageBox.question(self, "Latency Calibration", f"Connect an output of\n{dev}\nback to its input (loopback cable or mic at the speaker),\n"
+                                f"then press OK. Clicks will play for about 3 seconds (buffer {buf}).",
+                                QMessageBox.Ok | QMessageBox.Cancel) != QMessageBox.Ok: return
+        self.leave_idle()
+        if not self.eng.start_calibration(): return
+        self.is_locked = True
+        self.btn_start.setText("CALIBRATING...")
+        self.log_win.log(f"[CAL] Measuring round trip on {dev} / Buf:{buf}...")
+
+    def on_calibration(self, d):
+        if "error" in d: self.log_win.log(f"[CAL] Failed: {d['error']}")
+        else:
+            rec = {k: round(d[k], 3) for k in ("rt_ms", "reported_rt_ms", "out_ms", "fix_ms", "jitter_ms")}
+            rec["time"] = time.strftime("%Y-%m-%d %H:%M")
+            self.app_config.setdefault("latency", {}).setdefault(d["device"], {})[str(d["buffer"])] = rec
+            self.log_win.log(f"[CAL] {d['device']} / Buf:{d['buffer']}: round trip {d['rt_ms']:.2f}ms (reported {d['reported_rt_ms']:.2f}ms) | "
+                             f"output ≈ {d['out_ms']:.2f}ms | jitter {d['jitter_ms']:.3f}ms over {d['clicks']} clicks (SNR {d['snr']:.0f})")
+        self.change_dev() # 測定用に閉じたストリームを開き直す (ここで校正値も反映)
+
+    def apply_latency_cal(self):
+        # デバイス x バッファごとの校正値を出力レイテンシの補正に使う (振り子/テレメトリ/マイク採点の時刻)
+        r = self.app_config.get("latency", {}).get(self.eng.current_device_name, {}).get(str(self.eng.buffer_size))
+        self.eng.lat_fix_s = r["fix_ms"] / 1000.0 if r else 0.0
+        if r: self.log_win.log(f"[CAL] Using {r['rt_ms']:.2f}ms round trip ({r['fix_ms']:+.2f}ms vs reported, {r['time']})")
+
+    def toggle_limiter(self, on):
+        self.eng.limiter = on
+        self.app_config["limiter"] = on
+        self.save_config()
+        self.log_win.log(f"[MASTER] Limiter {'ON' if on else 'OFF'} (threshold {self.eng.limit_threshold:.2f} / headroom {' '.join(f'{k} {v:+.1f}dB' for k, v in self.eng.headroom_db.items()) or '0dB'})")
+
+    def toggle_listen(self, on):
+        if self.eng.is_playing: self.toggle()
+        self.eng.listen = on
+        self.app_config["listen"] = on
+        self.change_dev()
+
+    def open_layers(self):
+        dlg = LayersDialog(self, self.eng.params.get("layers", ()))
+        if dlg.exec():
+            layers = dlg.get_layers()
+            self.eng.update("layers", tuple(layers))
+            self.app_config["layers"] = layers
+            self.save_config()
+            self.log_win.log(f"[LAYERS] " + (", ".join(f"{l['name']} {l['bpm']}bpm x{l['bpb']}{'' if l['enabled'] else ' (off)'}" for l in layers) or "none"))
+
+    def open_voice_layers(self):
+        dlg = VoiceLayerDialog(self, self.eng.params.get("voices", ()))
+        if dlg.exec():
+            voices = dlg.get_voices()
+            self.eng.update("voices", tuple(voices))
+            self.app_config["voices"] = voices
+            self.save_config()
+            self.log_win.log(f"[VOICES] " + (", ".join(f"{v['wave']} {v['hits']}:{v['beats']}" for v in voices) or "none"))
+
+    def open_routing(self):
+        dlg = RoutingDialog(self, self.eng.routing, self.eng.n_channels, self.eng.headroom_db)
+        if dlg.exec():
+            self.eng.headroom_db = dlg.get_headroom()
+            self.eng.set_routing(dlg.get_routing())
+            self.app_config["routing"] = self.eng.routing
+            self.app_config["headroom_db"] = self.eng.headroom_db
+            self.save_config()
+            self.log_win.log(f"[ROUTING] " + " ".join(f"{k}>{'+'.join(str(c + 1) for c in v['ch'])}" for k, v in self.eng.routing.items()))
+
+    def open_kit(self):
+        dlg = KitDialog(self, self.eng.kit)
+        if dlg.exec():
+            new_kit = dlg.get_kit()
+            for key in KIT_VOICES:
+                path = new_kit.get(key, "")
+                if path == self.eng.kit.get(key, ""): continue
+                try:
+                    self.eng.set_kit_sample(key, path)
+                    self.log_win.log(f"[KIT] {key}: {os.path.basename(path) if path else 'built-in'}")
+                except Exception as e:
+                    self.log_win.log(f"[ERROR] Kit {key}: {str(e)}")
+            self.app_config["kit"] = dict(self.eng.kit)
+            self.save_config()
+
+    def open_voice_cues(self):
+        root, lang, max_bytes = self._cue_spec()
+        dlg = VoiceCueDialog(self, self.eng.params, root, lang, max_bytes >> 20)
+        if dlg.exec():
+            self.eng.publish(dlg.get_settings())
+            root, lang, mb = dlg.get_library()
+            self.app_config.update(cue_dir=root, cue_lang=lang, cue_cache_mb=mb)
+            self.eng.set_cues(*self._cue_spec()[:2], mb)
+            self.save_config()
+            p = self.eng.params
+            n = len(os.listdir(self.eng.cues.root)) if self.eng.cues and os.path.isdir(self.eng.cues.root) else 0
+            self.log_win.log(f"[CUES] Count-in {p['count_in']} bar(s) | bars {'ON' if p['cue_bars'] else 'OFF'} | sections {'ON' if p['cue_sections'] else 'OFF'} | {n} files in {root}")
+
+    def open_groove(self):
+        dlg = GrooveDialog(self, self.eng.params["groove"])
+        if dlg.exec():
+            try: g = dlg.get_groove()
+            except Exception as e: self.log_win.log(f"[ERROR] Groove: {str(e)}"); return
+            self.eng.update("groove", g)
+            self.app_config["groove"] = g
+            self.save_config()
+            self.log_win.log(f"[GROOVE] {g['name']} | swing {g['swing']:g}% ({g['swing_grid']}) | humanize ±{g['humanize']['ticks']} ticks" if g else "[GROOVE] Straight")
+
+    def open_speed_trainer(self):
+        dlg = SpeedTrainerDialog(self, self.eng.params)
+        if dlg.exec():
+            self.eng.publish(dlg.get_settings())
             self.save_config()
-            self.log_win.log(f"[RND SETTINGS] Play:{ranges['rnd_play_min']}-{ranges['rnd_play_max']} | Mute:{ranges['rnd_mute_min']}-{ranges['rnd_mute_max']}")
+            p = self.eng.params
+            self.log_win.log(f"[TRAINER] {'ON' if p['trainer'] else 'OFF'} {p['trainer_step']:+d} BPM every {p['trainer_every']} bars -> {p['trainer_max']}")
 
     def open_editor(self):
         dlg = SetlistEditor(self, self.setlist, self.setlist_idx)
@@ -1132,17 +4103,27 @@ class InnerPulseQt(QMainWindow):
         s = self.setlist[self.setlist_idx]
         self.sp_bpm_obj[1].setValue(s["bpm"])
         self.sp_bpb_obj[1].setValue(s["bpb"])
+        self.eng.update("sections", tuple(sorted((int(b), str(n)) for b, n in s.get("sections", {}).items())))
+        if s.get("track") or self.eng.track_spec:
+            tr = self.eng.set_track(s.get("track"), float(s.get("track_gain", 1.0)), float(s.get("track_offset_ms", 0.0)) / 1000.0)
+            if tr: self.log_win.log(f"[TRACK] {os.path.basename(tr.path)} ({tr.n_src / tr.src_sr:.0f}s @ {tr.src_sr}Hz)")
         self.update_song_display()
 
     def update_song_display(self):
-        self.lbl_song.setText(f"{self.setlist_idx+1}. {self.setlist[self.setlist_idx]['name']}")
+        s = self.setlist[self.setlist_idx]
+        self.lbl_song.setText(f"{self.setlist_idx+1}. {s['name']}" + (" ♪" if s.get("track") else ""))
 
     def change_dev(self):
+        self.leave_idle()
         self.is_locked = True
         self.btn_start.setText("WAIT...")
         self.eng.device_index = self.combo_dev.currentData()
-        msg = self.eng.boot()
+        self.booted(self.eng.boot())
+
+    def booted(self, msg):
         self.log_win.log(f"[BOOT] {msg}")
+        self.apply_latency_cal()
+        self.vis_offset_ms = float(self.app_config.get("vis_offsets", {}).get(self.eng.current_device_name, 0.0))
         QTimer.singleShot(1500, self.unlock_controls)
         self.app_config["audio_device"] = self.combo_dev.currentText()
         self.save_config()
@@ -1151,25 +4132,67 @@ class InnerPulseQt(QMainWindow):
         self.is_locked = False
         self.btn_start.setText("START")
         self.btn_start.setEnabled(True)
+        self.arm_idle()
+
+    def arm_idle(self):
+        idle_s = float(self.app_config.get("idle_s", 30))
+        if idle_s > 0 and not self.eng.is_playing: self.idle_tmr.start(int(idle_s * 1000))
+
+    def enter_idle(self):
+        if self.eng.is_playing or self.eng.pending_start or self.eng.start_wait or self.replay or self.is_idle: return
+        rates = self.wakeup_rates()
+        self.eng.park()
+        self.is_idle = True
+        self.tmr.setInterval(IDLE_POLL_MS); self.watchdog.set_interval(IDLE_POLL_MS)
+        self.log_win.log(f"[IDLE] Parked{' stream' if self.eng.parked else ''} | active: {rates}")
+
+    def leave_idle(self):
+        self.idle_tmr.stop()
+        if not self.is_idle: return
+        rates = self.wakeup_rates()
+        self.is_idle = False
+        self.tmr.setInterval(ACTIVE_POLL_MS); self.watchdog.set_interval(ACTIVE_POLL_MS)
+        self.log_win.log(f"[IDLE] Resume | idle: {rates}")
+
+    def wakeup_rates(self):
+        # 前回呼び出しからの 起床/秒 (オーディオコールバックと UI ポーリング)
+        now, cb, polls = time.perf_counter(), self.eng.cb_count, self.poll_count
+        t0, cb0, p0 = self._wake_mark
+        self._wake_mark = (now, cb, polls)
+        dt = max(now - t0, 1e-6)
+        return f"audio {(cb - cb0) / dt:.1f}/s, ui {(polls - p0) / dt:.1f}/s over {dt:.1f}s"
+
+    def log_wakeups(self):
+        self.log_win.log(f"[WAKEUPS] {'IDLE' if self.is_idle else 'ACTIVE'} {self.wakeup_rates()}")
 
     def change_buf(self):
+        self.leave_idle()
         self.is_locked = True
         self.btn_start.setText("WAIT...")
         self.eng.buffer_size = int(self.combo_buf.currentText())
         msg = self.eng.boot()
         self.log_win.log(f"[BOOT] {msg}")
+        self.apply_latency_cal()
         QTimer.singleShot(1000, self.unlock_controls)
         self.app_config["buffer_size"] = self.combo_buf.currentText()
         self.save_config()
 
     def toggle(self):
-        if self.eng.is_playing:
+        if self.eng.is_playing or self.eng.start_wait:
             self.eng.pause()
+            if self.eng.scorer and self.eng.scorer.results:
+                sc = self.eng.scorer
+                self.log_win.log(f"[SCORE] {sc.score():.1f} (PLAY {sc.score('play'):.1f} / MUTE {sc.score('mute'):.1f}) | Hits:{len(sc.results)} | Load:{self.eng.listen_load*100:.1f}% of block")
             self.btn_start.setText("START")
             self.btn_start.setStyleSheet("background: #007acc;")
+            if self.eng.track and self.eng.track.underruns:
+                self.log_win.log(f"[TRACK] {self.eng.track.underruns} underruns")
+            self.arm_idle()
         else:
+            self.replay = None
+            self.leave_idle()
             self.canvas.reset_pos()
-            self.eng.request_start()
+            self.eng.request_start(wait=False)
             self.btn_start.setText("STOP")
             self.btn_start.setStyleSheet("background: #c30; border: 1px solid #900;")
             self.last_bt = 0
@@ -1192,17 +4215,120 @@ class InnerPulseQt(QMainWindow):
         self.sp_mute_obj[1].setEnabled(not is_rnd)
 
     def poll_queue(self):
+        self.watchdog.beat(); self.poll_count += 1
+        self.eng.poll_start()
+        if self.replay: self._replay_step()
+        lv = None
         while not self.eng.queue.empty():
             d = self.eng.queue.get()
-            if d["type"] == "vis": self.canvas.update_pos(d["pos"], d["mute"], self.eng.params["bpb"])
+            if d["type"] == "vis":
+                if "t" in d: self.vis_anchor = (d["t"], d["b"], d["bps"], d["mute"], d["ci"])
+                else: self.vis_anchor = None; self.canvas.update_pos(d["pos"], d["mute"], self.eng.params["bpb"])
+                if "peak" in d: lv = (max(d["peak"], lv[0]), max(d["rms"], lv[1]), max(d["gr"], lv[2])) if lv else (d["peak"], d["rms"], d["gr"])
+            elif d["type"] == "log":
+                self.log_win.log(d["msg"])
+                if "first_block" in d: self.on_first_click(d["first_block"])
+            elif d["type"] == "cal": self.on_calibration(d)
+            elif d["type"] == "boot": self.on_boot(d)
+            elif d["type"] == "hit":
+                if self.recorder: self.recorder.append(1, time.perf_counter(), d["s"], 0.0, self.eng.params["bpm"], d["bar"], d["beat"], self.eng.params["bpb"], d["mute"], off_ms=d["off_ms"])
+                self.lbl_bar.setText(f"Bar: {d['bar']}  {d['off_ms']:+.0f}ms  ({d['score']:.0f})")
+                self.log_win.log(f"[HIT{' MUTE' if d['mute'] else ''}] Bar:{d['bar']} Beat:{d['beat']} {'LATE' if d['off_ms'] > 0 else 'EARLY'} {d['off_ms']:+.1f}ms | Score:{d['score']:.1f}")
+            elif d["type"] == "evt" and d["bar"] <= 0:
+                self.lbl_bar.setText(f"Count-in: {d['word']}")
             elif d["type"] == "evt":
-                self.lbl_bar.setText(f"Bar: {d['bar']}")
-                if self.last_bt > 0:
-                    df = (d["ts"] - self.last_bt - (60.0/self.eng.params["bpm"])) * 1000
-                    self.diffs.append(df); self.log_win.log(f"[{'MUTE' if d['mute'] else 'PLAY'}] Bar:{d['bar']} Beat:{d['beat']} (Df:{df:+.1f}ms) | Vis:{d['vis_err']:.4f}°")
-                self.last_bt = d["ts"]
+                if d["beat"] == 1: self.eng.prefetch_cues(d["bar"])
+                if self.recorder: self.recorder.append(0, d["ts"], d["s"], d["pos"], d["bpm"], d["bar"], d["beat"], d["bpb"], d["mute"], d["vis_err"],
+                                                      ideal=d["ideal"], t_out=d["dac"] or d["t_spk"], sr=self.eng.sr)
+                self.lbl_bar.setText(f"Bar: {d['bar']}" + (f" @ {d['bpm']:.0f}" if self.eng.params["trainer"] else ""))
+                if self.last_bt:
+                    # Df: 実サンプルと理想位置の差 (スケジューリング誤差)。Spk: 発音時刻の間隔 - サンプル間隔 (到着/レイテンシ推定の揺れ)
+                    df = (d["s"] - d["ideal"]) / self.eng.sr * 1000
+                    spk = (d["t_spk"] - self.last_bt[0] - (d["s"] - self.last_bt[1]) / self.eng.sr) * 1000
+                    self.diffs.append(df); self.log_win.log(f"[{'MUTE' if d['mute'] else 'PLAY'}] Bar:{d['bar']} Beat:{d['beat']} (Df:{df:+.3f}ms Spk:{spk:+.2f}ms) | Vis:{d['vis_err']:.4f}°")
+                self.last_bt = (d["t_spk"], d["s"])
+        self.meter.set_levels(*(lv or (0.0, 0.0, 0.0)))
+        if self.vis_anchor and not self.replay:
+            # 描画時点でスピーカーから出ている拍位置を予測 (コールバックが止まったら 0.5 秒で外挿をやめる)
+            t, b, bps, mute, ci = self.vis_anchor
+            dt = min(time.perf_counter() - self.vis_offset_ms / 1000.0 - t, 0.5)
+            pos = b + dt * bps
+            if -ci <= pos < 0: pos += ci # カウントイン中も拍の位相で振る (ci は小節の整数倍)
+            self.canvas.update_pos(max(-1.0, pos), mute, self.eng.params["bpb"])
+
+def startup_report():
+    # 各段階のプロセス開始からの経過 ms (time-to-window = window_shown, time-to-first-click = first_click)
+    return {k: (v - STARTUP["t0"]) * 1000.0 for k, v in STARTUP.items() if k != "t0"}
+
+def write_startup_profile():
+    # --profile-startup [--profile-out startup.jsonl] : 回帰追跡用に 1 起動 1 行の JSON を追記
+    if "--profile-startup" not in sys.argv: return
+    rec = dict(startup_report(), time=time.time(), version=APP_VERSION, platform=platform.platform())
+    line = json.dumps(rec)
+    path = _cli_arg("--profile-out", "")
+    if path:
+        with open(path, 'a', encoding='utf-8') as f: f.write(line + "\n")
+    else: print(line, flush=True)
+
+def _cli_arg(name, default):
+    return type(default)(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
 
 if __name__ == "__main__":
+    _arg = _cli_arg
+    if "--server" in sys.argv:
+        # python InnerPulse.py --server sessions.json [--workers N] [--seconds S] [--block 512]
+        for st in serve(_arg("--server", ""), _arg("--workers", 0) or None, _arg("--seconds", 0.0), _arg("--block", 512)):
+            print(f"[SERVER] {st['sessions']} sessions | {st['audio_s']:.1f}s audio | load {st['load']*100:.1f}% | late blocks {st['late_blocks']}")
+        sys.exit(0)
+    if "--bench-server" in sys.argv:
+        # python InnerPulse.py --bench-server [--workers N] [--seconds 5] [--block 512]
+        rep = bench_server(_arg("--workers", 0) or None, _arg("--seconds", 5.0), _arg("--block", 512))
+        for n, rt in sorted(rep["results"].items()): print(f"  {n:5d} sessions: {rt:7.2f}x real time")
+        print(f"[BENCH] {rep['workers']} workers / block {rep['block']}: {rep['max_sessions']} real-time sessions")
+        sys.exit(0)
+    if "--bench-render" in sys.argv:
+        # python InnerPulse.py --bench-render [--frames 600] : 各レンダラで振り子/LED を同じ軌跡で描いてフレーム時間を比べる
+        app = QApplication(sys.argv)
+        n = _arg("--frames", 600)
+        for renderer in ("painter", "scene", "gl"):
+            w = make_visualizer(renderer); w.resize(360, 300); w.show(); app.processEvents()
+            for mode in ("BAR", "LED"):
+                w.set_mode(mode); w.frame_times = collections.deque(maxlen=n)
+                for i in range(n):
+                    w.update_pos(i * 0.02, (i // 200) % 2 == 1, 4); w.repaint(); app.processEvents()
+                st = frame_stats(w.frame_times)
+                print(f"[BENCH] {renderer:8s} {mode}: mean {st['mean_ms']:.3f}ms p95 {st['p95_ms']:.3f}ms max {st['max_ms']:.3f}ms")
+            w.close()
+        sys.exit(0)
+    if "--golden" in sys.argv:
+        # python InnerPulse.py --golden [--golden-file tests/golden.json] [--update] [--only name] : 失敗があれば終了コード 1
+        path = _arg("--golden-file", os.path.join(os.path.dirname(os.path.abspath(__file__)), GOLDEN_FILENAME))
+        failed = golden_run(path, "--update" in sys.argv, _arg("--only", ""))
+        print(f"[GOLDEN] {len(failed)} failed" + (f": {', '.join(failed)}" if failed else ""))
+        sys.exit(1 if failed else 0)
+    if "--export-smf" in sys.argv:
+        # python InnerPulse.py --export-smf click.mid [--setlist setlist.json] [--bars 64] : 既定のパラメータでセットリスト全体を書き出す
+        path = _arg("--setlist", os.path.join(os.path.dirname(os.path.abspath(__file__)), JSON_FILENAME))
+        songs = []
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f: songs = json.load(f)
+        t = time.perf_counter()
+        rep = export_smf(AudioEngine(), _arg("--export-smf", ""), songs or [DEFAULT_SONG], _arg("--bars", 64))
+        print(f"[MIDI] {rep['songs']} songs | {rep['bars']} bars | {rep['notes']} notes | {(time.perf_counter() - t) * 1000:.1f}ms")
+        sys.exit(0)
+    if "--calibrate-test" in sys.argv:
+        # python InnerPulse.py --calibrate-test [--delay-ms 23.4] [--block 256] : 出力の遅延コピーを入力に戻して校正を自己検証
+        r = calibrate_offline(delay_s=_arg("--delay-ms", 23.4) / 1000.0, block=_arg("--block", 256))
+        print(f"[CAL] true {r['true_ms']:.3f}ms | measured {r['rt_ms']:.3f}ms | error {r['rt_ms'] - r['true_ms']:+.4f}ms | jitter {r['jitter_ms']:.4f}ms | SNR {r['snr']:.0f}")
+        sys.exit(0 if abs(r['rt_ms'] - r['true_ms']) < 0.1 else 1)
+    if "--score-wav" in sys.argv:
+        # python InnerPulse.py --score-wav take.wav --bpm 120 [--bpb 4] [--first-beat 0.5] [--latency-ms 0]
+        rep = score_wav(_arg("--score-wav", ""), _arg("--bpm", 120.0), _arg("--bpb", 4), _arg("--play", 0), _arg("--mute", 0),
+                        _arg("--first-beat", 0.0), _arg("--latency-ms", 0.0))
+        for r in rep["results"]:
+            print(f"Bar:{r['bar']:>3} Beat:{r['beat']} {'MUTE' if r['mute'] else 'PLAY'} {r['off_ms']:+7.1f}ms")
+        print(f"Score: {rep['score']:.1f} (PLAY {rep['play']:.1f} / MUTE {rep['mute']:.1f}) | Load: {rep['load']*100:.2f}% of real time")
+        sys.exit(0)
     signal.signal(signal.SIGINT, signal.SIG_DFL)
     app = QApplication(sys.argv)
     window = InnerPulseQt()
@@ -0,0 +1,68 @@
+# スウィングを _cb で実際に描画し、発音サンプル位置を解析的な期待値と比べる
+# python -m pytest -q tests
+import os, sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import InnerPulse as ip
+
+SR = 48000
+BPM = 60 # 1 拍 48000 サンプル: 16th スウィングでも波形 (0.1 秒) が重ならず発音を分けて拾える
+SPB = SR * 60 // BPM
+SILENT = {"v_acc": 0.0, "v_backbeat": 0.0, "v_4th": 0.0, "v_8th": 0.0, "v_16th": 0.0, "v_trip": 0.0}
+
+def render_onsets(params, bars=1, block=256):
+    # bars 小節ぶん _cb を回して、16 サンプル以上の無音のあとの立ち上がり位置を返す
+    eng = ip.AudioEngine()
+    eng.noise_seed = 0
+    eng.publish(dict(SILENT, bpm=BPM, bpb=4, play=1, mute=0, **params))
+    eng.open_offline(SR, 2)
+    eng.request_start()
+    out = np.zeros((block, 2), dtype=np.float32)
+    chunks = []
+    while len(chunks) * block < bars * 4 * SPB:
+        eng._cb(out, block, None, None)
+        chunks.append(out[:, 0].copy())
+    idx = np.flatnonzero(np.concatenate(chunks)[:bars * 4 * SPB] != 0)
+    return idx[np.diff(idx, prepend=-16) >= 16].tolist()
+
+def expected(beat_fracs, bars=1, lead=0):
+    # lead: 波形の頭が 0 のボイス (bell/click は sin(0) = 0) は 1 サンプル後に立ち上がる
+    return [int(b * SPB + f * SPB + 1e-6) + lead for b in range(bars * 4) for f in beat_fracs]
+
+def swing(name, **kw):
+    return dict(ip.GROOVES[name], **kw)
+
+# 8th ボイスは裏拍 (0.5)、16th ボイスは 0.25 / 0.75、拍頭は acc / 4th が鳴らす
+def test_straight_offbeats():
+    assert render_onsets({"v_8th": 0.4}) == expected([0.5])
+    assert render_onsets({"v_16th": 0.4}) == expected([0.25, 0.75])
+
+def test_swing_8th_offbeat_lands_at_swing_ratio():
+    assert render_onsets({"v_8th": 0.4, "groove": swing("Swing 8th 62%")}) == expected([0.62])
+
+def test_swing_8th_moves_16ths_in_order_inside_the_beat():
+    # 8th グリッドの 62%: 組 (1 拍) の前半を 0.62 まで伸ばし、後半を残りに縮める
+    g = swing("Swing 8th 62%")
+    s16 = render_onsets({"v_16th": 0.4, "groove": g})
+    s8 = render_onsets({"v_8th": 0.4, "groove": g})
+    assert s16 == expected([0.31, 0.81])
+    per_beat = np.sort(np.concatenate([s16, s8])).reshape(4, 3) - np.arange(4)[:, None] * SPB
+    assert (np.diff(per_beat, axis=1) > 0).all() and (per_beat > 0).all() and (per_beat < SPB).all()
+
+@pytest.mark.parametrize("pct", [25.0, 50.0, 66.67, 75.0])
+def test_16ths_stay_distinct_at_any_swing(pct):
+    g, s = swing("Swing 8th 62%", swing=pct), pct / 100.0
+    both = sorted(render_onsets({"v_16th": 0.4, "groove": g}) + render_onsets({"v_8th": 0.4, "groove": g}))
+    assert both == sorted(expected([0.5 * s, s + 0.5 * (1 - s)]) + expected([s]))
+    assert len(set(both)) == 12
+
+def test_swing_16th_grid():
+    assert render_onsets({"v_16th": 0.4, "groove": swing("Swing 16th 58%", velocity={})}) == expected([0.29, 0.79])
+
+def test_swing_does_not_move_downbeats_or_quarters():
+    straight = render_onsets({"v_acc": 0.8, "v_4th": 0.5}, bars=2)
+    assert straight == expected([0.0], bars=2, lead=1)
+    for name in ("Swing 8th 62%", "Swing 16th 58%"):
+        assert render_onsets({"v_acc": 0.8, "v_4th": 0.5, "groove": swing(name)}, bars=2) == straight